@@ -12,6 +12,11 @@ from . import presentor
 from . import crypto
 from . import sender
 from . import receiver
+from . import maintenance
+from . import ratelimit
+from . import ringbuffer
+from . import monitoring
+from . import proof_of_work
 
 
 def obtain_app_dir():
@@ -50,8 +55,39 @@ def make_default_config(config_file):
         parser.add_section("Server")
         parser.set("Server", "address", "0.0.0.0")
         parser.set("Server", "port", "8001")
+        parser.set("Server", "ring_buffer_mb", "0")
+        parser.add_section("Storage")
+        parser.set("Storage", "batch_size", "100")
+        parser.set("Storage", "batch_delay_ms", "50")
+        parser.set("Storage", "durability", "normal")
+        parser.set("Storage", "ciphergrams_max_rows", "100000")
+        parser.set("Storage", "ciphergrams_max_mb", "256")
+        parser.set("Storage", "eviction", "age")
+        parser.add_section("Maintenance")
+        parser.set("Maintenance", "expiry_interval", "600")
+        parser.set("Maintenance", "vacuum_interval", "3600")
+        parser.set("Maintenance", "checkpoint_interval", "300")
+        parser.set("Maintenance", "analyze_interval", "86400")
+        parser.add_section("Limits")
+        parser.set("Limits", "connections_per_second", "10")
+        parser.set("Limits", "messages_per_second", "50")
+        parser.set("Limits", "bytes_per_second", "1048576")
+        parser.set("Limits", "max_connections", "64")
+        parser.add_section("PoW")
+        parser.set("PoW", "normal_rate", "20")
+        parser.set("PoW", "max_difficulty", "64")
+        parser.add_section("TLS")
+        parser.set("TLS", "certificate", "ecdsa")
+        parser.set("TLS", "min_version", "1.3")
+        parser.set("TLS", "ciphers", "ECDHE+AESGCM:ECDHE+CHACHA20")
+        parser.set("TLS", "session_tickets", "2")
+        parser.add_section("Crypto")
+        parser.set("Crypto", "suite", "rsa")
         parser.add_section("GUI")
         parser.set("GUI", "port", "8002")
+        parser.set("GUI", "workers", "4")
+        parser.add_section("Metrics")
+        parser.set("Metrics", "port", "8003")
         parser.write(config)
 
 
@@ -62,45 +98,152 @@ def read_config(app_dir):
 
     parser = configparser.ConfigParser()
     parser.read(str(conf_file))
-    return (
-        (
-            parser.get("Server", "address", fallback="0.0.0.0"),
-            parser.getint("Server", "port", fallback=8001)
+    return parser
+
+
+def make_receiver_queue(config):
+    ring_buffer_mb = config.getint("Server", "ring_buffer_mb", fallback=0)
+    if ring_buffer_mb > 0:
+        return ringbuffer.RingBuffer(ring_buffer_mb * 1024 * 1024)
+    return multiprocessing.Queue()
+
+
+def make_admission_control(config):
+    return ratelimit.AdmissionControl(
+        connections_rate=config.getfloat(
+            "Limits", "connections_per_second", fallback=10
+        ),
+        messages_rate=config.getfloat(
+            "Limits", "messages_per_second", fallback=50
+        ),
+        bytes_rate=config.getint(
+            "Limits", "bytes_per_second", fallback=1 << 20
         ),
-        parser.getint("GUI", "port", fallback=8002)
+        max_connections=config.getint(
+            "Limits", "max_connections", fallback=64
+        ),
+    )
+
+
+def make_certificates(config, app_dir):
+    return crypto.CertificateProvider(
+        app_dir,
+        key_type=config.get("TLS", "certificate", fallback="ecdsa"),
+        tls=crypto.TLSSettings(
+            min_version=config.get("TLS", "min_version", fallback="1.3"),
+            ciphers=config.get(
+                "TLS", "ciphers", fallback="ECDHE+AESGCM:ECDHE+CHACHA20"
+            ),
+            session_tickets=config.getint(
+                "TLS", "session_tickets", fallback=2
+            ),
+        )
     )
 
 
+def make_maintenance(config, storage_obj):
+    return maintenance.Maintenance(
+        storage_obj,
+        **{
+            interval: config.getint("Maintenance", interval, fallback=default)
+            for interval, default in (
+                ("expiry_interval", 600),
+                ("vacuum_interval", 3600),
+                ("checkpoint_interval", 300),
+                ("analyze_interval", 60*60*24),
+            )
+        }
+    )
+
+
+def make_metrics_server(config, metrics):
+    port = config.getint("Metrics", "port", fallback=8003)
+    if port <= 0:
+        return None
+    return monitoring.MetricsServer(metrics, port)
+
+
 def main():
     app_dir = obtain_app_dir()
     ttl_two_days = 60 * 60 * 24 * 2
     db_path = app_dir / "db.sqlite3"
     bootstrap_list = app_dir / "bootstrap.list"
-    serv_addr, gui_port = read_config(app_dir)
-
-    storage_obj = storage.Storage(db_path, ttl_two_days)
+    config = read_config(app_dir)
+    serv_addr = (
+        config.get("Server", "address", fallback="0.0.0.0"),
+        config.getint("Server", "port", fallback=8001)
+    )
+    gui_port = config.getint("GUI", "port", fallback=8002)
+    # made before any child process starts, so they share its counters
+    metrics = monitoring.Metrics()
+
+    storage_obj = storage.Storage(
+        db_path, ttl_two_days,
+        batch_size=config.getint("Storage", "batch_size", fallback=100),
+        batch_delay=config.getint(
+            "Storage", "batch_delay_ms", fallback=50
+        ) / 1000,
+        durability=config.get("Storage", "durability", fallback="normal"),
+        ciphergrams_quota=storage.CiphergramsQuota(
+            max_rows=config.getint(
+                "Storage", "ciphergrams_max_rows", fallback=100000
+            ),
+            max_bytes=config.getint(
+                "Storage", "ciphergrams_max_mb", fallback=256
+            ) * 1024 * 1024,
+            policy=config.get("Storage", "eviction", fallback="age")
+        ),
+        metrics=metrics
+    )
     bootstrap(storage_obj, bootstrap_list)
-    keys = crypto.KeysProvider(app_dir)
-    certs = crypto.CertificateProvider(app_dir)
-    mcrypto = crypto.MessageCrypto(keys)
+    maintenance_obj = make_maintenance(config, storage_obj)
+    maintenance_obj.start()
+    keys = crypto.KeysProvider(
+        app_dir, config.get("Crypto", "suite", fallback="rsa")
+    )
+    certs = make_certificates(config, app_dir)
+    mcrypto = crypto.MessageCrypto(keys, metrics)
 
-    sender_queue = multiprocessing.Queue()
-    receiver_queue = multiprocessing.Queue()
+    sender_queue = sender.PriorityQueue()
+    receiver_queue = make_receiver_queue(config)
 
+    max_difficulty = config.getint("PoW", "max_difficulty", fallback=64)
     sender_obj = sender.Sender(
-        mcrypto, certs, storage_obj, serv_addr[-1], sender_queue
+        mcrypto, certs, storage_obj, serv_addr[-1], sender_queue,
+        max_difficulty=max_difficulty, metrics=metrics
+    )
+    presentor_obj = presentor.Presentor(
+        sender_obj, keys, storage_obj, metrics=metrics
+    )
+    gui_obj = gui.WebeventsGUI(
+        presentor_obj, gui_port,
+        workers=config.getint("GUI", "workers", fallback=4),
+        metrics=metrics
     )
-    presentor_obj = presentor.Presentor(sender_obj, keys, storage_obj)
-    gui_obj = gui.WebeventsGUI(presentor_obj, gui_port)
     receiver_obj = receiver.Receiver(
         gui_obj, sender_obj, storage_obj,
-        mcrypto, certs, receiver_queue, serv_addr
+        mcrypto, certs, receiver_queue, serv_addr,
+        make_admission_control(config),
+        pow_policy=proof_of_work.PowPolicy(
+            normal_rate=config.getfloat("PoW", "normal_rate", fallback=20),
+            max_difficulty=max_difficulty
+        ),
+        metrics=metrics
     )
+    metrics_server = make_metrics_server(config, metrics)
+    if metrics_server is not None:
+        metrics_server.start()
 
+    sender_obj.add_status_callback(gui_obj.push_message_status)
     gui_obj.add_termination_callback(lambda: receiver_obj.terminate())
     gui_obj.add_termination_callback(lambda: sender_obj.terminate())
     sender_obj.request_offline_data()
     receiver_obj.run()
+    if metrics_server is not None:
+        metrics_server.stop()
+    receiver_queue.close()
+    maintenance_obj.stop()
+    storage_obj.close()
     storage_obj.delete_expired_data()
 
 
@@ -0,0 +1,19 @@
+import time
+import queue
+
+
+def collect_batch(items, max_items, max_delay, keep_collecting):
+    """Waits for an item of the items queue and then collects up to
+    max_items of them during max_delay seconds, stops early after
+    an item for which keep_collecting returns False"""
+    batch = [items.get()]
+    deadline = time.monotonic() + max_delay
+    while len(batch) < max_items and keep_collecting(batch[-1]):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(items.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
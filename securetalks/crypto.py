@@ -1,5 +1,12 @@
+import ssl
+import lzma
 import time
+import zlib
 import json
+import struct
+import timeit
+import hashlib
+import tempfile
 import logging
 import pathlib
 import datetime
@@ -9,18 +16,39 @@ import cryptography
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.fernet import Fernet
 
+from . import monitoring
 from . import proof_of_work
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# RSA-OAEP wrapped keys and RSA-PSS signatures are the original suite,
+# X25519 key agreement and Ed25519 signatures are the elliptic curve one
+SUITE_RSA, SUITE_EC = 1, 2
+SUITES = dict(rsa=SUITE_RSA, ec=SUITE_EC)
+EC_KEY_PREFIX = "ec1:"
+RAW_KEY_SIZE = 32
+# suite byte, ephemeral public key, 44 bytes of fernet key and the tag
+EC_CIPHERKEY_SIZE = 1 + RAW_KEY_SIZE + 44 + 16
+# group cipherkeys start with a hint of their recipient's key
+HINT_SIZE = 2
+
+# the first plaintexts were json of hex strings, they start with "["
+PLAINTEXT_V2 = 2
+COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_LZMA = range(3)
+
 
 @dataclasses.dataclass(frozen=True)
 class EncryptedMessage:
@@ -31,10 +59,72 @@ class EncryptedMessage:
     timestamp: int
 
 
+@dataclasses.dataclass(frozen=True)
+class GroupEncryptedMessage:
+    """One ciphertext for several recipients, each of them
+    has its own copy of the secret key in cipherkeys, prefixed
+    with a hint of the recipient's key"""
+    ciphertext: str
+    cipherkeys: tuple
+    signature: str
+    proof: int
+    timestamp: int
+
+
+def get_key_hint(encryption_key, ciphertext):
+    """Few bytes of a hash of the key salted by the ciphertext, so they
+    don't link messages, though anyone knowing the key can check them"""
+    if isinstance(encryption_key, x25519.X25519PublicKey):
+        key_bytes = encryption_key.public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw,
+        )
+    else:
+        key_bytes = encryption_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    return hashlib.sha256(ciphertext[:32] + key_bytes).digest()[:HINT_SIZE]
+
+
+def get_cipherkeys(ciphergram):
+    if isinstance(ciphergram, GroupEncryptedMessage):
+        return ciphergram.cipherkeys
+    return (ciphergram.cipherkey, )
+
+
+class TLSSettings:
+    """Options of the TLS contexts of the sender and the receiver"""
+
+    versions = {"1.2": ssl.TLSVersion.TLSv1_2, "1.3": ssl.TLSVersion.TLSv1_3}
+
+    def __init__(self, min_version="1.3",
+                 ciphers="ECDHE+AESGCM:ECDHE+CHACHA20", session_tickets=2):
+        if min_version not in self.versions:
+            raise ValueError(f"Unsupported TLS version {min_version}")
+        self.min_version = self.versions[min_version]
+        # applies to TLS 1.2 only, TLS 1.3 suites are all AEAD ones
+        self.ciphers = ciphers
+        self.session_tickets = session_tickets
+
+    def apply(self, context):
+        context.minimum_version = self.min_version
+        if self.ciphers:
+            context.set_ciphers(self.ciphers)
+        return context
+
+
 class CertificateProvider:
-    def __init__(self, data_dir):
-        cert_key_file = data_dir / "cert_key.pem"
-        cert_file = data_dir / "cert.pem"
+    key_types = ("rsa", "ecdsa", "ed25519")
+
+    def __init__(self, data_dir, key_type="rsa", tls=None):
+        if key_type not in self.key_types:
+            raise ValueError(f"Unknown certificate key type {key_type}")
+        self.key_type = key_type
+        self.tls = TLSSettings() if tls is None else tls
+        suffix = "" if key_type == "rsa" else f"_{key_type}"
+        cert_key_file = data_dir / f"cert_key{suffix}.pem"
+        cert_file = data_dir / f"cert{suffix}.pem"
 
         self.key_file = str(cert_key_file)
         self.cert_file = str(cert_file)
@@ -43,18 +133,46 @@ class CertificateProvider:
             self._make_certificate_key()
             self._make_certificate()
 
+    def make_server_context(self):
+        context = self.tls.apply(ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER))
+        context.load_cert_chain(self.cert_file, self.key_file)
+        context.num_tickets = self.tls.session_tickets
+        if not self.tls.session_tickets:
+            context.options |= ssl.OP_NO_TICKET
+        return context
+
+    def make_client_context(self):
+        # nodes are authenticated by their message keys, not certificates
+        context = self.tls.apply(ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT))
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
     def _make_certificate_key(self):
-        self.key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        # handshakes signed by elliptic curve keys are much cheaper
+        # for a node accepting many short connections
+        if self.key_type == "ecdsa":
+            self.key = ec.generate_private_key(
+                ec.SECP256R1(), backend=default_backend()
+            )
+        elif self.key_type == "ed25519":
+            self.key = ed25519.Ed25519PrivateKey.generate()
+        else:
+            self.key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+                backend=default_backend()
+            )
 
         with open(self.key_file, "wb") as key_file:
             key_file.write(
                 self.key.private_bytes(
                     encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
+                    format=(
+                        serialization.PrivateFormat.TraditionalOpenSSL
+                        if self.key_type == "rsa" else
+                        serialization.PrivateFormat.PKCS8
+                    ),
                     encryption_algorithm=serialization.NoEncryption()
                 )
             )
@@ -76,7 +194,11 @@ class CertificateProvider:
         ).add_extension(
             x509.SubjectAlternativeName([x509.DNSName(u"localhost")]),
             critical=False,
-        ).sign(self.key, hashes.SHA256(), default_backend())
+        ).sign(
+            self.key,
+            None if self.key_type == "ed25519" else hashes.SHA256(),
+            default_backend()
+        )
 
         with open(self.cert_file, "wb") as cert_file:
             cert_file.write(
@@ -89,10 +211,16 @@ class RSAKeysNotFoundError(IOError):
 
 
 class KeysProvider:
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, suite="rsa"):
+        if suite not in SUITES:
+            raise ValueError(f"Unknown crypto suite {suite}")
+        self.suite = SUITES[suite]
         self._pub_file = data_dir / "pub.pem"
         self._prv_file = data_dir / "prv.pem"
+        self._x25519_file = data_dir / "x25519.pem"
+        self._ed25519_file = data_dir / "ed25519.pem"
         self._pub_key = self._prv_key = self._pub_key_str = None
+        self._ec_keys = None
 
     @property
     def pub_key(self):
@@ -102,7 +230,19 @@ class KeysProvider:
 
     @property
     def pub_key_str(self):
-        if self._pub_key_str is None:
+        if self._pub_key_str is None and self.suite == SUITE_EC:
+            x25519_key, ed25519_key = self.ec_keys
+            self._pub_key_str = EC_KEY_PREFIX + (
+                x25519_key.public_key().public_bytes(
+                    encoding=serialization.Encoding.Raw,
+                    format=serialization.PublicFormat.Raw,
+                ) +
+                ed25519_key.public_key().public_bytes(
+                    encoding=serialization.Encoding.Raw,
+                    format=serialization.PublicFormat.Raw,
+                )
+            ).hex()
+        elif self._pub_key_str is None:
             pub_pem = self.pub_key.public_bytes(
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PublicFormat.SubjectPublicKeyInfo,
@@ -116,6 +256,47 @@ class KeysProvider:
             self._obtain_keys()
         return self._prv_key
 
+    @property
+    def ec_keys(self):
+        """X25519 key for key agreement and Ed25519 key for signatures"""
+        if self._ec_keys is None:
+            self._ec_keys = (
+                self._obtain_ec_key(self._x25519_file, x25519.X25519PrivateKey),
+                self._obtain_ec_key(
+                    self._ed25519_file, ed25519.Ed25519PrivateKey
+                ),
+            )
+        return self._ec_keys
+
+    def has_keys(self, suite):
+        # keys of the other suite are never made only to fail a decryption
+        if suite == SUITE_EC:
+            return self._ec_keys is not None or (
+                self._x25519_file.exists() and self._ed25519_file.exists()
+            )
+        return self._prv_key is not None or (
+            self._pub_file.exists() and self._prv_file.exists()
+        )
+
+    def _obtain_ec_key(self, key_file, key_type):
+        if key_file.exists():
+            with open(key_file, "rb") as prv_file:
+                return serialization.load_pem_private_key(
+                    prv_file.read(), password=None, backend=default_backend()
+                )
+
+        private_key = key_type.generate()
+        with open(key_file, "wb") as prv_file:
+            prv_file.write(
+                private_key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.PKCS8,
+                    encryption_algorithm=serialization.NoEncryption(),
+                )
+            )
+        logger.info(f"Key {key_file.name} is generated and stored on the disk")
+        return private_key
+
     def _obtain_keys(self):
         try:
             self._pub_key, self._prv_key = self._load_keys()
@@ -164,6 +345,23 @@ class KeysProvider:
         return public_key, private_key
 
 
+def load_public_keys(key_str):
+    """Encryption and verification keys of a node id"""
+    if key_str.startswith(EC_KEY_PREFIX):
+        raw = bytes.fromhex(key_str[len(EC_KEY_PREFIX):])
+        if len(raw) != 2 * RAW_KEY_SIZE:
+            raise ValueError("Invalid length of an elliptic curve key")
+        return (
+            x25519.X25519PublicKey.from_public_bytes(raw[:RAW_KEY_SIZE]),
+            ed25519.Ed25519PublicKey.from_public_bytes(raw[RAW_KEY_SIZE:]),
+        )
+
+    public_key = serialization.load_pem_public_key(
+        bytes.fromhex(key_str), backend=default_backend()
+    )
+    return public_key, public_key
+
+
 class MessageCryptoError(Exception):
     """Base class for all message errors"""
 
@@ -188,22 +386,39 @@ class MessageVerificationError(MessageCryptoError):
     """Error when message's sender and author are not the same"""
 
 
+def _encode_key(key_str):
+    if key_str.startswith(EC_KEY_PREFIX):
+        return bytes([SUITE_EC]), bytes.fromhex(key_str[len(EC_KEY_PREFIX):])
+    return bytes([SUITE_RSA]), bytes.fromhex(key_str)
+
+
+def _decode_key(suite, raw):
+    if suite == SUITE_EC:
+        return EC_KEY_PREFIX + raw.hex()
+    return raw.hex()
+
+
+def _decompress(decompressor, data, max_size):
+    plaintext = decompressor.decompress(data, max_size + 1)
+    if len(plaintext) > max_size or not decompressor.eof:
+        raise ValueError("Plaintext is too large or truncated")
+    return plaintext
+
+
 class MessageCrypto:
-    def __init__(self, keys_provider):
-        self.keys = keys_provider
+    compression_threshold = 128
+    lzma_threshold = 1 << 14
+    max_plaintext_size = 1 << 20
 
-    def get_ciphergram(self, user_key, text):
-        try:
-            user_public_key = serialization.load_pem_public_key(
-                bytes.fromhex(user_key),
-                backend=default_backend()
-            )
-        except Exception:
-            raise MessageCryptoInvalidRecipientKey
+    def __init__(self, keys_provider, metrics=None):
+        self.keys = keys_provider
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
 
-        ct, ck, s, t = self._get_ciphergram(user_public_key, text)
+    def get_ciphergram(self, user_key, text, difficulty=1):
+        user_public_key = self._load_recipient_key(user_key)
+        ct, (ck, ), s, t = self._get_ciphergram([user_public_key], text)
         proof = proof_of_work.compute_pow(
-            (ct+ck+s+str(t)).encode("utf-8")
+            (ct+ck+s+str(t)).encode("utf-8"), difficulty
         )
         return EncryptedMessage(
             ciphertext=ct,
@@ -213,19 +428,68 @@ class MessageCrypto:
             timestamp=t
         )
 
-    def _get_ciphergram(self, user_public_key, text):
+    def get_group_ciphergram(self, user_keys, text, difficulty=1):
+        """Encrypts the text once for all of the users, so the
+        proof of work is computed only once too"""
+        user_public_keys = [
+            self._load_recipient_key(user_key) for user_key in user_keys
+        ]
+        ct, cks, s, t = self._get_ciphergram(
+            user_public_keys, text, hinted=True
+        )
+        proof = proof_of_work.compute_pow(
+            (ct+"".join(cks)+s+str(t)).encode("utf-8"), difficulty
+        )
+        return GroupEncryptedMessage(
+            ciphertext=ct,
+            cipherkeys=cks,
+            signature=s,
+            proof=proof,
+            timestamp=t
+        )
+
+    def _load_recipient_key(self, user_key):
+        try:
+            encryption_key, _ = load_public_keys(user_key)
+        except Exception:
+            raise MessageCryptoInvalidRecipientKey
+        return encryption_key
+
+    def _get_ciphergram(self, user_public_keys, text, hinted=False):
         current_time = int(time.time())
         secret_key = Fernet.generate_key()
         fernet = Fernet(secret_key)
-        message = [
-            self.keys.pub_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo,
-            ).hex(),
-            text.encode("utf-8").hex(),
+        ciphertext = fernet.encrypt(
+            self._encode_plaintext(self.keys.pub_key_str, text)
+        )
+        # the suite of every recipient's key decides how the key is wrapped
+        ephemeral_key = x25519.X25519PrivateKey.generate()
+        cipherkeys = [
+            (get_key_hint(user_public_key, ciphertext) if hinted else b"") +
+            self._wrap_key(user_public_key, ephemeral_key, secret_key)
+            for user_public_key in user_public_keys
         ]
-        ciphertext = fernet.encrypt(json.dumps(message).encode("utf-8"))
-        cipherkey = user_public_key.encrypt(
+        signature = self._sign(ciphertext + b"".join(cipherkeys))
+
+        return (ciphertext.hex(), tuple(ck.hex() for ck in cipherkeys),
+                signature.hex(), current_time, )
+
+    def _wrap_key(self, user_public_key, ephemeral_key, secret_key):
+        if isinstance(user_public_key, x25519.X25519PublicKey):
+            ephemeral_raw = ephemeral_key.public_key().public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw,
+            )
+            kek = self._derive_kek(
+                ephemeral_key.exchange(user_public_key),
+                ephemeral_raw, user_public_key
+            )
+            # every kek encrypts a single key, so the nonce may be fixed
+            return bytes([SUITE_EC]) + ephemeral_raw + ChaCha20Poly1305(
+                kek
+            ).encrypt(bytes(12), secret_key, None)
+
+        return user_public_key.encrypt(
             secret_key,
             padding.OAEP(
                 mgf=padding.MGF1(algorithm=hashes.SHA256()),
@@ -233,8 +497,25 @@ class MessageCrypto:
                 label=None,
             ),
         )
-        signature = self.keys.prv_key.sign(
-            ciphertext + cipherkey,
+
+    def _derive_kek(self, shared_key, ephemeral_raw, user_public_key):
+        return HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None,
+            info=b"securetalks ec1" + ephemeral_raw +
+            user_public_key.public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw,
+            ),
+            backend=default_backend()
+        ).derive(shared_key)
+
+    def _sign(self, data):
+        if self.keys.suite == SUITE_EC:
+            _, ed25519_key = self.keys.ec_keys
+            return ed25519_key.sign(data)
+
+        return self.keys.prv_key.sign(
+            data,
             padding.PSS(
                 mgf=padding.MGF1(hashes.SHA256()),
                 salt_length=padding.PSS.MAX_LENGTH
@@ -242,46 +523,150 @@ class MessageCrypto:
             hashes.SHA256(),
         )
 
-        return (ciphertext.hex(), cipherkey.hex(),
-                signature.hex(), current_time, )
-
-    def get_plaintext(self, ciphergram):
-        footprint = (
-            ciphergram.ciphertext + ciphergram.cipherkey +
-            ciphergram.signature + str(ciphergram.timestamp)
-        )
-        if not proof_of_work.check_pow_valid(
-            footprint.encode("utf-8"), ciphergram.proof
+    def get_plaintext(self, ciphergram, pow_checked=False):
+        if not pow_checked and not proof_of_work.check_pow_valid(
+            self._get_footprint(ciphergram), ciphergram.proof
         ):
             raise MessagePOWError
 
         return self._get_plaintext(ciphergram)
 
+    def redo_proof(self, ciphergram, difficulty):
+        """The ciphergram with a new proof of work of the difficulty"""
+        return dataclasses.replace(
+            ciphergram,
+            proof=proof_of_work.compute_pow(
+                self._get_footprint(ciphergram), difficulty
+            )
+        )
+
+    def verify_pow_many(self, ciphergrams, pool=None):
+        return proof_of_work.verify_many(
+            [
+                (self._get_footprint(ciphergram), ciphergram.proof)
+                for ciphergram in ciphergrams
+            ],
+            pool
+        )
+
+    def get_pow_strength(self, ciphergram):
+        return proof_of_work.compute_strength(
+            self._get_footprint(ciphergram), ciphergram.proof
+        )
+
+    def _get_footprint(self, ciphergram):
+        footprint = (
+            ciphergram.ciphertext + "".join(get_cipherkeys(ciphergram)) +
+            ciphergram.signature + str(ciphergram.timestamp)
+        )
+        return footprint.encode("utf-8")
+
     def _get_plaintext(self, ciphergram):
         try:
             ciphertext = bytes.fromhex(ciphergram.ciphertext)
-            cipherkey = bytes.fromhex(ciphergram.cipherkey)
+            cipherkeys = [
+                bytes.fromhex(cipherkey)
+                for cipherkey in get_cipherkeys(ciphergram)
+            ]
             signature = bytes.fromhex(ciphergram.signature)
         except Exception:
             raise MessageDecodingError
 
-        key = self._decrypt_cipherkey(cipherkey)
-        text = self._decrypt_ciphertext(key, ciphertext)
-
-        try:
-            node_pub_key_str, message = json.loads(text.decode("utf-8"))
-            message = bytes.fromhex(message)
-            node_pub_key = serialization.load_pem_public_key(
-                bytes.fromhex(node_pub_key_str),
-                backend=default_backend()
+        hints = None
+        if isinstance(ciphergram, GroupEncryptedMessage):
+            hints = self._get_my_hints(ciphertext)
+        with self.metrics.timer("decrypt"):
+            key = self._find_cipherkey(cipherkeys, hints)
+            text = self._decrypt_ciphertext(key, ciphertext)
+
+            try:
+                node_pub_key_str, message = self._decode_plaintext(text)
+                _, node_pub_key = load_public_keys(node_pub_key_str)
+            except Exception:
+                raise MessageDecodingError
+
+        with self.metrics.timer("verify"):
+            self._verify_signature(
+                node_pub_key, ciphertext, b"".join(cipherkeys), signature
             )
-        except Exception:
-            raise MessageDecodingError
+        return node_pub_key_str, message
+
+    def _encode_plaintext(self, key_str, text):
+        """Version, compression and then the sender's key and the text
+        as raw bytes, compressed when it makes them shorter"""
+        suite, raw_key = _encode_key(key_str)
+        payload = b"".join((
+            suite, struct.pack("!H", len(raw_key)), raw_key,
+            text.encode("utf-8")
+        ))
+        compression = COMPRESSION_NONE
+        if len(payload) >= self.lzma_threshold:
+            compressed = lzma.compress(payload, preset=6)
+            compression = COMPRESSION_LZMA
+        elif len(payload) >= self.compression_threshold:
+            compressed = zlib.compress(payload, 6)
+            compression = COMPRESSION_ZLIB
+        if compression != COMPRESSION_NONE and len(compressed) < len(payload):
+            payload = compressed
+        else:
+            compression = COMPRESSION_NONE
+        return bytes([PLAINTEXT_V2, compression]) + payload
+
+    def _decode_plaintext(self, plaintext):
+        if plaintext[:1] != bytes([PLAINTEXT_V2]):
+            node_pub_key_str, message = json.loads(plaintext.decode("utf-8"))
+            return node_pub_key_str, bytes.fromhex(message).decode("utf-8")
+
+        compression, payload = plaintext[1], plaintext[2:]
+        if compression == COMPRESSION_ZLIB:
+            payload = _decompress(
+                zlib.decompressobj(), payload, self.max_plaintext_size
+            )
+        elif compression == COMPRESSION_LZMA:
+            payload = _decompress(
+                lzma.LZMADecompressor(), payload, self.max_plaintext_size
+            )
+        elif compression != COMPRESSION_NONE:
+            raise ValueError(f"Unknown compression {compression}")
+
+        suite = payload[0]
+        key_size, = struct.unpack_from("!H", payload, 1)
+        raw_key = payload[3:3 + key_size]
+        if len(raw_key) != key_size:
+            raise ValueError("Truncated key")
+        return (
+            _decode_key(suite, raw_key),
+            payload[3 + key_size:].decode("utf-8")
+        )
 
-        self._verify_signature(node_pub_key, ciphertext, cipherkey, signature)
-        return node_pub_key_str, message.decode("utf-8")
+    def _get_my_hints(self, ciphertext):
+        keys = []
+        if self.keys.has_keys(SUITE_RSA):
+            keys.append(self.keys.prv_key.public_key())
+        if self.keys.has_keys(SUITE_EC):
+            keys.append(self.keys.ec_keys[0].public_key())
+        return {get_key_hint(key, ciphertext) for key in keys}
+
+    def _find_cipherkey(self, cipherkeys, hints=None):
+        # copies of the key for a group are tried only when their hint
+        # matches a key of this node, relays mostly try none of them
+        for cipherkey in cipherkeys:
+            if hints is not None:
+                if cipherkey[:HINT_SIZE] not in hints:
+                    continue
+                cipherkey = cipherkey[HINT_SIZE:]
+            try:
+                return self._decrypt_cipherkey(cipherkey)
+            except MessageDecryptionError:
+                continue
+        raise MessageDecryptionError
 
     def _decrypt_cipherkey(self, cipherkey):
+        if len(cipherkey) == EC_CIPHERKEY_SIZE and cipherkey[0] == SUITE_EC:
+            return self._decrypt_ec_cipherkey(cipherkey)
+        if not self.keys.has_keys(SUITE_RSA):
+            raise MessageDecryptionError
+
         try:
             key = self.keys.prv_key.decrypt(
                 cipherkey,
@@ -296,6 +681,25 @@ class MessageCrypto:
 
         return key
 
+    def _decrypt_ec_cipherkey(self, cipherkey):
+        if not self.keys.has_keys(SUITE_EC):
+            raise MessageDecryptionError
+
+        x25519_key, _ = self.keys.ec_keys
+        ephemeral_raw = cipherkey[1:1 + RAW_KEY_SIZE]
+        try:
+            kek = self._derive_kek(
+                x25519_key.exchange(
+                    x25519.X25519PublicKey.from_public_bytes(ephemeral_raw)
+                ),
+                ephemeral_raw, x25519_key.public_key()
+            )
+            return ChaCha20Poly1305(kek).decrypt(
+                bytes(12), cipherkey[1 + RAW_KEY_SIZE:], None
+            )
+        except Exception as exc:
+            raise MessageDecryptionError from exc
+
     def _decrypt_ciphertext(self, key, ciphertext):
         try:
             text = Fernet(key).decrypt(ciphertext)
@@ -306,6 +710,9 @@ class MessageCrypto:
 
     def _verify_signature(self, node_pub_key, ciphertext, cipherkey, signature):
         try:
+            if isinstance(node_pub_key, ed25519.Ed25519PublicKey):
+                node_pub_key.verify(signature, ciphertext + cipherkey)
+                return
             node_pub_key.verify(
                 signature,
                 ciphertext + cipherkey,
@@ -317,3 +724,35 @@ class MessageCrypto:
             )
         except Exception as exc:
             raise MessageVerificationError from exc
+
+
+def benchmark(count=100):
+    """Seconds per message of both suites, proof of work excluded"""
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name in SUITES:
+            suite_dir = pathlib.Path(data_dir) / name
+            suite_dir.mkdir()
+            mcrypto = MessageCrypto(KeysProvider(suite_dir, name))
+            user_key = mcrypto._load_recipient_key(mcrypto.keys.pub_key_str)
+            ct, (ck, ), s, t = mcrypto._get_ciphergram([user_key], "x" * 100)
+            ciphergram = EncryptedMessage(ct, ck, s, 0, t)
+            results[name] = (
+                timeit.timeit(
+                    lambda: mcrypto._get_ciphergram([user_key], "x" * 100),
+                    number=count
+                ) / count,
+                timeit.timeit(
+                    lambda: mcrypto._get_plaintext(ciphergram), number=count
+                ) / count,
+                len(mcrypto.keys.pub_key_str),
+            )
+    return results
+
+
+if __name__ == "__main__":
+    for name, (encrypt, decrypt, id_size) in benchmark().items():
+        print(
+            f"{name}: encrypt {encrypt * 1000:.3f} ms, "
+            f"decrypt {decrypt * 1000:.3f} ms, node id {id_size} chars"
+        )
@@ -1,56 +1,193 @@
-import time
+import queue
+import logging
+import threading
 import webbrowser
+import collections
+import concurrent.futures
 
 import webevents
 
+from . import batching
+from . import monitoring
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class PushCoalescer:
+    """Collects pushed items on its own thread and passes them to fire
+    in lists, at most max_items at once and max_delay seconds late"""
+
+    def __init__(self, fire, max_items=64, max_delay=0.1):
+        self.fire = fire
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def push(self, item):
+        self._queue.put(item)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = batching.collect_batch(
+                self._queue, self.max_items, self.max_delay,
+                lambda item: item is not None
+            )
+            items = [item for item in batch if item is not None]
+            if items:
+                self.fire(items)
+            if len(items) < len(batch):
+                break
+
+
+class HandlerPool:
+    """Runs handlers on a bounded pool of threads
+
+    Handlers share lanes which limit how many of them run at once,
+    the ones over the limit wait in the order they were submitted.
+    """
+
+    def __init__(self, max_workers=4, limits=None):
+        self.max_workers = max_workers
+        self.limits = {} if limits is None else limits
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._running = collections.Counter()
+        self._pending = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def submit(self, lane, handler, *args):
+        with self._lock:
+            if self._running[lane] >= self.limits.get(lane, self.max_workers):
+                self._pending[lane].append((handler, args))
+                return
+            self._running[lane] += 1
+        self._executor.submit(self._run, lane, handler, args)
+
+    def _run(self, lane, handler, args):
+        # the thread keeps serving the lane until nothing is waiting in it
+        while True:
+            try:
+                handler(*args)
+            except Exception:
+                logger.exception(f"Handler {handler.__name__} failed")
+            with self._lock:
+                if not self._pending[lane]:
+                    self._running[lane] -= 1
+                    return
+                handler, args = self._pending[lane].popleft()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
 class WebeventsGUI:
-    def __init__(self, presentor_obj, gui_port):
+    """Events may carry {"request_id": ..., "data": ...} instead of bare
+    data, results are fired as {"request_id": ..., "result": ...}"""
+
+    # writes share one lane so they are applied in the order they came,
+    # reads run in parallel on their own connections
+    lane_limits = dict(
+        write=1, get_dialogs=1, get_changes_since=2, search_messages=2,
+        get_older_messages=2, get_metrics=1
+    )
+
+    def __init__(self, presentor_obj, gui_port, workers=4, metrics=None):
         self.presentor_obj = presentor_obj
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
+        self.pushed_messages = PushCoalescer(self._push_messages)
+        self.handlers = HandlerPool(workers, self.lane_limits)
         address = ("localhost", gui_port)
         self.events = webevents.run(address, "web")
-        self.events.add_event_listener(
-            "get_dialogs", self._get_dialogs
-        )
-        self.events.add_event_listener(
-            "send_message", self._send_message
-        )
-        self.events.add_event_listener(
-            "add_dialog", self._add_dialog
-        )
-        self.events.add_event_listener(
-            "delete_dialog", self._delete_dialog
-        )
-        self.events.add_event_listener(
-            "make_dialog_read", self._make_dialog_read
-        )
-        self.events.add_event_listener(
-            "get_my_id", self._get_my_id
-        )
-        self.events.add_event_listener(
-            "change_node_alias", self._change_node_alias
+        listeners = (
+            ("get_dialogs", self._get_dialogs, "get_dialogs"),
+            ("get_changes_since", self._get_changes_since,
+             "get_changes_since"),
+            ("search_messages", self._search_messages, "search_messages"),
+            ("get_older_messages", self._get_older_messages,
+             "get_older_messages"),
+            ("get_my_id", self._get_my_id, "get_my_id"),
+            ("get_metrics", self._get_metrics, "get_metrics"),
+            ("send_message", self._send_message, "write"),
+            ("send_group_message", self._send_group_message, "write"),
+            ("add_dialog", self._add_dialog, "write"),
+            ("delete_dialog", self._delete_dialog, "write"),
+            ("make_dialog_read", self._make_dialog_read, "write"),
+            ("change_node_alias", self._change_node_alias, "write"),
         )
+        for event, handler, lane in listeners:
+            self.events.add_event_listener(
+                event, self._make_listener(event, handler, lane)
+            )
         webbrowser.open_new_tab("http://{}:{}".format(*address))
 
     def push_message(self, message):
-        self.events.fire_event("push_message", message)
+        self.pushed_messages.push(message)
+
+    def _push_messages(self, messages):
+        with self.metrics.timer("gui_push"):
+            self.events.fire_event("push_messages", messages)
+
+    def push_message_status(self, message_id, state):
+        self.events.fire_event(
+            "message_status", dict(message_id=message_id, state=state)
+        )
 
     def terminate(self):
+        self.pushed_messages.close()
+        self.handlers.shutdown()
         self.events.terminate()
 
     def add_termination_callback(self, callback):
         self.events.add_termination_callback(callback)
 
+    def _make_listener(self, event, handler, lane):
+        def listener(data):
+            request_id = None
+            if isinstance(data, dict) and "request_id" in data:
+                request_id, data = data["request_id"], data.get("data")
+            self.handlers.submit(
+                lane, self._handle, event, handler, request_id, data
+            )
+        return listener
+
+    def _handle(self, event, handler, request_id, data):
+        result = handler(data)
+        if result is not None:
+            self.events.fire_event(
+                f"{event}_result", dict(request_id=request_id, result=result)
+            )
+
     def _get_dialogs(self, data):
-        self.events.fire_event(
-            "get_dialogs_result", self.presentor_obj.get_dialogs()
+        return self.presentor_obj.get_dialogs()
+
+    def _get_changes_since(self, version):
+        return self.presentor_obj.get_changes_since(int(version))
+
+    def _get_older_messages(self, data):
+        node_id, skip, *count = data
+        return dict(
+            node_id=node_id,
+            messages=self.presentor_obj.get_older_messages(
+                node_id, int(skip), *count
+            )
         )
 
     def _send_message(self, data):
-        uid, message = data
-        self.presentor_obj.send_message(uid, message)
+        uid, message, *message_id = data
+        self.presentor_obj.send_message(uid, message, *message_id)
+
+    def _send_group_message(self, data):
+        uids, message, *message_id = data
+        self.presentor_obj.send_group_message(uids, message, *message_id)
 
     def _add_dialog(self, data):
-        if len(data) == 1:
+        if isinstance(data, str):
             self.presentor_obj.add_dialog(data)
         else:
             self.presentor_obj.add_dialog(*data)
@@ -62,10 +199,28 @@ class WebeventsGUI:
         self.presentor_obj.make_dialog_read(uid)
 
     def _get_my_id(self, data):
-        self.events.fire_event(
-            "get_my_id_result", self.presentor_obj.get_my_id()
-        )
+        return self.presentor_obj.get_my_id()
+
+    def _get_metrics(self, data):
+        return self.metrics.snapshot()
 
     def _change_node_alias(self, data):
         node_id, alias = data
         self.presentor_obj.change_node_alias(node_id, alias)
+
+    def _search_messages(self, data):
+        # a bare query string or a [query, limit] list
+        if isinstance(data, str):
+            query, limit = data, 20
+        elif isinstance(data, list) and len(data) == 2:
+            query, limit = data
+        else:
+            raise ValueError(f"Invalid search request {data!r}")
+        if not isinstance(query, str):
+            raise ValueError(f"Invalid search query {query!r}")
+        return dict(
+            query=query,
+            messages=self.presentor_obj.search_messages(
+                query, limit=int(limit)
+            )
+        )
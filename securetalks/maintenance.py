@@ -0,0 +1,58 @@
+import time
+import sqlite3
+import logging
+import threading
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    """Background thread running periodic storage upkeep
+
+    Expired data is deleted in small batches with pauses in between,
+    so the receive path is never locked out of the database for long.
+    An interval equal to zero disables the task.
+    """
+
+    def __init__(self, storage, expiry_interval=600, vacuum_interval=3600,
+                 checkpoint_interval=300, analyze_interval=60*60*24,
+                 batch_size=500, pause=0.05):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.pause = pause
+        self.tasks = [
+            (self._delete_expired, expiry_interval),
+            (self.storage.incremental_vacuum, vacuum_interval),
+            (self.storage.checkpoint, checkpoint_interval),
+            (self.storage.analyze, analyze_interval),
+        ]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _delete_expired(self):
+        self.storage.delete_expired_data(self.batch_size, self.pause)
+
+    def run(self):
+        now = time.monotonic()
+        schedule = [
+            [now + interval, task, interval]
+            for task, interval in self.tasks if interval > 0
+        ]
+        while schedule:
+            schedule.sort(key=lambda entry: entry[0])
+            due, task, interval = schedule[0]
+            if self._stopped.wait(max(0, due - time.monotonic())):
+                break
+            try:
+                task()
+            except sqlite3.Error:
+                logger.exception(f"Maintenance task {task.__name__} failed")
+            schedule[0][0] = time.monotonic() + interval
@@ -0,0 +1,181 @@
+import json
+import time
+import bisect
+import logging
+import itertools
+import threading
+import contextlib
+import http.server
+import multiprocessing
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Counters and latency histograms kept in shared memory
+
+    The registry is made before the LowLevelSender and LowLevelReceiver
+    processes are started, so what they count adds up with the counts
+    of the main process. Gauges are functions called on every snapshot.
+    """
+
+    counter_names = (
+        "connections_accepted", "connections_rejected", "connections_failed",
+        "peer_connections", "peer_connections_failed",
+        "bytes_received", "bytes_sent",
+        "ciphergrams_received", "ciphergrams_stored", "ciphergrams_duplicate",
+        "messages_stored", "messages_duplicate",
+    )
+    histogram_names = (
+        "parse", "pow_check", "decrypt", "verify", "store", "gui_push",
+        "storage_commit",
+    )
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        # a histogram is a count per bucket, one more for the slower
+        # observations and the sum of all of them
+        self._width = len(self.buckets) + 2
+        self._counters = multiprocessing.Array("Q", len(self.counter_names))
+        self._histograms = multiprocessing.Array(
+            "d", len(self.histogram_names) * self._width
+        )
+        self._gauges = {}
+
+    def count(self, name, amount=1):
+        with self._counters.get_lock():
+            self._counters[self.counter_names.index(name)] += amount
+
+    def observe(self, name, seconds):
+        start = self.histogram_names.index(name) * self._width
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._histograms.get_lock():
+            self._histograms[start + bucket] += 1
+            self._histograms[start + self._width - 1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def add_gauge(self, name, function):
+        self._gauges[name] = function
+
+    def _read_gauges(self):
+        gauges = {}
+        for name, function in self._gauges.items():
+            try:
+                gauges[name] = function()
+            except NotImplementedError:
+                pass  # qsize of multiprocessing queues on macOS
+        return gauges
+
+    def snapshot(self):
+        with self._counters.get_lock():
+            counters = dict(zip(self.counter_names, self._counters))
+        with self._histograms.get_lock():
+            values = self._histograms[:]
+
+        histograms = {}
+        for index, name in enumerate(self.histogram_names):
+            *counts, total = values[
+                index * self._width:(index + 1) * self._width
+            ]
+            # buckets are cumulative, as in the Prometheus format
+            histograms[name] = dict(
+                buckets=dict(zip(
+                    [str(bound) for bound in self.buckets] + ["+Inf"],
+                    [int(count) for count in itertools.accumulate(counts)]
+                )),
+                count=int(sum(counts)),
+                sum=total
+            )
+
+        duplicates = (
+            counters["ciphergrams_duplicate"] + counters["messages_duplicate"]
+        )
+        stored = counters["ciphergrams_stored"] + counters["messages_stored"]
+        return dict(
+            counters=counters,
+            histograms=histograms,
+            gauges=self._read_gauges(),
+            duplicate_rate=(
+                duplicates / (duplicates + stored) if duplicates else 0
+            )
+        )
+
+    def render_text(self):
+        """Snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE securetalks_{name}_total counter")
+            lines.append(f"securetalks_{name}_total {value}")
+        for name, histogram in snapshot["histograms"].items():
+            metric = f"securetalks_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{metric}_sum {histogram['sum']}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        gauges = dict(
+            snapshot["gauges"], duplicate_rate=snapshot["duplicate_rate"]
+        )
+        for name, value in gauges.items():
+            lines.append(f"# TYPE securetalks_{name} gauge")
+            lines.append(f"securetalks_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == "/metrics":
+            content_type = "text/plain; version=0.0.4"
+            body = metrics.render_text()
+        elif self.path == "/metrics.json":
+            content_type = "application/json"
+            body = json.dumps(metrics.snapshot())
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsServer:
+    """Serves the metrics to localhost only, /metrics in the Prometheus
+    text format and /metrics.json as a snapshot"""
+
+    def __init__(self, metrics, port):
+        self.server = http.server.ThreadingHTTPServer(
+            ("localhost", port), MetricsRequestHandler
+        )
+        self.server.metrics = metrics
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
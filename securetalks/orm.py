@@ -1,4 +1,6 @@
 import time
+import struct
+import hashlib
 from dataclasses import dataclass, field
 
 class MessageAlreadyExistsError(ValueError):
@@ -19,7 +21,34 @@ class NodeAlreadyExistsError(ValueError):
 class NodeNotFoundError(ValueError):
     """An error occurring when node doesn't exists"""
 
-@dataclass(order=True)
+class KeyNotFoundError(ValueError):
+    """An error occurring when public key of a node is unknown"""
+
+def to_dict(record):
+    """Shallow and much cheaper replacement of dataclasses.asdict"""
+    return {name: getattr(record, name) for name in record.__slots__}
+
+def pack_cipherkeys(cipherkeys):
+    """Keys of a group ciphergram stored in one cipherkey blob"""
+    return b"".join(
+        struct.pack("!H", len(cipherkey)) + cipherkey
+        for cipherkey in cipherkeys
+    )
+
+def unpack_cipherkeys(blob):
+    cipherkeys = []
+    offset = 0
+    while offset < len(blob):
+        length, = struct.unpack_from("!H", blob, offset)
+        cipherkeys.append(blob[offset + 2:offset + 2 + length])
+        offset += 2 + length
+    return cipherkeys
+
+def fingerprint(key):
+    """Compact node id standing for a full public key"""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+@dataclass(order=True, slots=True)
 class Message:
     node_id: str
     text: str = field(compare=False)
@@ -29,7 +58,7 @@ class Message:
     )
     timestamp: int = field(default_factory=lambda: int(time.time()))
     
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class IPAddress:
     address: str
     port: int
@@ -40,12 +69,25 @@ class IPAddress:
     def update_activity(self):
         self.last_activity = int(time.time())
 
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class Ciphergram:
-    content: str = field(compare=False)
+    ciphertext: bytes = field(compare=False)
+    cipherkey: bytes = field(compare=False)
+    signature: bytes = field(compare=False)
+    proof: int = field(compare=False)
     timestamp: int
+    origin: str = field(default="", compare=False)
+    weight: float = field(default=0, compare=False)
+    multikey: bool = field(default=False, compare=False)
+
+    @property
+    def digest(self):
+        return hashlib.sha256(
+            self.ciphertext + self.cipherkey + self.signature +
+            f"{self.proof}:{self.timestamp}".encode("utf-8")
+        ).digest()
 
-@dataclass
+@dataclass(slots=True)
 class Node:
     node_id: str
     last_activity: int = field(default_factory=lambda: int(time.time()))
@@ -1,61 +1,278 @@
+import threading
+import collections
 import dataclasses
 
 from . import orm
+from . import monitoring
+
+
+def _read_messages(tx, node, tail_size=None):
+    if tail_size is None:
+        return tx.messages.get_messages(node)
+    return tx.messages.get_last_messages(node, tail_size)
+
+
+class DialogsCache:
+    """Dialogs with the last tail_size messages of each kept in memory,
+    older ones are read from the storage when they are asked for,
+    tail_size=None keeps whole dialogs
+
+    Every commit to the storage marks the cache stale, then the next
+    listing applies the change journal to it instead of reading
+    everything again. The listing is shared, callers must not modify it.
+    """
+
+    def __init__(self, storage, tail_size=200, metrics=None):
+        self.storage = storage
+        self.tail_size = tail_size
+        self.stats = collections.Counter(hits=0, updates=0, misses=0)
+        if metrics is not None:
+            for outcome in self.stats:
+                metrics.add_gauge(
+                    f"dialogs_cache_{outcome}",
+                    lambda outcome=outcome: self.stats[outcome]
+                )
+        self._lock = threading.Lock()
+        self._stale = True
+        self._version = 0
+        self._nodes = {}
+        self._tails = {}
+        self._dialogs = None
+        storage.add_commit_listener(self.mark_stale)
+
+    def mark_stale(self):
+        self._stale = True
+
+    def get_dialogs(self):
+        with self._lock:
+            if not self._stale:
+                self.stats["hits"] += 1
+                return self._dialogs
+
+            # commits from now on must make the cache stale again
+            self._stale = False
+            try:
+                self._update()
+            except Exception:
+                self._stale = True
+                self._dialogs = None
+                raise
+            return self._dialogs
+
+    def _update(self):
+        with self.storage.transaction(write=False) as tx:
+            version = self._version
+            self._version = tx.changes.get_version()
+            if (self._dialogs is not None and
+                    tx.changes.check_version_covered(version)):
+                self.stats["updates"] += 1
+                self._apply_changes(tx, version)
+            else:
+                self.stats["misses"] += 1
+                self._load(tx)
+        self._dialogs = self._render()
+
+    def _load_node(self, tx, node):
+        self._nodes[node.node_id] = orm.to_dict(node)
+        self._tails[node.node_id] = collections.deque(
+            (
+                orm.to_dict(message) for message in
+                _read_messages(tx, node, self.tail_size)
+            ),
+            maxlen=self.tail_size
+        )
+
+    def _load(self, tx):
+        self._nodes = {}
+        self._tails = {}
+        for node in tx.nodes.list_all():
+            self._load_node(tx, node)
+
+    def _apply_changes(self, tx, version):
+        loaded = set()
+        for node_id in tx.changes.list_changed_nodes(version):
+            try:
+                node = tx.nodes.get_node_by_id(node_id)
+            except orm.NodeNotFoundError:
+                self._nodes.pop(node_id, None)
+                self._tails.pop(node_id, None)
+                continue
+            if node_id in self._nodes:
+                self._nodes[node_id] = orm.to_dict(node)
+            else:
+                self._load_node(tx, node)
+                loaded.add(node_id)
+
+        for message in tx.changes.list_new_messages(version):
+            if message.node_id in self._tails and (
+                message.node_id not in loaded
+            ):
+                self._tails[message.node_id].append(
+                    orm.to_dict(message)
+                )
+
+    def _render(self):
+        nodes = sorted(
+            self._nodes.values(),
+            key=lambda node: node["last_activity"], reverse=True
+        )
+        return [
+            dict(
+                **node,
+                messages=[
+                    {**node, **message}
+                    for message in self._tails[node["node_id"]]
+                ]
+            ) for node in nodes
+        ]
 
 
 class Presentor:
-    def __init__(self, sender, keys, storage):
+    def __init__(self, sender, keys, storage, tail_size=200, metrics=None):
         self.sender = sender
         self.keys = keys
         self.storage = storage
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
+        self.dialogs = DialogsCache(storage, tail_size, self.metrics)
 
     def get_dialogs(self):
+        return self.dialogs.get_dialogs()
+
+    def get_older_messages(self, node_id, skip, count=None):
+        """Messages of a dialog before the last skip ones,
+        a page of tail_size of them unless count is given"""
+        if count is None:
+            count = self.dialogs.tail_size or 200
+        with self.storage.transaction(write=False) as tx:
+            try:
+                node = tx.nodes.get_node_by_id(node_id)
+            except orm.NodeNotFoundError:
+                return []
+            return [
+                {**orm.to_dict(node), **orm.to_dict(message)}
+                for message in tx.messages.get_last_messages(
+                    node, count, skip
+                )
+            ]
+
+    def _get_dialogs(self, tx):
         return [
             dict(
-                **dataclasses.asdict(node),
+                **orm.to_dict(node),
                 messages= [
                     {
-                        **dataclasses.asdict(node),
-                        **dataclasses.asdict(message)
+                        **orm.to_dict(node),
+                        **orm.to_dict(message)
                     }
-                    for message in self.storage.messages.get_messages(node)
+                    for message in _read_messages(
+                        tx, node, self.dialogs.tail_size
+                    )
                 ]
-            ) for node in self.storage.nodes.list_all()
+            ) for node in tx.nodes.list_all()
         ]
 
-    def send_message(self, node_id, msg_text):
+    def get_changes_since(self, version):
+        """Dialogs changed and messages added after the version,
+        all dialogs when the journal doesn't reach back that far"""
+        with self.storage.transaction(write=False) as tx:
+            changes = dict(version=tx.changes.get_version())
+            if not tx.changes.check_version_covered(version):
+                changes.update(reset=True, dialogs=self._get_dialogs(tx))
+                return changes
+
+            nodes = {}
+            deleted = []
+            for node_id in tx.changes.list_changed_nodes(version):
+                try:
+                    nodes[node_id] = tx.nodes.get_node_by_id(node_id)
+                except orm.NodeNotFoundError:
+                    deleted.append(node_id)
+            changes.update(
+                reset=False,
+                dialogs=[
+                    orm.to_dict(node) for node in nodes.values()
+                ],
+                deleted=deleted,
+                messages=[
+                    {
+                        **orm.to_dict(nodes[message.node_id]),
+                        **orm.to_dict(message)
+                    }
+                    for message in tx.changes.list_new_messages(version)
+                    if message.node_id in nodes
+                ]
+            )
+            return changes
+
+    def search_messages(self, query, node_id=None, limit=20, offset=0):
+        with self.storage.transaction(write=False) as tx:
+            node = None if node_id is None else orm.Node(node_id)
+            found = tx.messages.search_messages(query, node, limit, offset)
+            nodes = {
+                node_id: tx.nodes.get_node_by_id(node_id)
+                for node_id in {message.node_id for message in found}
+            }
+            return [
+                {
+                    **orm.to_dict(nodes[message.node_id]),
+                    **orm.to_dict(message)
+                }
+                for message in found
+            ]
+
+    def send_message(self, node_id, msg_text, message_id=None):
         try:
-            node = self.storage.nodes.get_node_by_id(node_id)
-        except orm.NodeNotFoundError:
+            with self.storage.transaction() as tx:
+                node = tx.nodes.get_node_by_id(node_id)
+                key = tx.keys.get_key(node.node_id)
+                message = orm.Message(
+                    node.node_id, msg_text, to_me=False
+                )
+                tx.messages.add_message(message)
+        except (orm.NodeNotFoundError, orm.KeyNotFoundError):
             pass
         else:
-            message = orm.Message(
-                node.node_id, msg_text, to_me=False
-            )
-            self.storage.messages.add_message(message)
-            self.sender.send_message_to(node_id, msg_text)
+            self.sender.send_message_to(key, msg_text, message_id)
 
-    def add_dialog(self, node_id, alias=""):
+    def send_group_message(self, node_ids, msg_text, message_id=None):
+        """Sends one ciphergram readable by all of the nodes,
+        the message is shown in the dialog of each of them"""
+        keys = []
+        with self.storage.transaction() as tx:
+            for node_id in dict.fromkeys(node_ids):
+                try:
+                    node = tx.nodes.get_node_by_id(node_id)
+                    keys.append(tx.keys.get_key(node.node_id))
+                except (orm.NodeNotFoundError, orm.KeyNotFoundError):
+                    continue
+                tx.messages.add_message(
+                    orm.Message(node.node_id, msg_text, to_me=False)
+                )
+        if keys:
+            self.sender.send_group_message_to(keys, msg_text, message_id)
+
+    def add_dialog(self, key, alias=""):
         try:
-            self.storage.nodes.add_node(
-                orm.Node(node_id, alias=alias)
-            )
+            with self.storage.transaction() as tx:
+                node_id = tx.keys.add_key(key)
+                tx.nodes.add_node(orm.Node(node_id, alias=alias))
         except orm.NodeAlreadyExistsError:
             pass
 
     def delete_dialog(self, node_id):
         node = orm.Node(node_id)
         try:
-            self.storage.nodes.delete_node(node)
-            self.storage.messages.delete_messages(node)
+            with self.storage.transaction() as tx:
+                tx.nodes.delete_node(node)
+                tx.messages.delete_messages(node)
+                tx.keys.delete_key(node_id)
         except orm.NodeNotFoundError:
             pass
 
     def make_dialog_read(self, node_id):
         try:
-            self.storage.nodes.set_node_unread_to_zero(
-                orm.Node(node_id)
-            )
+            with self.storage.transaction() as tx:
+                tx.nodes.set_node_unread_to_zero(orm.Node(node_id))
         except orm.NodeNotFoundError:
             pass
 
@@ -64,10 +281,10 @@ class Presentor:
 
     def change_node_alias(self, node_id, alias):
         try:
-            node = self.storage.nodes.get_node_by_id(node_id)
+            with self.storage.transaction() as tx:
+                node = tx.nodes.get_node_by_id(node_id)
+                node_new_alias = dataclasses.replace(node, alias=alias)
+                tx.nodes.delete_node(node)
+                tx.nodes.add_node(node_new_alias)
         except orm.NodeNotFoundError:
             pass
-        else:
-            node_new_alias = dataclasses.replace(node, alias=alias)
-            self.storage.nodes.delete_node(node)
-            self.storage.nodes.add_node(node_new_alias)
@@ -1,9 +1,13 @@
+import os
+import time
 import struct
 import hashlib
+import threading
+import multiprocessing
 
-def compute_pow(bmessage):
+def compute_pow(bmessage, difficulty=1):
     nonce = 0
-    target = compute_target(bmessage)
+    target = compute_target(bmessage) / difficulty
     trial = target + 1
     while trial > target:
         nonce += 1
@@ -15,18 +19,76 @@ def compute_pow(bmessage):
     return nonce
 
 def check_pow_valid(bmessage, nonce):
-    target = compute_target(bmessage)
+    return compute_trial(bmessage, nonce) <= compute_target(bmessage)
+
+def verify_many(batch, pool=None):
+    """Validity mask of (bmessage, nonce) pairs, checked by the
+    process pool when it's given"""
+    if pool is None:
+        return [check_pow_valid(bmessage, nonce) for bmessage, nonce in batch]
+
+    chunksize = -(-len(batch) // (4 * (os.cpu_count() or 1)))
+    return pool.starmap(check_pow_valid, batch, max(chunksize, 1))
+
+def compute_trial(bmessage, nonce):
     bnonce = struct.pack("!Q", nonce)
     hash1 = hashlib.sha512(bnonce + bmessage).digest()
     hash2 = hashlib.sha512(hash1).digest()
-    trial = struct.unpack("!Q", hash2[:8])[0]
+    return struct.unpack("!Q", hash2[:8])[0]
 
-    return trial <= target
+def compute_strength(bmessage, nonce):
+    # how many times the work exceeds the minimum for this message size
+    return compute_target(bmessage) / max(compute_trial(bmessage, nonce), 1)
 
 def compute_target(bmessage):
     return (1 << 56) / (1 + len(bmessage))
 
 
+class PowPolicy:
+    """Difficulty a node requires from the ciphergrams it relays
+
+    Difficulty is a multiple of the work compute_target asks for a message
+    of that size, every ciphergram lives as long on relays, so their
+    lifetime doesn't change it. The difficulty is doubled while ciphergrams
+    come faster than normal_rate per second and falls back when the load
+    goes down, it's shared with the listening process.
+    """
+
+    def __init__(self, normal_rate=20, max_difficulty=64, window=10):
+        self.normal_rate = normal_rate
+        self.max_difficulty = max_difficulty
+        self.window = window
+        self._difficulty = multiprocessing.RawValue("d", 1)
+        self._received = 0
+        self._window_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def difficulty(self):
+        return self._difficulty.value
+
+    def record_message(self):
+        with self._lock:
+            self._received += 1
+            elapsed = time.monotonic() - self._window_start
+            if elapsed >= self.window:
+                self._difficulty.value = self._get_difficulty(
+                    self._received / elapsed
+                )
+                self._received = 0
+                self._window_start += elapsed
+
+    def _get_difficulty(self, rate):
+        difficulty = 1
+        while (rate > self.normal_rate * difficulty and
+               difficulty < self.max_difficulty):
+            difficulty *= 2
+        return difficulty
+
+    def check(self, bmessage, nonce):
+        return compute_strength(bmessage, nonce) >= self.difficulty
+
+
 if __name__ == "__main__":
     message = b"hello, folks!"
     proof = compute_pow(message)
@@ -0,0 +1,117 @@
+import time
+import threading
+import multiprocessing
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def check(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        # a request larger than the burst passes when the bucket is full
+        # and leaves it in debt, so big frames are slowed down, not banned
+        return self.tokens >= min(amount, self.burst)
+
+    def consume(self, amount=1):
+        if not self.check(amount):
+            return False
+        self.tokens -= amount
+        return True
+
+
+class PeerLimits:
+    def __init__(self, connections_rate, messages_rate, bytes_rate):
+        self.connections = TokenBucket(connections_rate, connections_rate * 4)
+        self.messages = TokenBucket(messages_rate, messages_rate * 4)
+        self.bytes = TokenBucket(bytes_rate, bytes_rate * 4)
+        self.last_seen = time.monotonic()
+
+
+class AdmissionControl:
+    """Per source ip rate limits and a global cap of connections,
+    checked before received frames are passed to the Receiver"""
+
+    counter_names = (
+        "accepted", "rejected_connections", "rejected_concurrency",
+        "rejected_messages", "rejected_bytes",
+    )
+
+    def __init__(self, connections_rate=10, messages_rate=50,
+                 bytes_rate=1 << 20, max_connections=64,
+                 max_peers=4096, peer_idle_timeout=60):
+        self.connections_rate = connections_rate
+        self.messages_rate = messages_rate
+        self.bytes_rate = bytes_rate
+        self.max_peers = max_peers
+        self.peer_idle_timeout = peer_idle_timeout
+        self._peers = {}
+        self._lock = threading.Lock()
+        self._connections = threading.BoundedSemaphore(max_connections)
+        self._counters = multiprocessing.Array("Q", len(self.counter_names))
+
+    @property
+    def counters(self):
+        return dict(zip(self.counter_names, self._counters))
+
+    def _count(self, name):
+        with self._counters.get_lock():
+            self._counters[self.counter_names.index(name)] += 1
+
+    def _get_peer(self, ip):
+        try:
+            peer = self._peers[ip]
+        except KeyError:
+            if len(self._peers) >= self.max_peers:
+                self._forget_idle_peers()
+            peer = self._peers[ip] = PeerLimits(
+                self.connections_rate, self.messages_rate, self.bytes_rate
+            )
+        peer.last_seen = time.monotonic()
+        return peer
+
+    def _forget_idle_peers(self):
+        now = time.monotonic()
+        self._peers = {
+            ip: peer for ip, peer in self._peers.items()
+            if now - peer.last_seen < self.peer_idle_timeout
+        }
+
+    def admit_connection(self, ip):
+        with self._lock:
+            allowed = self._get_peer(ip).connections.consume()
+        if not allowed:
+            self._count("rejected_connections")
+            return False
+        if not self._connections.acquire(blocking=False):
+            self._count("rejected_concurrency")
+            return False
+
+        self._count("accepted")
+        return True
+
+    def release_connection(self):
+        self._connections.release()
+
+    def admit_frame(self, ip, size):
+        with self._lock:
+            peer = self._get_peer(ip)
+            # a frame rejected by one of the buckets costs nothing
+            if not peer.messages.check():
+                rejected = "rejected_messages"
+            elif not peer.bytes.check(size):
+                rejected = "rejected_bytes"
+            else:
+                peer.messages.consume()
+                peer.bytes.consume(size)
+                return True
+
+        self._count(rejected)
+        return False
@@ -1,13 +1,15 @@
-import ssl
 import time
 import json
+import struct
 import logging
-import dataclasses
 import threading
 import multiprocessing
 
 from . import orm
 from . import crypto
+from . import ratelimit
+from . import monitoring
+from . import proof_of_work
 from . import snakesockets
 
 logging.basicConfig(level=logging.DEBUG)
@@ -19,16 +21,42 @@ class MessageParsingError(ValueError):
 
 
 class Receiver:
+    max_group_size = 64
+    parallel_pow_batch = 256
+
     def __init__(self, gui, sender, storage,
-                 mcrypto, certs, queue, listening_address):
+                 mcrypto, certs, queue, listening_address, admission=None,
+                 pow_workers=None, pow_policy=None, metrics=None):
         self.gui = gui
         self.sender = sender
         self.storage = storage
         self.mcrypto = mcrypto
         self.queue = queue
         self.ttl = 60*60*24*2  # two days
+        self.pow_workers = pow_workers
+        self._pow_pool = None
+        self.pow_policy = (
+            proof_of_work.PowPolicy() if pow_policy is None else pow_policy
+        )
+        self.admission = (
+            ratelimit.AdmissionControl() if admission is None else admission
+        )
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
+        self.metrics.add_gauge("receiver_queue", self.queue.qsize)
+        self.metrics.add_gauge(
+            "pow_difficulty", lambda: self.pow_policy.difficulty
+        )
+        # the counters are shared with the listening process
+        for name in self.admission.counter_names:
+            self.metrics.add_gauge(
+                f"admission_{name}",
+                lambda name=name: self.admission.counters[name]
+            )
         
-        self.llreceiver = LowLevelReceiver(certs, queue, listening_address)
+        self.llreceiver = LowLevelReceiver(
+            certs, queue, listening_address, self.admission, self.pow_policy,
+            self.metrics, check_frame=self._check_pow
+        )
         self.llreceiver_proc = multiprocessing.Process(
             target=self.llreceiver.run
         )
@@ -40,14 +68,30 @@ class Receiver:
             if address is None and message_bytes is None:
                 break
             try:
-                message_json = message_bytes.decode("utf-8")
+                message_json = str(message_bytes, "utf-8")
                 message = json.loads(message_json)
                 address.port = int(message["server_port"])
                 message["type"]
             except Exception:
                 pass  # message parsing error
             else:
-                self._receive(address, message)
+                try:
+                    self._receive(address, message)
+                except Exception:
+                    # one bad message must not stop the receiving loop
+                    logger.exception(
+                        f"Failed to handle message from {address}"
+                    )
+
+        if self._pow_pool is not None:
+            self._pow_pool.terminate()
+            self._pow_pool.join()
+
+    def _get_pow_pool(self):
+        # made on the first offline response, most runs need just one
+        if self._pow_pool is None:
+            self._pow_pool = multiprocessing.Pool(self.pow_workers)
+        return self._pow_pool
 
     def terminate(self):
         self.llreceiver_proc.terminate()
@@ -69,13 +113,20 @@ class Receiver:
         
 
     def _handle_request_offline_message(self, address, message):
-        if not self.storage.ipaddresses.check_address_exists(address):
-            self.storage.ipaddresses.add_address(address)
+        with self.storage.transaction() as tx:
+            if not tx.ipaddresses.check_address_exists(address):
+                tx.ipaddresses.add_address(address)
 
         logger.info(
             f"Got request for offline data from {address} with {message}"
         )
-        self.sender.respond_offline_data(address)
+        since = message.get("since")
+        if not isinstance(since, int) or isinstance(since, bool):
+            since = None
+        # older nodes read only plain frames and don't ask for chunks
+        self.sender.respond_offline_data(
+            address, since, message.get("chunked") is True
+        )
 
     def _handle_response_offline_message(self, address, message):
         logger.info("Handling response to offline data request")
@@ -85,25 +136,86 @@ class Receiver:
         except (ValueError, KeyError):
             logger.info("Error in handling offline response message")
             return  # flooding
-        else:
-            for cph in message["ciphergrams"]:
-                self._handle_ciphergram_message(
-                    address, json.loads(cph["content"]), offline=True
+
+        ciphergrams = []
+        for cph in message["ciphergrams"]:
+            try:
+                with self.metrics.timer("parse"):
+                    flat_ciphergram = json.dumps(json.loads(cph["content"]))
+                    ciphergram = self._parse_ciphergram(flat_ciphergram)
+            except (MessageParsingError, ValueError, KeyError, TypeError):
+                logger.info("Got offline ciphergram, parsing error")
+                continue
+            self.metrics.count("ciphergrams_received")
+            if self._check_fresh(ciphergram):
+                ciphergrams.append((flat_ciphergram, ciphergram))
+
+        # proofs of the whole batch are checked at once before decryption,
+        # a check is only two hashes, so small batches aren't worth the pool;
+        # the load-aware difficulty isn't required here, the batch answers
+        # our own request and its ciphergrams were made for the difficulty
+        # of their time, so they are checked at the base one
+        with self.metrics.timer("pow_check"):
+            valid = self.mcrypto.verify_pow_many(
+                [ciphergram for _, ciphergram in ciphergrams],
+                self._get_pow_pool()
+                if len(ciphergrams) >= self.parallel_pow_batch else None
+            )
+        for (flat_ciphergram, ciphergram), pow_valid in zip(ciphergrams, valid):
+            if pow_valid:
+                self._handle_ciphergram(
+                    address, flat_ciphergram, ciphergram,
+                    offline=True, pow_checked=True
                 )
+            else:
+                logger.info("Got offline ciphergram, invalid proof of work")
 
     def _handle_ciphergram_message(self, address, message, offline=False):
         try:
-            message = json.dumps(message)
-            ciphergram = self._parse_ciphergram(message)
+            with self.metrics.timer("parse"):
+                message = json.dumps(message)
+                ciphergram = self._parse_ciphergram(message)
         except MessageParsingError:
             logger.info("Got ciphergram message, parsing error")
             return
-        
+
+        self.metrics.count("ciphergrams_received")
+        if not self._check_fresh(ciphergram):
+            return
+        self._handle_ciphergram(address, message, ciphergram, offline)
+
+    def _check_pow(self, frame):
+        """Run by the listening process, ciphergrams weaker than the
+        difficulty of the moment are refused before they are queued,
+        so their senders learn it and can redo the proof of work"""
+        difficulty = self.pow_policy.difficulty
+        if difficulty <= 1:
+            return True  # the base proof is checked before decryption
+        # offline responses are big and hold ciphergrams only as escaped
+        # strings, so just frames which may be ciphergrams are parsed,
+        # an escape could spell the type without its quoted name
+        if b'"ciphergram"' not in frame and b"\\u" not in frame:
+            return True
+        try:
+            ciphergram = self._parse_ciphergram(frame)
+            with self.metrics.timer("pow_check"):
+                return self.mcrypto.get_pow_strength(ciphergram) >= difficulty
+        except (MessageParsingError, TypeError, ValueError, struct.error):
+            return True  # not a ciphergram, the Receiver sorts it out
+
+    def _check_fresh(self, ciphergram):
+        if abs(ciphergram.timestamp - time.time()) > self.ttl:
+            logger.info("Got ciphergram message, message is too old")
+            return False  # message is too old
+        return True
+
+    def _handle_ciphergram(self, address, message, ciphergram,
+                           offline=False, pow_checked=False):
         try:
-            node_id, msg_text = self.mcrypto.get_plaintext(ciphergram)
+            key, msg_text = self.mcrypto.get_plaintext(ciphergram, pow_checked)
         except crypto.MessageDecryptionError:
             logger.info("Got ciphergram message, decryption error")
-            self._store_as_ciphergram(message, ciphergram.timestamp)
+            self._store_as_ciphergram(ciphergram, address)
             if not offline:
                 logger.info(f"Broadcast except {address}")
                 self.sender.broadcast_from(message, address)
@@ -111,12 +223,8 @@ class Receiver:
             logger.info("Got ciphergram message, crypto error")
             return
         else:
-            if abs(ciphergram.timestamp - time.time()) > self.ttl:
-                logger.info("Got ciphergram message, message is too old")
-                return  # message is too old
-
             logger.info("Got ciphergram message, stored as message")
-            self._store_as_message(node_id, msg_text, ciphergram.timestamp)
+            self._store_as_message(key, msg_text, ciphergram.timestamp)
             if not offline:
                 self.sender.broadcast_from(message, address)
 
@@ -125,61 +233,144 @@ class Receiver:
             crypto_message = json.loads(flat_ciphergram)
             del crypto_message["type"]
             del crypto_message["server_port"]
-            crypto_message = crypto.EncryptedMessage(**crypto_message)
+            # the fields are used before the ciphergram is authenticated
+            for field in ("proof", "timestamp"):
+                value = crypto_message[field]
+                if (not isinstance(value, int) or isinstance(value, bool)
+                        or not 0 <= value < 1 << 64):
+                    raise MessageParsingError(f"Invalid {field}")
+            for field in ("ciphertext", "cipherkey", "signature"):
+                if not isinstance(crypto_message.get(field, ""), str):
+                    raise MessageParsingError(f"Invalid {field}")
+            if "cipherkeys" in crypto_message:
+                cipherkeys = crypto_message["cipherkeys"]
+                # copies of the key are hinted, so only the matching ones
+                # are decrypted, but every copy is still stored and relayed
+                if not 0 < len(cipherkeys) <= self.max_group_size or not all(
+                    isinstance(cipherkey, str) and len(cipherkey) < 0x1FFFF
+                    for cipherkey in cipherkeys
+                ):
+                    raise MessageParsingError("Invalid cipherkeys")
+                crypto_message["cipherkeys"] = tuple(cipherkeys)
+                crypto_message = crypto.GroupEncryptedMessage(
+                    **crypto_message
+                )
+            else:
+                crypto_message = crypto.EncryptedMessage(**crypto_message)
         except Exception as exc:
             raise MessageParsingError from exc
         return crypto_message
 
-    def _store_as_ciphergram(self, message, timestamp):
-        ciphergram = orm.Ciphergram(message, timestamp)
-        try:
-            self.storage.ciphergrams.add_ciphergram(ciphergram)
-        except orm.CiphergramAlreadyExistsError:
-            pass
+    def _store_as_ciphergram(self, ciphergram, address):
+        # hex fields are already validated by the decryption attempt
+        multikey = isinstance(ciphergram, crypto.GroupEncryptedMessage)
+        if multikey:
+            cipherkey = orm.pack_cipherkeys(
+                bytes.fromhex(cipherkey)
+                for cipherkey in ciphergram.cipherkeys
+            )
+        else:
+            cipherkey = bytes.fromhex(ciphergram.cipherkey)
+        self.storage.batcher.add_ciphergram(
+            orm.Ciphergram(
+                bytes.fromhex(ciphergram.ciphertext), cipherkey,
+                bytes.fromhex(ciphergram.signature),
+                ciphergram.proof, ciphergram.timestamp,
+                origin=address.address,
+                weight=self.mcrypto.get_pow_strength(ciphergram),
+                multikey=multikey
+            )
+        )
 
-    def _store_as_message(self, node_id, msg_text, timestamp):
-        node = orm.Node(node_id)
+    def _store_as_message(self, key, msg_text, timestamp):
         message = orm.Message(
-            node_id, msg_text,
+            orm.fingerprint(key), msg_text,
             to_me=True, sender_timestamp=timestamp
         )
-        if not self.storage.nodes.check_node_exists(node):
-            self.storage.nodes.add_node(node)
-        else:
-            node = self.storage.nodes.get_node_by_id(node_id)
-        if not self.storage.messages.check_message_exists(message):
-            self.storage.messages.add_message(message)
-            self.storage.nodes.increment_node_unread(node)
+        # the message is pushed to the gui only after it's committed
+        self.storage.batcher.add_received_message(
+            message, key, callback=self._push_message
+        )
 
-            self.gui.push_message(
-                {**dataclasses.asdict(node), **dataclasses.asdict(message)}
-            )
+    def _push_message(self, stored):
+        node, message = stored
+        self.gui.push_message(
+            {**orm.to_dict(node), **orm.to_dict(message)}
+        )
 
 
 class LowLevelReceiver:
-    def __init__(self, certs, queue, listening_address):
+    def __init__(self, certs, queue, listening_address, admission,
+                 pow_policy, metrics, check_frame=None, recv_timeout=30):
         self.certs = certs
         self.queue = queue
         self.listening_address = listening_address
+        self.admission = admission
+        self.pow_policy = pow_policy
+        self.metrics = metrics
+        self.check_frame = check_frame
+        self.recv_timeout = recv_timeout
+
+    def _send_reply(self, client_socket, accepted):
+        # senders learn the difficulty this node currently requires
+        reply = dict(
+            pow_difficulty=self.pow_policy.difficulty, accepted=accepted
+        )
+        try:
+            client_socket.send(json.dumps(reply).encode("utf-8"))
+        except OSError:
+            pass  # older senders don't wait for the reply
 
     def _worker(self, client_socket, client_addr):
-        message = client_socket.recv()
-        logger.info(f"Received message {message}")
-        self.queue.put((orm.IPAddress(*client_addr), message))
-        client_socket.close()
+        try:
+            # the handshake is done here, so a peer which never sends
+            # a ClientHello holds up only its own thread
+            client_socket.sock.settimeout(self.recv_timeout)
+            client_socket.sock.do_handshake()
+            message = client_socket.recv()
+        except (OSError, struct.error):
+            logger.info(f"Failed to receive message from {client_addr}")
+            self.metrics.count("connections_failed")
+        else:
+            logger.info(f"Received message {message}")
+            self.metrics.count("bytes_received", len(message))
+            if self.admission.admit_frame(client_addr[0], len(message)):
+                self.pow_policy.record_message()
+                accepted = self.check_frame is None or self.check_frame(
+                    message
+                )
+                if accepted:
+                    self.queue.put((orm.IPAddress(*client_addr), message))
+                else:
+                    logger.info(f"Proof of work of {client_addr} is too weak")
+                self._send_reply(client_socket, accepted)
+            else:
+                logger.info(f"Rate limit exceeded by {client_addr}")
+        finally:
+            client_socket.close()
+            self.admission.release_connection()
 
     def run(self):
-        context = ssl.SSLContext()
-        context.load_cert_chain(self.certs.cert_file, self.certs.key_file)
+        context = self.certs.make_server_context()
         server_socket = snakesockets.TCP(reuseaddr=True)
         server_socket.sock = context.wrap_socket(
-            server_socket.sock, server_side=True
+            server_socket.sock, server_side=True,
+            do_handshake_on_connect=False
         )
         server_socket.bind(self.listening_address)
         server_socket.listen()
 
         while True:
-            client_socket, client_addr = server_socket.accept()
+            try:
+                client_socket, client_addr = server_socket.accept()
+            except OSError:
+                self.metrics.count("connections_failed")
+                continue
+            if not self.admission.admit_connection(client_addr[0]):
+                self.metrics.count("connections_rejected")
+                client_socket.close()
+                continue
+            self.metrics.count("connections_accepted")
             client_thread = threading.Thread(
                 target=self._worker, args=(client_socket, client_addr)
             )
@@ -0,0 +1,111 @@
+import socket
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+
+from . import orm
+
+
+class RingBuffer:
+    """Shared memory replacement of multiprocessing.Queue for frames
+
+    Frames are written next to a compact (address length, address, port,
+    frame length) header, the consumer gets them as memoryviews which stay
+    valid until the next call of get. Frames larger than a half of the
+    buffer and the stop message go through an ordinary pipe.
+    """
+
+    header = struct.Struct("!B16sHI")
+    wrap_marker = 0xFF
+
+    def __init__(self, size):
+        self._size = size
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._written = multiprocessing.RawValue("Q", 0)
+        self._read = multiprocessing.RawValue("Q", 0)
+        self._space = multiprocessing.Condition()
+        self._items = multiprocessing.Semaphore(0)
+        self._overflow = multiprocessing.SimpleQueue()
+        self._view = None
+        self._pending = 0
+
+    def put(self, item):
+        address, frame = item
+        if address is None or (
+            self.header.size + len(frame) > self._size // 2
+        ):
+            self._overflow.put(item)
+            self._items.release()
+            return
+
+        family = socket.AF_INET6 if ":" in address.address else socket.AF_INET
+        packed = socket.inet_pton(family, address.address)
+        record_size = self.header.size + len(frame)
+        with self._space:
+            offset, skipped = self._wait_for_space(record_size)
+            buf = self._shm.buf
+            if skipped >= self.header.size:
+                buf[offset] = self.wrap_marker
+            if skipped:
+                offset = 0
+            self.header.pack_into(
+                buf, offset, len(packed), packed, address.port, len(frame)
+            )
+            start = offset + self.header.size
+            buf[start:start + len(frame)] = frame
+            self._written.value += skipped + record_size
+        self._items.release()
+
+    def _wait_for_space(self, record_size):
+        while True:
+            offset = self._written.value % self._size
+            tail = self._size - offset
+            skipped = tail if tail < record_size else 0
+            used = self._written.value - self._read.value
+            if self._size - used >= skipped + record_size:
+                return offset, skipped
+            self._space.wait()
+
+    def qsize(self):
+        return self._items.get_value()
+
+    def get(self):
+        self._release_previous()
+        self._items.acquire()
+        read = self._read.value
+        if read == self._written.value:
+            return self._overflow.get()
+
+        buf = self._shm.buf
+        offset = read % self._size
+        if (self._size - offset < self.header.size or
+                buf[offset] == self.wrap_marker):
+            self._pending = self._size - offset
+            offset = 0
+        packed_len, packed, port, length = self.header.unpack_from(
+            buf, offset
+        )
+        start = offset + self.header.size
+        self._pending += self.header.size + length
+        self._view = buf[start:start + length]
+
+        family = socket.AF_INET if packed_len == 4 else socket.AF_INET6
+        address = orm.IPAddress(
+            socket.inet_ntop(family, packed[:packed_len]), port
+        )
+        return address, self._view
+
+    def _release_previous(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._pending:
+            with self._space:
+                self._read.value += self._pending
+                self._space.notify_all()
+            self._pending = 0
+
+    def close(self):
+        self._release_previous()
+        self._shm.close()
+        self._shm.unlink()
@@ -1,67 +1,204 @@
-import ssl
 import json
+import math
+import time
+import struct
 import logging
+import functools
+import threading
+import concurrent.futures
 import dataclasses
 import multiprocessing
 
-from . import crypto
+from . import orm
+from . import streaming
+from . import monitoring
 from . import snakesockets
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+INTERACTIVE, RELAY, BULK = range(3)
+PRIORITY_NAMES = ("interactive", "relay", "bulk")
+
+
+@dataclasses.dataclass(frozen=True)
+class OfflineData:
+    """Placeholder of a response to an offline data request,
+    the response is read from the storage while it's being sent,
+    in chunks to the peers which asked for them"""
+    since: int = None
+    chunked: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class OwnCiphergram:
+    """Ciphergram made by this node with a proof of work of the
+    difficulty, the proof is redone for peers requiring more"""
+    ciphergram: object
+    difficulty: float = 1
+
+
+def get_wire_ciphergram(ciphergram, port):
+    if ciphergram.multikey:
+        cipherkeys = dict(cipherkeys=[
+            cipherkey.hex()
+            for cipherkey in orm.unpack_cipherkeys(ciphergram.cipherkey)
+        ])
+    else:
+        cipherkeys = dict(cipherkey=ciphergram.cipherkey.hex())
+    return json.dumps(
+        dict(
+            type="ciphergram",
+            server_port=port,
+            ciphertext=ciphergram.ciphertext.hex(),
+            **cipherkeys,
+            signature=ciphergram.signature.hex(),
+            proof=ciphergram.proof,
+            timestamp=ciphergram.timestamp
+        )
+    )
+
+
+class PriorityQueue:
+    """Process-safe queue which serves user's own messages first,
+    then relays and then bulk offline synchronization"""
+
+    def __init__(self, maxsizes=(0, 1000, 16),
+                 droppable=(False, True, True)):
+        self._queues = [multiprocessing.SimpleQueue() for _ in maxsizes]
+        self._slots = [
+            multiprocessing.BoundedSemaphore(maxsize) if maxsize else None
+            for maxsize in maxsizes
+        ]
+        self._droppable = droppable
+        self._dropped = multiprocessing.Array("l", len(maxsizes))
+        self._sizes = multiprocessing.Array("l", len(maxsizes))
+        self._items = multiprocessing.Semaphore(0)
+        self._get_lock = multiprocessing.Lock()
+
+    @property
+    def dropped(self):
+        return list(self._dropped)
+
+    @property
+    def sizes(self):
+        return list(self._sizes)
+
+    def put(self, item, priority=INTERACTIVE):
+        slots = self._slots[priority]
+        if slots is not None and not slots.acquire(
+            block=not self._droppable[priority]
+        ):
+            with self._dropped.get_lock():
+                self._dropped[priority] += 1
+            logger.info(f"Send queue {priority} is full, message dropped")
+            return False
+
+        self._queues[priority].put(item)
+        with self._sizes.get_lock():
+            self._sizes[priority] += 1
+        self._items.release()
+        return True
+
+    def get(self):
+        self._items.acquire()
+        with self._get_lock:
+            for priority, queue in enumerate(self._queues):
+                if not queue.empty():
+                    item = queue.get()
+                    if self._slots[priority] is not None:
+                        self._slots[priority].release()
+                    with self._sizes.get_lock():
+                        self._sizes[priority] -= 1
+                    return item
+
+
 class Sender:
-    def __init__(self, mcrypto, certs, storage, my_port, queue):
+    def __init__(self, mcrypto, certs, storage, my_port, queue,
+                 max_difficulty=64, metrics=None):
         self.queue = queue
         self.storage = storage
         self.my_port = my_port
         self.offline_requested = None
-        self.llsender = LowLevelSender(self.queue, mcrypto, certs, my_port)
+        self.offline_overlap = 60*10
+        self.status_queue = multiprocessing.Queue()
+        self._status_callbacks = []
+        self._status_thread = threading.Thread(
+            target=self._listen_status, daemon=True
+        )
+        self._status_thread.start()
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
+        for priority, name in enumerate(PRIORITY_NAMES):
+            self.metrics.add_gauge(
+                f"sender_queue_{name}",
+                functools.partial(self._queue_size, priority)
+            )
+        self.llsender = LowLevelSender(
+            self.queue, self.status_queue, mcrypto, certs, my_port,
+            ciphergrams=storage.ciphergrams, max_difficulty=max_difficulty,
+            metrics=self.metrics
+        )
         self.llsender_proc = multiprocessing.Process(
             target=self.llsender.run
         )
         self.llsender_proc.start()
 
-    def send_message_to(self, user_key, message):
-        self.broadcast(message, user_key)
+    def _queue_size(self, priority):
+        return self.queue.sizes[priority]
+
+    def add_status_callback(self, callback):
+        self._status_callbacks.append(callback)
+
+    def _listen_status(self):
+        while True:
+            status = self.status_queue.get()
+            if status is None:
+                break
+            message_id, state = status
+            for callback in self._status_callbacks:
+                callback(message_id, state)
+
+    def send_message_to(self, user_key, message, message_id=None):
+        addresses = self.storage.ipaddresses.list_all()
+        self.queue.put(
+            (addresses, message, user_key, message_id), INTERACTIVE
+        )
+
+    def send_group_message_to(self, user_keys, message, message_id=None):
+        addresses = self.storage.ipaddresses.list_all()
+        self.queue.put(
+            (addresses, message, tuple(user_keys), message_id), INTERACTIVE
+        )
 
     def request_offline_data(self):
         self.offline_requested = [
             address for address in self.storage.ipaddresses.list_all()
         ]
-        
-        self.broadcast(
-            json.dumps(
-                dict(
-                    type="request_offline_data",
-                    server_port=self.my_port
-                )
-            )
-        )
-
-    def respond_offline_data(self, address):
-        response = dict(
-            type="response_offline_data",
+        request = dict(
+            type="request_offline_data",
             server_port=self.my_port,
-            ciphergrams=[]
+            chunked=True
         )
-        for ciphergram in self.storage.ciphergrams.list_all():
-            response["ciphergrams"].append(
-                dict(
-                    content=ciphergram.content,
-                    timestamp=ciphergram.timestamp
-                )
-            )
-        self.send_to(json.dumps(response), address)
+        # ask only for what was sent since the last ciphergram we have seen
+        latest = self.storage.ciphergrams.get_latest_timestamp()
+        if latest is not None:
+            request["since"] = latest - self.offline_overlap
+
+        # the request is small and must not be dropped with bulk traffic,
+        # only the responses to it are bulk
+        self.broadcast(json.dumps(request), priority=INTERACTIVE)
+
+    def respond_offline_data(self, address, since=None, chunked=False):
+        self.send_to(OfflineData(since, chunked), address, priority=BULK)
 
-    def send_to(self, message, ip_address):
+    def send_to(self, message, ip_address, priority=INTERACTIVE):
         self.queue.put(
-            ([ip_address, ], message, None)
+            ([ip_address, ], message, None, None), priority
         )
 
-    def broadcast(self, message, user_key=None):
+    def broadcast(self, message, priority=INTERACTIVE):
         addresses = self.storage.ipaddresses.list_all()
-        self.queue.put((addresses, message, user_key))
+        self.queue.put((addresses, message, None, None), priority)
 
     def broadcast_from(self, message, ip_address):
         ip_addresses = self.storage.ipaddresses.list_all()
@@ -70,53 +207,288 @@ class Sender:
         except ValueError:
             pass
         else:
-            self.queue.put((ip_addresses, message, None))
+            self.queue.put((ip_addresses, message, None, None), RELAY)
 
     def terminate(self):
-        self.llsender_proc.terminate()
-        self.llsender_proc.join()
+        self.queue.put(None, INTERACTIVE)  # stop the pipeline gracefully
+        self.llsender_proc.join(timeout=5)
+        if self.llsender_proc.is_alive():
+            self.llsender_proc.terminate()
+            self.llsender_proc.join()
+        self.status_queue.put(None)
+
+
+_worker_mcrypto = None
+
+
+def _init_crypto_worker(mcrypto):
+    global _worker_mcrypto
+    _worker_mcrypto = mcrypto
+
+
+def _get_ciphergram(user_key, message, difficulty=1):
+    # a tuple of keys stands for a group message
+    if isinstance(user_key, tuple):
+        return _worker_mcrypto.get_group_ciphergram(
+            user_key, message, difficulty
+        )
+    return _worker_mcrypto.get_ciphergram(user_key, message, difficulty)
+
+
+def _redo_proof(ciphergram, difficulty):
+    return _worker_mcrypto.redo_proof(ciphergram, difficulty)
 
 
 class LowLevelSender:
-    def __init__(self, queue, mcrypto, certs, port):
+    def __init__(self, queue, status_queue, mcrypto, certs, port,
+                 crypto_workers=2, ciphergrams=None, max_difficulty=64,
+                 metrics=None):
         self.queue = queue
+        self.status_queue = status_queue
         self.mcrypto = mcrypto
         self.certs = certs
         self.my_port = port
+        self.crypto_workers = crypto_workers
+        self.ciphergrams = ciphergrams
+        self.close_timeout = 5
+        self.max_reply_size = 1 << 12
+        self.reply_workers = 4
+        self.max_peers = 1024
+        self.max_difficulty = max_difficulty
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
+        self._sessions = {}
+        self._difficulties = {}
+        self._context = None
+        self._reply_pool = None
+        self._pool = None
+        self._lock = threading.Lock()
 
-    def _send_message(self, ip_addresses, message):
-        context = ssl.SSLContext()
-        context.verify_mode = ssl.CERT_NONE
+    def _get_offline_response(self, since):
+        # ciphergrams are read lazily while the response is written out
+        return dict(
+            type="response_offline_data",
+            server_port=self.my_port,
+            ciphergrams=(
+                dict(
+                    content=get_wire_ciphergram(ciphergram, self.my_port),
+                    timestamp=ciphergram.timestamp
+                ) for ciphergram in self.ciphergrams.iter_all(since)
+            )
+        )
+
+    def _get_reply_pool(self):
+        # made by the sending process, threads don't survive a fork
+        if self._reply_pool is None:
+            self._reply_pool = concurrent.futures.ThreadPoolExecutor(
+                self.reply_workers
+            )
+        return self._reply_pool
+
+    def _send_message(self, ip_addresses, message, message_id=None):
+        """Sends the message to every peer and returns a future of
+        the number of peers which got it, the status of the message
+        is reported when their replies are read off the send loop"""
+        delivered = []
+        # sessions can be resumed only by the context they were made by
+        if self._context is None:
+            self._context = self.certs.make_client_context()
         for ip_address in ip_addresses:
+            peer = (ip_address.address, ip_address.port)
+            client_socket = snakesockets.TCP()
+            with self._lock:
+                session = self._sessions.get(peer)
             try:
-                client_socket = snakesockets.TCP()
-                client_socket.sock =context.wrap_socket(client_socket.sock)
-                client_socket.connect((ip_address.address, ip_address.port))
-                client_socket.send(message.encode("utf-8"))
+                client_socket.sock = self._context.wrap_socket(
+                    client_socket.sock, session=session
+                )
+                client_socket.connect(peer)
+                if isinstance(message, OfflineData):
+                    chunks = self._count_sent(streaming.iter_chunks(
+                        self._get_offline_response(message.since)
+                    ))
+                    if message.chunked:
+                        client_socket.send_chunked(chunks)
+                    else:
+                        client_socket.send(b"".join(chunks))
+                else:
+                    data = self._encode_message(message)
+                    client_socket.send(data)
+                    self.metrics.count("bytes_sent", len(data))
             except Exception:
-                pass
+                with self._lock:
+                    self._sessions.pop(peer, None)
+                self.metrics.count("peer_connections_failed")
+                client_socket.close()
+            else:
+                self.metrics.count("peer_connections")
+                delivered.append((peer, client_socket))
             logger.info(
                 f"Sending message to {ip_address} with content {message}"
             )
+        return self._get_reply_pool().submit(
+            self._read_replies, delivered, message, message_id
+        )
+
+    def _encode_message(self, message):
+        if isinstance(message, OwnCiphergram):
+            message = json.dumps(
+                dict(
+                    type="ciphergram",
+                    server_port=self.my_port,
+                    **dataclasses.asdict(message.ciphergram)
+                )
+            )
+        return message.encode("utf-8")
+
+    def _read_replies(self, delivered, message, message_id):
+        accepted = []
+        refused = []
+        # all of the replies are read within one close_timeout
+        deadline = time.monotonic() + self.close_timeout
+        for peer, client_socket in delivered:
+            try:
+                required = self._read_reply(
+                    peer, client_socket, deadline - time.monotonic()
+                )
+            finally:
+                client_socket.close()
+            if required is None:
+                accepted.append(peer)
+            else:
+                refused.append((peer, required))
+
+        # the status is reported once, by the resent message if need be
+        resent = self._resend(
+            message, refused, None if accepted else message_id
+        )
+        if accepted:
+            self._report_status(message_id, "sent")
+        elif not resent:
+            self._report_status(message_id, "failed")
+        return len(accepted)
+
+    def _resend(self, message, refused, message_id):
+        # only own ciphergrams are worked out again, at most up to
+        # max_difficulty, relays are left to the peers which made them
+        if not refused or not isinstance(message, OwnCiphergram):
+            return False
+        difficulty = max(required for _, required in refused)
+        if not message.difficulty < difficulty <= self.max_difficulty:
+            return False
+
+        logger.info(f"Proof of work is too weak, redone at {difficulty}")
+        self._pool.apply_async(
+            _redo_proof, (message.ciphergram, difficulty),
+            callback=functools.partial(
+                self._ciphergram_ready,
+                [orm.IPAddress(*peer) for peer, _ in refused],
+                message_id, difficulty
+            ),
+            error_callback=functools.partial(
+                self._ciphergram_failed, message_id
+            )
+        )
+        return True
+
+    def _count_sent(self, chunks):
+        for chunk in chunks:
+            yield chunk
+            self.metrics.count("bytes_sent", len(chunk))
+
+    def _read_reply(self, peer, client_socket, timeout):
+        """Returns the difficulty the peer requires when it refused the
+        message for its weak proof of work, None if it took the message"""
+        # the reply carries the difficulty the peer requires, TLS 1.3
+        # tickets come after the handshake and are read on the way
+        required = None
+        try:
+            client_socket.sock.settimeout(max(timeout, 0))
+            reply = json.loads(client_socket.recv(self.max_reply_size))
+            difficulty = float(reply["pow_difficulty"])
+        except (OSError, struct.error, ValueError, KeyError, TypeError):
+            pass  # peers of older versions just close the connection
+        else:
+            if math.isfinite(difficulty):
+                self._remember(
+                    self._difficulties, peer,
+                    min(max(difficulty, 1), self.max_difficulty)
+                )
+                if reply.get("accepted") is False:
+                    required = difficulty
+        if self.certs.tls.session_tickets and (
+            client_socket.sock.session is not None
+        ):
+            self._remember(self._sessions, peer, client_socket.sock.session)
+        return required
+
+    def _remember(self, cache, peer, value):
+        with self._lock:
+            cache.pop(peer, None)
+            if len(cache) >= self.max_peers:
+                del cache[next(iter(cache))]
+            cache[peer] = value
+
+    def _get_difficulty(self, addresses):
+        with self._lock:
+            return max(
+                (
+                    self._difficulties.get((address.address, address.port), 1)
+                    for address in addresses
+                ),
+                default=1
+            )
+
+    def _report_status(self, message_id, state):
+        if message_id is not None:
+            self.status_queue.put((message_id, state))
+
+    def _ciphergram_ready(self, addresses, message_id, difficulty,
+                          ciphergram):
+        self.queue.put(
+            (addresses, OwnCiphergram(ciphergram, difficulty), None,
+             message_id),
+            INTERACTIVE
+        )
+
+    def _ciphergram_failed(self, message_id, exc):
+        logger.info(f"Can't make ciphergram: {exc!r}")
+        self._report_status(message_id, "failed")
+
+    def _schedule_ciphergram(self, pool, addresses, message, user_key,
+                             message_id):
+        self._report_status(message_id, "sending")
+        difficulty = self._get_difficulty(addresses)
+        pool.apply_async(
+            _get_ciphergram,
+            (user_key, message, difficulty),
+            callback=functools.partial(
+                self._ciphergram_ready, addresses, message_id, difficulty
+            ),
+            error_callback=functools.partial(
+                self._ciphergram_failed, message_id
+            )
+        )
 
     def run(self):
+        # encryption and proof of work are done by the pool, ready
+        # ciphergrams come back through the queue with the top priority,
+        # so relays are never stuck behind somebody's proof of work
+        pool = self._pool = multiprocessing.Pool(
+            self.crypto_workers,
+            initializer=_init_crypto_worker, initargs=(self.mcrypto, )
+        )
         while True:
-            addresses, message, node_id = self.queue.get()
-            if node_id is not None:
-                try:
-                    ciphergram = self.mcrypto.get_ciphergram(node_id, message)
-                except crypto.MessageCryptoInvalidRecipientKey:
-                    pass
-                else:
-                    self._send_message(
-                        addresses,
-                        json.dumps(
-                            dict(
-                                type="ciphergram",
-                                server_port=self.my_port,
-                                **dataclasses.asdict(ciphergram)
-                            )
-                        )
-                    )
+            item = self.queue.get()
+            if item is None:
+                break
+            addresses, message, user_key, message_id = item
+            if user_key is not None:
+                self._schedule_ciphergram(
+                    pool, addresses, message, user_key, message_id
+                )
             else:
-                self._send_message(addresses, message)
+                self._send_message(addresses, message, message_id)
+
+        self._get_reply_pool().shutdown(wait=True)
+        pool.terminate()
+        pool.join()
@@ -5,6 +5,10 @@ import struct
 import pickle
 
 
+class FrameTooLargeError(ConnectionError):
+    """Error when a received frame exceeds the allowed size"""
+
+
 class TCP:
     def __init__(self, sock=None, reuseaddr=False):
         self.sock = socket.socket() if sock is None else sock
@@ -30,27 +34,51 @@ class TCP:
     def close(self):
         self.sock.close()
 
+    # a length equal to the marker starts a frame sent in chunks,
+    # each of them has its own length, a zero length ends the frame;
+    # older nodes can't read it, so it's sent only on request
+    chunked_marker = 0xFFFFFFFF
+    max_frame_size = 1 << 27
+
     def send(self, msg_obj):
         self.sock.sendall(struct.pack("!I", len(msg_obj)))
         self.sock.sendall(msg_obj)
 
-    def recv(self):
-        b1, b2, b3, b4 = (
-            self.sock.recv(1),
-            self.sock.recv(1),
-            self.sock.recv(1),
-            self.sock.recv(1),
-        )
-        data_len = struct.unpack("!I", b1 + b2 + b3 + b4)[0]
-
-        msg_obj = b""
-        bytes_read = 0
-        while bytes_read < data_len:
-            readed_data = self.sock.recv(data_len - bytes_read)
-            bytes_read += len(readed_data)
+    def send_chunked(self, chunks):
+        self.sock.sendall(struct.pack("!I", self.chunked_marker))
+        for chunk in chunks:
+            if chunk:
+                self.sock.sendall(struct.pack("!I", len(chunk)))
+                self.sock.sendall(chunk)
+        self.sock.sendall(struct.pack("!I", 0))
+
+    def recv(self, max_size=None):
+        max_size = self.max_frame_size if max_size is None else max_size
+        data_len, = struct.unpack("!I", self._recv_exactly(4))
+        if data_len != self.chunked_marker:
+            if data_len > max_size:
+                raise FrameTooLargeError(f"Frame of {data_len} bytes")
+            return self._recv_exactly(data_len)
+
+        chunks = []
+        total = 0
+        while True:
+            chunk_len, = struct.unpack("!I", self._recv_exactly(4))
+            if chunk_len == 0:
+                return b"".join(chunks)
+            total += chunk_len
+            if total > max_size:
+                raise FrameTooLargeError(f"Chunked frame over {max_size} bytes")
+            chunks.append(self._recv_exactly(chunk_len))
+
+    def _recv_exactly(self, size):
+        msg_obj = bytearray()
+        while len(msg_obj) < size:
+            readed_data = self.sock.recv(size - len(msg_obj))
+            if not readed_data:
+                raise ConnectionError("Connection closed inside of a frame")
             msg_obj += readed_data
-
-        return msg_obj
+        return bytes(msg_obj)
 
 
 class PickleUDP:
@@ -1,16 +1,63 @@
+import json
+import math
+import time
+import queue
+import logging
+import contextlib
 import pathlib
 import sqlite3
-import time
+import threading
 
 from . import orm
+from . import batching
+from . import monitoring
+
+logger = logging.getLogger(__name__)
+
+
+def _make_node(cursor, row):
+    return orm.Node(*row)
+
+
+def _make_message(cursor, row):
+    node_id, text, to_me, sender_timestamp, timestamp = row
+    return orm.Message(
+        node_id, text, bool(to_me), sender_timestamp, timestamp
+    )
 
 
-class Nodes:
-    def __init__(self, db_path):
+def _make_ipaddress(cursor, row):
+    return orm.IPAddress(*row)
+
+
+def _make_ciphergram(cursor, row):
+    *fields, multikey = row
+    return orm.Ciphergram(*fields, multikey=bool(multikey))
+
+
+class Table:
+    def __init__(self, db_path, conn=None):
         self.db_path = db_path
+        self._conn = conn
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # inside of a transaction all tables share its connection
+        if self._conn is not None:
+            yield self._conn
+            return
 
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class Nodes(Table):
     def update_node_activity(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if not self.check_node_exists(node):
@@ -21,10 +68,9 @@ class Nodes:
                 "UPDATE `Nodes` SET `last_activity`=? WHERE `node_id`=?",
                 (node.last_activity, node.node_id)
             )
-            conn.commit()
 
     def increment_node_unread(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if not self.check_node_exists(node):
@@ -38,10 +84,9 @@ class Nodes:
                 """,
                 (node.node_id,)
             )
-            conn.commit()
 
     def set_node_unread_to_zero(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if not self.check_node_exists(node):
@@ -55,10 +100,9 @@ class Nodes:
                 """,
                 (node.node_id,)
             )
-            conn.commit()
 
     def check_node_exists(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -72,7 +116,7 @@ class Nodes:
             return True if node_exists else False
 
     def add_node(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if self.check_node_exists(node):
@@ -85,10 +129,9 @@ class Nodes:
                     node.unread_count, node.alias
                 ),
             )
-            conn.commit()
 
     def delete_node(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if not self.check_node_exists(node):
@@ -98,11 +141,11 @@ class Nodes:
                 "DELETE FROM `Nodes` WHERE `node_id`=?",
                 (node.node_id,)
             )
-            conn.commit()
 
     def get_node_by_id(self, node_id):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = _make_node
 
             if not self.check_node_exists(orm.Node(node_id)):
                 raise orm.NodeNotFoundError
@@ -111,24 +154,21 @@ class Nodes:
                 "SELECT * FROM `Nodes` WHERE `node_id`=?",
                 (node_id,)
             )
-            node = cursor.fetchone()
-            return orm.Node(*node)
+            return cursor.fetchone()
 
     def list_all(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = _make_node
             cursor.execute(
                 "SELECT * FROM `Nodes` ORDER BY `last_activity` DESC"
             )
-            return [orm.Node(*node) for node in cursor.fetchall()]
-
+            return cursor.fetchall()
 
-class Messages:
-    def __init__(self, db_path):
-        self.db_path = db_path
 
+class Messages(Table):
     def check_message_exists(self, message):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -147,7 +187,7 @@ class Messages:
             return True if message_exists else False
 
     def add_message(self, message):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             if self.check_message_exists(message):
@@ -163,11 +203,11 @@ class Messages:
                     message.timestamp
                 )
             )
-            conn.commit()
 
     def get_messages(self, node, limit=None, offset=None):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = _make_message
             if limit is not None and offset is not None:
                 cursor.execute(
                     """
@@ -195,76 +235,629 @@ class Messages:
             else:
                 raise sqlite3.Error
 
-            return [
-                orm.Message(nid, txt, True if to_me else False, stm, tm)
-                for nid, txt, to_me, stm, tm in cursor.fetchall()
-            ]
+            return cursor.fetchall()
+
+    def get_last_messages(self, node, count, skip=0):
+        """count messages before the last skip ones, oldest first"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _make_message
+            cursor.execute(
+                """
+                SELECT `node_id`, `text`, `to_me`, `sender_timestamp`,
+                `timestamp` FROM (
+                    SELECT rowid, * FROM `Messages` WHERE `node_id`=?
+                    ORDER BY `timestamp` DESC, rowid DESC LIMIT ? OFFSET ?
+                ) ORDER BY `timestamp`, rowid
+                """,
+                (node.node_id, count, skip)
+            )
+            return cursor.fetchall()
+
+    def search_messages(self, query, node=None, limit=20, offset=0):
+        # every word is matched as a prefix, so user input can't break
+        # the full text query syntax
+        match = " ".join(
+            '"{}"*'.format(word.replace('"', '""')) for word in query.split()
+        )
+        if not match:
+            return []
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _make_message
+            cursor.execute(
+                """
+                SELECT `Messages`.`node_id`, `Messages`.`text`, `to_me`,
+                `sender_timestamp`, `timestamp` FROM `MessagesSearch`
+                JOIN `Messages` ON `Messages`.rowid = `MessagesSearch`.rowid
+                WHERE `MessagesSearch` MATCH ?
+                AND `Messages`.`node_id` = COALESCE(?, `Messages`.`node_id`)
+                ORDER BY `rank`, `timestamp` DESC LIMIT ? OFFSET ?
+                """,
+                (match, None if node is None else node.node_id, limit, offset)
+            )
+            return cursor.fetchall()
 
     def delete_messages(self, node):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "DELETE FROM `Messages` WHERE `node_id`=?",
                 (node.node_id, )
             )
-            conn.commit()
 
 
-class Ciphergrams:
-    def __init__(self, db_path):
-        self.db_path = db_path
+class Keys(Table):
+    """Directory of full public keys by their fingerprints"""
 
-    def delete_expired(self, timespan):
-        with sqlite3.connect(self.db_path) as conn:
+    def add_key(self, key):
+        with self._connect() as conn:
             cursor = conn.cursor()
+            key_fingerprint = orm.fingerprint(key)
             cursor.execute(
-                "DELETE FROM `Ciphergrams` WHERE ? - `timestamp` > ?",
-                (
-                    int(time.time()),
-                    timespan,
+                "INSERT OR IGNORE INTO `Keys` VALUES (?, ?)",
+                (key_fingerprint, key)
+            )
+            return key_fingerprint
+
+    def get_key(self, key_fingerprint):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT `key` FROM `Keys` WHERE `fingerprint`=?",
+                (key_fingerprint, )
+            )
+            row = cursor.fetchone()
+            if row is None:
+                raise orm.KeyNotFoundError
+            return row[0]
+
+    def delete_key(self, key_fingerprint):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM `Keys` WHERE `fingerprint`=?",
+                (key_fingerprint, )
+            )
+
+
+class Changes(Table):
+    """Journal of changed dialogs, every change gets a new version"""
+
+    def get_version(self):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT `seq` FROM `sqlite_sequence` WHERE `name`='Changes'"
+            )
+            row = cursor.fetchone()
+            return 0 if row is None else row[0]
+
+    def check_version_covered(self, version):
+        """Whether every change made after the version is in the journal"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT MIN(`version`) FROM `Changes`")
+            oldest, = cursor.fetchone()
+            current = self.get_version()
+            if oldest is None:
+                oldest = current + 1
+            return 0 < version <= current and version + 1 >= oldest
+
+    def list_changed_nodes(self, version):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT `node_id` FROM `Changes` WHERE `version` > ?
+                GROUP BY `node_id` ORDER BY MAX(`version`)
+                """,
+                (version, )
+            )
+            return [node_id for node_id, in cursor.fetchall()]
+
+    def list_new_messages(self, version):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _make_message
+            cursor.execute(
+                """
+                SELECT `Messages`.`node_id`, `text`, `to_me`,
+                `sender_timestamp`, `Messages`.`timestamp` FROM `Changes`
+                JOIN `Messages` ON `Messages`.rowid = `Changes`.`message`
+                WHERE `version` > ?
+                GROUP BY `Changes`.`message` ORDER BY MAX(`version`)
+                """,
+                (version, )
+            )
+            return cursor.fetchall()
+
+    def delete_expired(self, timespan, limit=-1):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                DELETE FROM `Changes` WHERE `version` IN (
+                    SELECT `version` FROM `Changes`
+                    WHERE `timestamp` < ? ORDER BY `version` LIMIT ?
                 )
+                """,
+                (int(time.time()) - timespan, limit)
             )
-            conn.commit()
+            return cursor.rowcount
 
-    def check_ciphergram_exists(self, ciphergram):
-        with sqlite3.connect(self.db_path) as conn:
+
+class Ciphergrams(Table):
+    """Ciphergrams are kept in a table per partition_span seconds,
+    so expired ones are deleted by dropping whole tables"""
+
+    partition_span = 60 * 60 * 4
+    page_size = 256
+
+    partition_statements = (
+        """
+        CREATE TABLE `Ciphergrams_{bucket}` (
+            `digest`	BLOB NOT NULL,
+            `ciphertext`	BLOB NOT NULL,
+            `cipherkey`	BLOB NOT NULL,
+            `signature`	BLOB NOT NULL,
+            `proof`	INTEGER NOT NULL,
+            `timestamp`	INTEGER NOT NULL,
+            `origin`	TEXT NOT NULL DEFAULT '',
+            `weight`	REAL NOT NULL DEFAULT 0,
+            `multikey`	INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(digest)
+        )
+        """,
+        """
+        CREATE INDEX `Ciphergrams_{bucket}_Timestamp`
+            ON `Ciphergrams_{bucket}` (`timestamp`)
+        """,
+        """
+        CREATE TRIGGER `Ciphergrams_{bucket}_Insert`
+        AFTER INSERT ON `Ciphergrams_{bucket}` BEGIN
+            INSERT INTO `CiphergramsUsage`
+            VALUES ({bucket}, NEW.origin, 1, LENGTH(NEW.ciphertext) +
+                LENGTH(NEW.cipherkey) + LENGTH(NEW.signature))
+            ON CONFLICT(bucket, origin) DO UPDATE SET
+                `rows` = `rows` + 1, `bytes` = `bytes` +
+                LENGTH(NEW.ciphertext) + LENGTH(NEW.cipherkey) +
+                LENGTH(NEW.signature);
+        END
+        """,
+        """
+        CREATE TRIGGER `Ciphergrams_{bucket}_Delete`
+        AFTER DELETE ON `Ciphergrams_{bucket}` BEGIN
+            UPDATE `CiphergramsUsage` SET
+                `rows` = `rows` - 1, `bytes` = `bytes` -
+                LENGTH(OLD.ciphertext) - LENGTH(OLD.cipherkey) -
+                LENGTH(OLD.signature)
+            WHERE `bucket` = {bucket} AND `origin` = OLD.origin;
+        END
+        """,
+    )
+
+    def get_bucket(self, timestamp):
+        return int(timestamp) // self.partition_span
+
+    def _list_buckets(self, cursor, since=None, until=None):
+        cursor.execute(
+            """
+            SELECT `bucket` FROM `CiphergramsPartitions`
+            WHERE `bucket` >= COALESCE(?, `bucket`)
+            AND `bucket` <= COALESCE(?, `bucket`)
+            ORDER BY `bucket`
+            """,
+            (
+                None if since is None else self.get_bucket(since),
+                None if until is None else self.get_bucket(until),
+            )
+        )
+        return [bucket for bucket, in cursor.fetchall()]
+
+    def _check_partition_exists(self, cursor, bucket):
+        cursor.execute(
+            """
+            SELECT EXISTS(SELECT 1 FROM `CiphergramsPartitions`
+            WHERE bucket=? LIMIT 1)
+            """,
+            (bucket, )
+        )
+        partition_exists, = cursor.fetchone()
+        return True if partition_exists else False
+
+    def _create_partition(self, cursor, bucket):
+        for statement in self.partition_statements:
+            cursor.execute(statement.format(bucket=bucket))
+        cursor.execute(
+            "INSERT INTO `CiphergramsPartitions` VALUES (?)", (bucket, )
+        )
+
+    def _drop_partition(self, cursor, bucket):
+        cursor.execute(f"DROP TABLE `Ciphergrams_{bucket}`")
+        cursor.execute(
+            "DELETE FROM `CiphergramsUsage` WHERE `bucket`=?", (bucket, )
+        )
+        cursor.execute(
+            "DELETE FROM `CiphergramsPartitions` WHERE `bucket`=?", (bucket, )
+        )
+
+    def delete_expired(self, timespan, limit=-1):
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
-                SELECT EXISTS(SELECT 1 FROM `Ciphergrams`
-                WHERE content=? AND timestamp=? LIMIT 1)
+                SELECT `bucket` FROM `CiphergramsPartitions`
+                WHERE `bucket` < ? ORDER BY `bucket` LIMIT ?
                 """,
-                (ciphergram.content, ciphergram.timestamp)
+                (self.get_bucket(int(time.time()) - timespan), limit)
+            )
+            buckets = [bucket for bucket, in cursor.fetchall()]
+            for bucket in buckets:
+                self._drop_partition(cursor, bucket)
+            return len(buckets)
+
+    def check_ciphergram_exists(self, ciphergram):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            bucket = self.get_bucket(ciphergram.timestamp)
+            if not self._check_partition_exists(cursor, bucket):
+                return False
+
+            cursor.execute(
+                f"""
+                SELECT EXISTS(SELECT 1 FROM `Ciphergrams_{bucket}`
+                WHERE digest=? LIMIT 1)
+                """,
+                (ciphergram.digest, )
             )
             node_exists, = cursor.fetchone()
             return True if node_exists else False
 
     def add_ciphergram(self, ciphergram):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if self.check_ciphergram_exists(ciphergram):
                 raise orm.CiphergramAlreadyExistsError
-            
+
+            bucket = self.get_bucket(ciphergram.timestamp)
+            if not self._check_partition_exists(cursor, bucket):
+                self._create_partition(cursor, bucket)
             cursor.execute(
-                "INSERT INTO `Ciphergrams` VALUES (?, ?)",
-                (ciphergram.content, ciphergram.timestamp)
+                f"""
+                INSERT INTO `Ciphergrams_{bucket}`
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    ciphergram.digest, ciphergram.ciphertext,
+                    ciphergram.cipherkey, ciphergram.signature,
+                    ciphergram.proof, ciphergram.timestamp,
+                    ciphergram.origin, ciphergram.weight,
+                    1 if ciphergram.multikey else 0
+                )
             )
-            conn.commit()
 
-    def list_all(self):
-        with sqlite3.connect(self.db_path) as conn:
+    def list_all(self, since=None):
+        return list(self.iter_all(since))
+
+    def iter_all(self, since=None):
+        """Yields ciphergrams without loading them all
+
+        They are read in pages ordered by (bucket, rowid) and every page
+        is read by its own statement, so a slow consumer doesn't keep
+        a read open and hold back checkpoints of the write-ahead log.
+        """
+        position = (-1, 0)
+        while True:
+            page = self._read_page(since, position)
+            if not page:
+                return
+            for position, ciphergram in page:
+                yield ciphergram
+
+    def _read_page(self, since, position):
+        last_bucket, last_rowid = position
+        page = []
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            for bucket in self._list_buckets(cursor, since):
+                if bucket < last_bucket:
+                    continue
+                cursor.execute(
+                    f"""
+                    SELECT `rowid`, `ciphertext`, `cipherkey`, `signature`,
+                    `proof`, `timestamp`, `origin`, `weight`, `multikey`
+                    FROM `Ciphergrams_{bucket}`
+                    WHERE `rowid` > ?
+                    AND `timestamp` >= COALESCE(?, `timestamp`)
+                    ORDER BY `rowid` LIMIT ?
+                    """,
+                    (
+                        last_rowid if bucket == last_bucket else 0,
+                        since, self.page_size - len(page)
+                    )
+                )
+                page.extend(
+                    ((bucket, rowid), _make_ciphergram(cursor, row))
+                    for rowid, *row in cursor.fetchall()
+                )
+                if len(page) >= self.page_size:
+                    break
+        return page
+
+    def get_latest_timestamp(self):
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM `Ciphergrams`")
-            return [orm.Ciphergram(*cph) for cph in cursor.fetchall()]
+            buckets = self._list_buckets(cursor, until=time.time())
+            if not buckets:
+                return None
+            cursor.execute(
+                f"SELECT MAX(`timestamp`) FROM `Ciphergrams_{buckets[-1]}`"
+            )
+            latest, = cursor.fetchone()
+            return latest
 
+    def get_usage(self):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT COALESCE(SUM(`rows`), 0), COALESCE(SUM(`bytes`), 0)
+                FROM `CiphergramsUsage`
+                """
+            )
+            return cursor.fetchone()
+
+    eviction_orders = dict(
+        age="`timestamp`",
+        strength="`weight`, `timestamp`",
+        fairness="`timestamp`",
+    )
+
+    def evict(self, count, policy="age"):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            buckets = self._list_buckets(cursor)
+            if not buckets:
+                return 0
+
+            condition, params = "", ()
+            if policy == "fairness":
+                # the origin which occupies the most space loses its oldest
+                cursor.execute(
+                    """
+                    SELECT `origin` FROM `CiphergramsUsage` GROUP BY `origin`
+                    ORDER BY SUM(`bytes`) DESC LIMIT 1
+                    """
+                )
+                condition, params = "WHERE `origin`=?", cursor.fetchone()
+                if params is None:
+                    return 0
+
+            partitions = " UNION ALL ".join(
+                f"""
+                SELECT {bucket} AS `bucket`, rowid AS `row`,
+                `timestamp`, `origin`, `weight` FROM `Ciphergrams_{bucket}`
+                """
+                for bucket in buckets
+            )
+            cursor.execute(
+                f"""
+                SELECT `bucket`, `row` FROM ({partitions}) {condition}
+                ORDER BY {self.eviction_orders[policy]} LIMIT ?
+                """,
+                params + (count, )
+            )
+            victims = cursor.fetchall()
+            for bucket, row in victims:
+                cursor.execute(
+                    f"DELETE FROM `Ciphergrams_{bucket}` WHERE rowid=?",
+                    (row, )
+                )
+            return len(victims)
+
+
+_text_partition_statements = (
+    """
+    CREATE TABLE `Ciphergrams_{bucket}` (
+        `content`	TEXT NOT NULL,
+        `timestamp`	INTEGER NOT NULL,
+        `origin`	TEXT NOT NULL DEFAULT '',
+        `weight`	REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY(content,timestamp)
+    )
+    """,
+    """
+    CREATE INDEX `Ciphergrams_{bucket}_Timestamp`
+        ON `Ciphergrams_{bucket}` (`timestamp`)
+    """,
+    """
+    CREATE TRIGGER `Ciphergrams_{bucket}_Insert`
+    AFTER INSERT ON `Ciphergrams_{bucket}` BEGIN
+        INSERT INTO `CiphergramsUsage`
+        VALUES ({bucket}, NEW.origin, 1, LENGTH(NEW.content))
+        ON CONFLICT(bucket, origin) DO UPDATE SET
+            `rows` = `rows` + 1, `bytes` = `bytes` + LENGTH(NEW.content);
+    END
+    """,
+    """
+    CREATE TRIGGER `Ciphergrams_{bucket}_Delete`
+    AFTER DELETE ON `Ciphergrams_{bucket}` BEGIN
+        UPDATE `CiphergramsUsage` SET
+            `rows` = `rows` - 1, `bytes` = `bytes` - LENGTH(OLD.content)
+        WHERE `bucket` = {bucket} AND `origin` = OLD.origin;
+    END
+    """,
+)
+
+
+def _partition_ciphergrams(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE `CiphergramsUsage`")
+    cursor.execute(
+        """
+        CREATE TABLE `CiphergramsPartitions` (
+            `bucket`	INTEGER NOT NULL,
+            PRIMARY KEY(bucket)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE `CiphergramsUsage` (
+            `bucket`	INTEGER NOT NULL,
+            `origin`	TEXT NOT NULL,
+            `rows`	INTEGER NOT NULL,
+            `bytes`	INTEGER NOT NULL,
+            PRIMARY KEY(bucket,origin)
+        )
+        """
+    )
+    cursor.execute(
+        "SELECT DISTINCT `timestamp` / ? FROM `Ciphergrams`",
+        (Ciphergrams.partition_span, )
+    )
+    for bucket, in cursor.fetchall():
+        for statement in _text_partition_statements:
+            cursor.execute(statement.format(bucket=bucket))
+        cursor.execute(
+            "INSERT INTO `CiphergramsPartitions` VALUES (?)", (bucket, )
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO `Ciphergrams_{bucket}`
+            SELECT `content`, `timestamp`, `origin`, `weight`
+            FROM `Ciphergrams` WHERE `timestamp` / ? = ?
+            """,
+            (Ciphergrams.partition_span, bucket)
+        )
+    cursor.execute("DROP TABLE `Ciphergrams`")
 
-class IPAddresses:
-    def __init__(self, db_path):
-        self.db_path = db_path
 
+def _compact_node_ids(conn):
+    conn.create_function(
+        "fingerprint", 1, orm.fingerprint, deterministic=True
+    )
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE `Keys` (
+            `fingerprint`	TEXT NOT NULL,
+            `key`	TEXT NOT NULL,
+            PRIMARY KEY(fingerprint)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        INSERT OR IGNORE INTO `Keys`
+        SELECT fingerprint(`node_id`), `node_id` FROM `Nodes`
+        UNION SELECT fingerprint(`node_id`), `node_id` FROM `Messages`
+        """
+    )
+    cursor.execute("UPDATE `Nodes` SET `node_id` = fingerprint(`node_id`)")
+    cursor.execute(
+        "UPDATE `Messages` SET `node_id` = fingerprint(`node_id`)"
+    )
+
+
+def _store_ciphergrams_as_blobs(conn):
+    ciphergrams = Ciphergrams(None, conn)
+    cursor = conn.cursor()
+    cursor.execute("SELECT `bucket` FROM `CiphergramsPartitions`")
+    for bucket, in cursor.fetchall():
+        cursor.execute(f"DROP TRIGGER `Ciphergrams_{bucket}_Insert`")
+        cursor.execute(f"DROP TRIGGER `Ciphergrams_{bucket}_Delete`")
+        cursor.execute(f"DROP INDEX `Ciphergrams_{bucket}_Timestamp`")
+        cursor.execute(
+            f"ALTER TABLE `Ciphergrams_{bucket}` "
+            f"RENAME TO `CiphergramsText_{bucket}`"
+        )
+        cursor.execute(
+            "DELETE FROM `CiphergramsUsage` WHERE `bucket`=?", (bucket, )
+        )
+        cursor.execute(
+            "DELETE FROM `CiphergramsPartitions` WHERE `bucket`=?", (bucket, )
+        )
+        cursor.execute(
+            f"""
+            SELECT `content`, `timestamp`, `origin`, `weight`
+            FROM `CiphergramsText_{bucket}`
+            """
+        )
+        for content, timestamp, origin, weight in cursor.fetchall():
+            try:
+                fields = json.loads(content)
+                ciphergram = orm.Ciphergram(
+                    bytes.fromhex(fields["ciphertext"]),
+                    bytes.fromhex(fields["cipherkey"]),
+                    bytes.fromhex(fields["signature"]),
+                    int(fields["proof"]), timestamp, origin, weight
+                )
+                ciphergrams.add_ciphergram(ciphergram)
+            except (ValueError, KeyError, TypeError):
+                logger.info(f"Dropped malformed ciphergram {timestamp}")
+        cursor.execute(f"DROP TABLE `CiphergramsText_{bucket}`")
+
+
+def _add_multikey_column(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT `bucket` FROM `CiphergramsPartitions`")
+    for bucket, in cursor.fetchall():
+        # partitions made by the blobs migration already have the column
+        cursor.execute(f"PRAGMA table_info(`Ciphergrams_{bucket}`)")
+        if "multikey" not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute(
+                f"ALTER TABLE `Ciphergrams_{bucket}` ADD COLUMN "
+                f"`multikey` INTEGER NOT NULL DEFAULT 0"
+            )
+
+
+class CiphergramsQuota:
+    """Row and byte limits of the relay store, zero means no limit"""
+
+    policies = ("age", "strength", "fairness")
+
+    def __init__(self, max_rows=0, max_bytes=0, policy="age"):
+        if policy not in self.policies:
+            raise ValueError(f"Unknown eviction policy {policy}")
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+    def _excess(self, rows, size):
+        excess = 0
+        if self.max_rows and rows > self.max_rows:
+            excess = rows - self.max_rows
+        if self.max_bytes and size > self.max_bytes and rows > 0:
+            average_size = size / rows
+            excess = max(
+                excess, math.ceil((size - self.max_bytes) / average_size)
+            )
+        return excess
+
+    def enforce(self, ciphergrams):
+        evicted = 0
+        excess = self._excess(*ciphergrams.get_usage())
+        while excess > 0:
+            count = ciphergrams.evict(excess, self.policy)
+            if count == 0:
+                # the usage counters don't match the partitions
+                logger.warning(
+                    f"Usage of ciphergrams is {excess} over the quota, "
+                    "but nothing is left to evict"
+                )
+                break
+            evicted += count
+            excess = self._excess(*ciphergrams.get_usage())
+        return evicted
+
+
+class IPAddresses(Table):
     def check_address_exists(self, ipaddress):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -276,19 +869,22 @@ class IPAddresses:
             address_exists, = cursor.fetchone()
             return True if address_exists else False
 
-    def delete_expired(self, timespan):
-        with sqlite3.connect(self.db_path) as conn:
+    def delete_expired(self, timespan, limit=-1):
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "DELETE FROM `IPAddresses` WHERE ? - `last_activity` > ?",
-                (
-                    int(time.time()), timespan
+                """
+                DELETE FROM `IPAddresses` WHERE rowid IN (
+                    SELECT rowid FROM `IPAddresses`
+                    WHERE `last_activity` < ? LIMIT ?
                 )
+                """,
+                (int(time.time()) - timespan, limit)
             )
-            conn.commit()
+            return cursor.rowcount
 
     def add_address(self, ipaddress):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if self.check_address_exists(ipaddress):
@@ -298,10 +894,9 @@ class IPAddresses:
                 "INSERT INTO `IPAddresses` VALUES (?, ?, ?)",
                 (ipaddress.address, ipaddress.port, ipaddress.last_activity)
             )
-            conn.commit()
 
     def update_address(self, ipaddress):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
 
             if not self.check_address_exists(ipaddress):
@@ -315,18 +910,168 @@ class IPAddresses:
                 """,
                 (ipaddress.last_activity, ipaddress.address, ipaddress.port)
             )
-            conn.commit()
 
     def list_all(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = _make_ipaddress
             cursor.execute("SELECT * FROM `IPAddresses`")
-            return [orm.IPAddress(*ip) for ip in cursor.fetchall()]
+            return cursor.fetchall()
+
+
+class Transaction:
+    """Tables sharing one connection, everything done through them
+    is committed at once"""
+
+    def __init__(self, db_path, conn):
+        self.conn = conn
+        self.nodes = Nodes(db_path, conn)
+        self.keys = Keys(db_path, conn)
+        self.changes = Changes(db_path, conn)
+        self.messages = Messages(db_path, conn)
+        self.ciphergrams = Ciphergrams(db_path, conn)
+        self.ipaddresses = IPAddresses(db_path, conn)
+
+
+@contextlib.contextmanager
+def transaction(db_path, conn=None, write=True):
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            # writers take the lock at once instead of failing to
+            # upgrade it in the middle, readers get a consistent snapshot
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            yield Transaction(db_path, conn)
+    finally:
+        if own_conn:
+            conn.close()
+
+
+class WriteBatcher:
+    """Write-behind layer of the receive path
+
+    Operations are queued and committed by a background thread in one
+    transaction per max_items operations or max_delay seconds, whichever
+    comes first. Callbacks of the operations are called after the commit.
+    """
+
+    durability_levels = dict(full="FULL", normal="NORMAL", off="OFF")
+
+    def __init__(self, db_path, max_items=100, max_delay=0.05,
+                 durability="normal", quota=None, on_commit=None,
+                 metrics=None):
+        self.db_path = db_path
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.quota = quota
+        self.on_commit = on_commit
+        self.metrics = monitoring.Metrics() if metrics is None else metrics
+        self.metrics.add_gauge("storage_queue", self._queue_size)
+        self.synchronous = self.durability_levels[durability]
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_ciphergram(self, ciphergram, callback=None):
+        self._queue.put((self._add_ciphergram, (ciphergram, ), callback))
+
+    def add_received_message(self, message, key, callback=None):
+        self._queue.put(
+            (self._add_received_message, (message, key), callback)
+        )
+
+    def _queue_size(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _add_ciphergram(self, tx, ciphergram):
+        try:
+            tx.ciphergrams.add_ciphergram(ciphergram)
+        except orm.CiphergramAlreadyExistsError:
+            self.metrics.count("ciphergrams_duplicate")
+            return None
+        self.metrics.count("ciphergrams_stored")
+        return ciphergram
+
+    def _add_received_message(self, tx, message, key):
+        node = orm.Node(message.node_id)
+        if not tx.nodes.check_node_exists(node):
+            tx.keys.add_key(key)
+            tx.nodes.add_node(node)
+        else:
+            node = tx.nodes.get_node_by_id(message.node_id)
+        if tx.messages.check_message_exists(message):
+            self.metrics.count("messages_duplicate")
+            return None
+
+        tx.messages.add_message(message)
+        tx.nodes.increment_node_unread(node)
+        self.metrics.count("messages_stored")
+        return node, message
+
+    def _commit(self, conn, operations):
+        results = []
+        with self.metrics.timer("storage_commit"):
+            with transaction(self.db_path, conn) as tx:
+                for operation, args, callback in operations:
+                    with self.metrics.timer("store"):
+                        results.append(operation(tx, *args))
+                if self.quota is not None:
+                    self.quota.enforce(tx.ciphergrams)
+        return results
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        while True:
+            # flush events and the stop sentinel end a batch early
+            batch = batching.collect_batch(
+                self._queue, self.max_items, self.max_delay,
+                lambda item: isinstance(item, tuple)
+            )
+            operations = [item for item in batch if isinstance(item, tuple)]
+            try:
+                results = self._commit(conn, operations)
+            except (sqlite3.Error, ValueError):
+                # don't let one failing operation lose the whole batch
+                logger.exception("Batch commit failed, committing one by one")
+                results = []
+                for operation in operations:
+                    try:
+                        results.extend(self._commit(conn, [operation]))
+                    except (sqlite3.Error, ValueError):
+                        results.append(None)
+
+            for (operation, args, callback), result in zip(
+                operations, results
+            ):
+                if callback is not None and result is not None:
+                    callback(result)
+            if operations and self.on_commit is not None:
+                self.on_commit()
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if None in batch:
+                break
+        conn.close()
 
 
 class Storage:
 
     storage_init_script = """
+        PRAGMA auto_vacuum = INCREMENTAL;
         CREATE TABLE `IPAddresses` (
             `address`	TEXT NOT NULL,
             `port`	INTEGER NOT NULL,
@@ -354,24 +1099,223 @@ class Storage:
         );
     """
 
-    def __init__(self, db_path, ttl):
+    def __init__(self, db_path, ttl, batch_size=100, batch_delay=0.05,
+                 durability="normal", ciphergrams_quota=None, metrics=None):
         self._ttl = int(ttl)
         self._db_path = str(db_path)
         self._create_tables_if_needed()
 
         self.nodes = Nodes(self._db_path)
+        self.keys = Keys(self._db_path)
+        self.changes = Changes(self._db_path)
         self.messages = Messages(self._db_path)
         self.ciphergrams = Ciphergrams(self._db_path)
         self.ipaddresses = IPAddresses(self._db_path)
+        self._commit_listeners = []
+        self.batcher = WriteBatcher(
+            self._db_path, batch_size, batch_delay, durability,
+            ciphergrams_quota, on_commit=self._notify_commit, metrics=metrics
+        )
+
+    storage_migrations = (
+        """
+        CREATE INDEX IF NOT EXISTS `CiphergramsTimestamp`
+            ON `Ciphergrams` (`timestamp`);
+        CREATE INDEX IF NOT EXISTS `IPAddressesLastActivity`
+            ON `IPAddresses` (`last_activity`);
+        """,
+        """
+        ALTER TABLE `Ciphergrams`
+            ADD COLUMN `origin` TEXT NOT NULL DEFAULT '';
+        ALTER TABLE `Ciphergrams`
+            ADD COLUMN `weight` REAL NOT NULL DEFAULT 0;
+        CREATE INDEX `CiphergramsWeight`
+            ON `Ciphergrams` (`weight`, `timestamp`);
+        CREATE INDEX `CiphergramsOrigin`
+            ON `Ciphergrams` (`origin`, `timestamp`);
+        CREATE TABLE `CiphergramsUsage` (
+            `origin`	TEXT NOT NULL,
+            `rows`	INTEGER NOT NULL,
+            `bytes`	INTEGER NOT NULL,
+            PRIMARY KEY(origin)
+        );
+        CREATE INDEX `CiphergramsUsageBytes`
+            ON `CiphergramsUsage` (`bytes`);
+        INSERT INTO `CiphergramsUsage`
+            SELECT `origin`, COUNT(*), SUM(LENGTH(`content`))
+            FROM `Ciphergrams` GROUP BY `origin`;
+        CREATE TRIGGER `CiphergramsUsageInsert`
+        AFTER INSERT ON `Ciphergrams` BEGIN
+            INSERT INTO `CiphergramsUsage`
+            VALUES (NEW.origin, 1, LENGTH(NEW.content))
+            ON CONFLICT(origin) DO UPDATE SET
+                `rows` = `rows` + 1, `bytes` = `bytes` + LENGTH(NEW.content);
+        END;
+        CREATE TRIGGER `CiphergramsUsageDelete`
+        AFTER DELETE ON `Ciphergrams` BEGIN
+            UPDATE `CiphergramsUsage` SET
+                `rows` = `rows` - 1, `bytes` = `bytes` - LENGTH(OLD.content)
+            WHERE `origin` = OLD.origin;
+        END;
+        """,
+        _partition_ciphergrams,
+        _compact_node_ids,
+        _store_ciphergrams_as_blobs,
+        """
+        CREATE VIRTUAL TABLE `MessagesSearch` USING fts5(
+            `text`, `node_id` UNINDEXED,
+            content=`Messages`, content_rowid=`rowid`
+        );
+        CREATE TRIGGER `MessagesSearchInsert`
+        AFTER INSERT ON `Messages` BEGIN
+            INSERT INTO `MessagesSearch` (rowid, `text`, `node_id`)
+            VALUES (NEW.rowid, NEW.text, NEW.node_id);
+        END;
+        CREATE TRIGGER `MessagesSearchDelete`
+        AFTER DELETE ON `Messages` BEGIN
+            INSERT INTO `MessagesSearch`
+            (`MessagesSearch`, rowid, `text`, `node_id`)
+            VALUES ('delete', OLD.rowid, OLD.text, OLD.node_id);
+        END;
+        CREATE TRIGGER `MessagesSearchUpdate`
+        AFTER UPDATE ON `Messages` BEGIN
+            INSERT INTO `MessagesSearch`
+            (`MessagesSearch`, rowid, `text`, `node_id`)
+            VALUES ('delete', OLD.rowid, OLD.text, OLD.node_id);
+            INSERT INTO `MessagesSearch` (rowid, `text`, `node_id`)
+            VALUES (NEW.rowid, NEW.text, NEW.node_id);
+        END;
+        INSERT INTO `MessagesSearch` (`MessagesSearch`) VALUES ('rebuild');
+        """,
+        """
+        CREATE TABLE `Changes` (
+            `version`	INTEGER PRIMARY KEY AUTOINCREMENT,
+            `node_id`	TEXT NOT NULL,
+            `message`	INTEGER,
+            `timestamp`	INTEGER NOT NULL
+        );
+        CREATE INDEX `ChangesTimestamp` ON `Changes` (`timestamp`);
+        CREATE TRIGGER `ChangesMessageInsert`
+        AFTER INSERT ON `Messages` BEGIN
+            INSERT INTO `Changes` (`node_id`, `message`, `timestamp`)
+            VALUES (NEW.node_id, NEW.rowid, strftime('%s', 'now'));
+        END;
+        CREATE TRIGGER `ChangesNodeInsert`
+        AFTER INSERT ON `Nodes` BEGIN
+            INSERT INTO `Changes` (`node_id`, `timestamp`)
+            VALUES (NEW.node_id, strftime('%s', 'now'));
+        END;
+        CREATE TRIGGER `ChangesNodeUpdate`
+        AFTER UPDATE ON `Nodes` BEGIN
+            INSERT INTO `Changes` (`node_id`, `timestamp`)
+            VALUES (NEW.node_id, strftime('%s', 'now'));
+        END;
+        CREATE TRIGGER `ChangesNodeDelete`
+        AFTER DELETE ON `Nodes` BEGIN
+            INSERT INTO `Changes` (`node_id`, `timestamp`)
+            VALUES (OLD.node_id, strftime('%s', 'now'));
+        END;
+        INSERT INTO `Changes` (`node_id`, `timestamp`)
+            SELECT `node_id`, strftime('%s', 'now') FROM `Nodes`;
+        """,
+        """
+        CREATE INDEX `MessagesNode` ON `Messages` (`node_id`, `timestamp`);
+        """,
+        _add_multikey_column,
+    )
 
     def _create_tables_if_needed(self):
+        conn = sqlite3.connect(self._db_path)
         try:
-            with sqlite3.connect(self._db_path) as conn:
+            with conn:
                 cursor = conn.cursor()
                 cursor.executescript(self.storage_init_script)
         except sqlite3.Error:
             pass
+        finally:
+            conn.close()
+
+        self.migrate(self._db_path)
 
-    def delete_expired_data(self):
-        self.ciphergrams.delete_expired(self._ttl)
-        self.ipaddresses.delete_expired(self._ttl)
+    @classmethod
+    def migrate(cls, db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            version, = conn.execute("PRAGMA user_version").fetchone()
+            for number, migration in enumerate(
+                cls.storage_migrations[version:], version + 1
+            ):
+                if callable(migration):
+                    with conn:
+                        conn.execute("BEGIN")
+                        migration(conn)
+                        conn.execute(f"PRAGMA user_version = {number}")
+                else:
+                    conn.executescript(
+                        f"BEGIN; {migration} "
+                        f"PRAGMA user_version = {number}; COMMIT;"
+                    )
+            cls._enable_incremental_vacuum(conn)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _enable_incremental_vacuum(conn):
+        # auto_vacuum of an existing database changes only with a full
+        # VACUUM, done once, as older installs were made without it
+        auto_vacuum, = conn.execute("PRAGMA auto_vacuum").fetchone()
+        if auto_vacuum == 2:  # incremental
+            return
+        try:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        except sqlite3.Error:
+            logger.exception("Failed to enable incremental vacuum")
+
+    def _execute_pragma(self, pragma):
+        conn = sqlite3.connect(self._db_path)
+        try:
+            return conn.execute(pragma).fetchall()
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self, write=True):
+        with transaction(self._db_path, write=write) as tx:
+            yield tx
+        if write:
+            self._notify_commit()
+
+    def add_commit_listener(self, listener):
+        """Listener is called after every write transaction commits"""
+        self._commit_listeners.append(listener)
+
+    def _notify_commit(self):
+        for listener in self._commit_listeners:
+            listener()
+
+    def close(self):
+        self.batcher.close()
+
+    def delete_expired_data(self, batch_size=-1, pause=0):
+        for table in (self.ciphergrams, self.ipaddresses, self.changes):
+            while table.delete_expired(self._ttl, batch_size) == batch_size:
+                time.sleep(pause)
+
+    def incremental_vacuum(self, pages=256):
+        # a no-op unless auto_vacuum could be enabled by the migration
+        if self._execute_pragma("PRAGMA auto_vacuum") != [(2, )]:
+            logger.info("Incremental vacuum isn't enabled, skipped")
+            return
+        self._execute_pragma(f"PRAGMA incremental_vacuum({int(pages)})")
+
+    def checkpoint(self):
+        self._execute_pragma("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def analyze(self):
+        conn = sqlite3.connect(self._db_path)
+        try:
+            conn.executescript("PRAGMA analysis_limit = 400; ANALYZE;")
+        finally:
+            conn.close()
@@ -0,0 +1,42 @@
+import json
+
+
+def iter_json(obj):
+    """Encodes obj as JSON piece by piece
+
+    Besides lists and tuples any other iterable, e.g. a generator
+    reading rows from a database cursor, is encoded as an array
+    without being materialized.
+    """
+    if isinstance(obj, dict):
+        yield "{"
+        for i, (key, value) in enumerate(obj.items()):
+            yield f"{', ' if i else ''}{json.dumps(str(key))}: "
+            yield from iter_json(value)
+        yield "}"
+    elif isinstance(obj, (str, int, float, bool)) or obj is None:
+        yield json.dumps(obj)
+    elif isinstance(obj, bytes):
+        yield json.dumps(obj.decode("utf-8"))
+    else:
+        yield "["
+        for i, item in enumerate(obj):
+            if i:
+                yield ", "
+            yield from iter_json(item)
+        yield "]"
+
+
+def iter_chunks(obj, chunk_size=1 << 16):
+    """Encodes obj as UTF-8 JSON in chunks of about chunk_size bytes"""
+    pieces = []
+    size = 0
+    for piece in iter_json(obj):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(pieces).encode("utf-8")
+            pieces = []
+            size = 0
+    if pieces:
+        yield "".join(pieces).encode("utf-8")
@@ -0,0 +1,28 @@
+import queue
+import unittest
+
+from securetalks import batching
+
+
+class TestCollectBatch(unittest.TestCase):
+    def test_max_items(self):
+        items = queue.Queue()
+        for item in range(5):
+            items.put(item)
+        batch = batching.collect_batch(items, 3, 10, lambda item: True)
+        self.assertEqual(batch, [0, 1, 2])
+
+    def test_stops_after_item(self):
+        items = queue.Queue()
+        for item in (1, None, 2):
+            items.put(item)
+        batch = batching.collect_batch(
+            items, 10, 10, lambda item: item is not None
+        )
+        self.assertEqual(batch, [1, None])
+
+    def test_max_delay(self):
+        items = queue.Queue()
+        items.put(1)
+        batch = batching.collect_batch(items, 10, 0.01, lambda item: True)
+        self.assertEqual(batch, [1])
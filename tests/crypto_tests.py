@@ -1,4 +1,8 @@
+import json
 import pprint
+import socket
+import tempfile
+import threading
 import pathlib
 import dataclasses
 import unittest
@@ -36,6 +40,96 @@ class TestMessageCrypto(unittest.TestCase):
         self.assertEqual(plaintext, text)
         self.assertEqual(user_pub_key, self.sender_keys.pub_key_str)
 
+    def test_group_ciphergram(self):
+        text = "This is a message for the group."
+        ciphergram = self.sender_mcrypto.get_group_ciphergram(
+            [self.sender_keys.pub_key_str, self.recver_keys.pub_key_str], text
+        )
+        self.assertEqual(len(ciphergram.cipherkeys), 2)
+
+        for mcrypto in (self.sender_mcrypto, self.recver_mcrypto):
+            user_pub_key, plaintext = mcrypto.get_plaintext(ciphergram)
+            self.assertEqual(plaintext, text)
+            self.assertEqual(user_pub_key, self.sender_keys.pub_key_str)
+
+    def test_group_ciphergram_not_a_recipient(self):
+        ciphergram = self.sender_mcrypto.get_group_ciphergram(
+            [self.sender_keys.pub_key_str], "Text"
+        )
+        with self.assertRaises(crypto.MessageDecryptionError):
+            self.recver_mcrypto.get_plaintext(ciphergram)
+
+    def test_redo_proof(self):
+        ciphergram = self.sender_mcrypto.get_ciphergram(
+            self.recver_keys.pub_key_str, "Text"
+        )
+        redone = self.sender_mcrypto.redo_proof(ciphergram, 8)
+
+        self.assertGreaterEqual(self.sender_mcrypto.get_pow_strength(redone), 8)
+        _, plaintext = self.recver_mcrypto.get_plaintext(redone)
+        self.assertEqual(plaintext, "Text")
+
+    def test_group_ciphergram_hints(self):
+        ciphergram = self.sender_mcrypto.get_group_ciphergram(
+            [self.sender_keys.pub_key_str], "Text"
+        )
+        with patch.object(
+            self.recver_mcrypto, "_decrypt_cipherkey",
+            side_effect=crypto.MessageDecryptionError
+        ) as mock_decrypt:
+            with self.assertRaises(crypto.MessageDecryptionError):
+                self.recver_mcrypto.get_plaintext(ciphergram)
+        mock_decrypt.assert_not_called()
+
+    def test_group_ciphergram_keys_are_signed(self):
+        ciphergram = self.sender_mcrypto.get_group_ciphergram(
+            [self.sender_keys.pub_key_str, self.recver_keys.pub_key_str], "Text"
+        )
+        modified = dataclasses.replace(
+            ciphergram, cipherkeys=ciphergram.cipherkeys[1:]
+        )
+        with self.assertRaises(crypto.MessageVerificationError):
+            self.recver_mcrypto._get_plaintext(modified)
+
+    def test_long_message_is_compressed(self):
+        text = "A long message from sender. " * 2000
+        ct, (ck, ), s, t = self.sender_mcrypto._get_ciphergram(
+            [self.sender_mcrypto._load_recipient_key(
+                self.recver_keys.pub_key_str
+            )],
+            text
+        )
+        self.assertLess(len(ct), len(text))
+
+        user_pub_key, plaintext = self.recver_mcrypto._get_plaintext(
+            crypto.EncryptedMessage(ct, ck, s, 0, t)
+        )
+        self.assertEqual(plaintext, text)
+        self.assertEqual(user_pub_key, self.sender_keys.pub_key_str)
+
+    def test_plaintext_formats(self):
+        key_str = self.sender_keys.pub_key_str
+        for text in ("short", "x" * 1000, "y" * 100000):
+            plaintext = self.sender_mcrypto._encode_plaintext(key_str, text)
+            self.assertEqual(
+                self.recver_mcrypto._decode_plaintext(plaintext),
+                (key_str, text)
+            )
+
+        legacy = json.dumps([key_str, "legacy".encode("utf-8").hex()])
+        self.assertEqual(
+            self.recver_mcrypto._decode_plaintext(legacy.encode("utf-8")),
+            (key_str, "legacy")
+        )
+
+    def test_decompression_cap(self):
+        self.recver_mcrypto.max_plaintext_size = 1000
+        plaintext = self.sender_mcrypto._encode_plaintext(
+            self.sender_keys.pub_key_str, "z" * 2000
+        )
+        with self.assertRaises(ValueError):
+            self.recver_mcrypto._decode_plaintext(plaintext)
+
     def test_invalid_receiver_pub_key(self):
         user_pub_key = self.recver_keys.pub_key_str + "invalid"
 
@@ -101,3 +195,147 @@ class TestMessageCrypto(unittest.TestCase):
 
         with self.assertRaises(crypto.MessageVerificationError):
             self.recver_mcrypto.get_plaintext(ciphergram)
+
+
+class TestEllipticCurveSuite(unittest.TestCase):
+    def setUp(self):
+        self._data_dir = tempfile.TemporaryDirectory()
+        data_dir = pathlib.Path(self._data_dir.name)
+        (data_dir / "sender").mkdir()
+        (data_dir / "receiver").mkdir()
+        self.sender_keys = crypto.KeysProvider(data_dir / "sender", "ec")
+        self.recver_keys = crypto.KeysProvider(data_dir / "receiver", "ec")
+        self.rsa_keys = crypto.KeysProvider(
+            pathlib.Path.cwd() / "tests" / "receiver_keys"
+        )
+        self.sender_mcrypto = crypto.MessageCrypto(self.sender_keys)
+        self.recver_mcrypto = crypto.MessageCrypto(self.recver_keys)
+        self.rsa_mcrypto = crypto.MessageCrypto(self.rsa_keys)
+
+    def tearDown(self):
+        self._data_dir.cleanup()
+
+    def test_compact_node_id(self):
+        key_str = self.sender_keys.pub_key_str
+        self.assertTrue(key_str.startswith(crypto.EC_KEY_PREFIX))
+        self.assertEqual(len(key_str), 4 + 128)
+        self.assertFalse(self.sender_keys.has_keys(crypto.SUITE_RSA))
+
+    def test_keys_are_stored(self):
+        key_str = self.sender_keys.pub_key_str
+        reloaded = crypto.KeysProvider(
+            pathlib.Path(self._data_dir.name) / "sender", "ec"
+        )
+        self.assertEqual(reloaded.pub_key_str, key_str)
+
+    def test_can_decrypt_message(self):
+        ct, cks, s, t = self.sender_mcrypto._get_ciphergram(
+            [self.recver_mcrypto._load_recipient_key(
+                self.recver_keys.pub_key_str
+            )],
+            "Text"
+        )
+        cipherkey, = cks
+        self.assertEqual(len(cipherkey), 2 * crypto.EC_CIPHERKEY_SIZE)
+
+        user_pub_key, plaintext = self.recver_mcrypto._get_plaintext(
+            crypto.EncryptedMessage(ct, cipherkey, s, 0, t)
+        )
+        self.assertEqual(plaintext, "Text")
+        self.assertEqual(user_pub_key, self.sender_keys.pub_key_str)
+
+    def test_wrong_recipient(self):
+        ciphergram = self._get_group_ciphergram([self.recver_keys.pub_key_str])
+        with self.assertRaises(crypto.MessageDecryptionError):
+            self.sender_mcrypto._get_plaintext(ciphergram)
+        with self.assertRaises(crypto.MessageDecryptionError):
+            self.rsa_mcrypto._get_plaintext(ciphergram)
+
+    def test_mixed_suites_group(self):
+        ciphergram = self._get_group_ciphergram(
+            [self.recver_keys.pub_key_str, self.rsa_keys.pub_key_str]
+        )
+        for mcrypto in (self.recver_mcrypto, self.rsa_mcrypto):
+            user_pub_key, plaintext = mcrypto._get_plaintext(ciphergram)
+            self.assertEqual(plaintext, "Group text")
+            self.assertEqual(user_pub_key, self.sender_keys.pub_key_str)
+
+    def test_rsa_sender(self):
+        ct, (ck, ), s, t = self.rsa_mcrypto._get_ciphergram(
+            [self.rsa_mcrypto._load_recipient_key(
+                self.recver_keys.pub_key_str
+            )],
+            "Text"
+        )
+        user_pub_key, plaintext = self.recver_mcrypto._get_plaintext(
+            crypto.EncryptedMessage(ct, ck, s, 0, t)
+        )
+        self.assertEqual(plaintext, "Text")
+        self.assertEqual(user_pub_key, self.rsa_keys.pub_key_str)
+
+    def test_forged_signature(self):
+        ciphergram = self._get_group_ciphergram([self.recver_keys.pub_key_str])
+        signature = bytearray.fromhex(ciphergram.signature)
+        signature[0] ^= 1
+        with self.assertRaises(crypto.MessageVerificationError):
+            self.recver_mcrypto._get_plaintext(
+                dataclasses.replace(ciphergram, signature=signature.hex())
+            )
+
+    def test_invalid_recipient_key(self):
+        with self.assertRaises(crypto.MessageCryptoInvalidRecipientKey):
+            self.sender_mcrypto._load_recipient_key(
+                crypto.EC_KEY_PREFIX + "00" * 10
+            )
+
+    def _get_group_ciphergram(self, user_keys):
+        ct, cks, s, t = self.sender_mcrypto._get_ciphergram(
+            [self.sender_mcrypto._load_recipient_key(key) for key in user_keys],
+            "Group text", hinted=True
+        )
+        return crypto.GroupEncryptedMessage(ct, cks, s, 0, t)
+
+
+class TestCertificateProvider(unittest.TestCase):
+    def setUp(self):
+        self._data_dir = tempfile.TemporaryDirectory()
+        self.data_dir = pathlib.Path(self._data_dir.name)
+
+    def tearDown(self):
+        self._data_dir.cleanup()
+
+    def test_handshake(self):
+        for key_type in crypto.CertificateProvider.key_types:
+            certs = crypto.CertificateProvider(
+                self.data_dir, key_type, crypto.TLSSettings(min_version="1.3")
+            )
+            with self.subTest(key_type=key_type):
+                self.assertEqual(self._handshake(certs), "TLSv1.3")
+
+    def test_certificate_is_kept(self):
+        certs = crypto.CertificateProvider(self.data_dir, "ecdsa")
+        with open(certs.cert_file, "rb") as cert_file:
+            cert = cert_file.read()
+        certs = crypto.CertificateProvider(self.data_dir, "ecdsa")
+        with open(certs.cert_file, "rb") as cert_file:
+            self.assertEqual(cert_file.read(), cert)
+
+    def test_unknown_settings(self):
+        with self.assertRaises(ValueError):
+            crypto.CertificateProvider(self.data_dir, "dsa")
+        with self.assertRaises(ValueError):
+            crypto.TLSSettings(min_version="1.0")
+
+    def _handshake(self, certs):
+        server_sock, client_sock = socket.socketpair()
+        server_ssl = certs.make_server_context().wrap_socket(
+            server_sock, server_side=True, do_handshake_on_connect=False
+        )
+        handshake = threading.Thread(target=server_ssl.do_handshake)
+        handshake.start()
+        client_ssl = certs.make_client_context().wrap_socket(client_sock)
+        handshake.join()
+        version = client_ssl.version()
+        client_ssl.close()
+        server_ssl.close()
+        return version
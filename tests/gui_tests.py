@@ -0,0 +1,123 @@
+import time
+import threading
+import unittest
+from unittest.mock import Mock
+
+from securetalks import gui
+
+
+class TestPushCoalescer(unittest.TestCase):
+    def test_items_are_batched(self):
+        fire = Mock()
+        coalescer = gui.PushCoalescer(fire, max_delay=10)
+        for i in range(3):
+            coalescer.push(i)
+        coalescer.close()
+
+        fire.assert_called_once_with([0, 1, 2])
+
+    def test_max_items(self):
+        fire = Mock()
+        coalescer = gui.PushCoalescer(fire, max_items=2, max_delay=10)
+        for i in range(5):
+            coalescer.push(i)
+        coalescer.close()
+
+        batches = [args[0] for args, _ in fire.call_args_list]
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    def test_max_delay(self):
+        fired = threading.Event()
+        coalescer = gui.PushCoalescer(lambda items: fired.set(), max_delay=0)
+        coalescer.push(1)
+        self.assertTrue(fired.wait(5))
+        coalescer.close()
+
+    def test_slow_fire_doesnt_block_push(self):
+        release = threading.Event()
+        coalescer = gui.PushCoalescer(
+            lambda items: release.wait(5), max_delay=0
+        )
+        started = time.monotonic()
+        for i in range(100):
+            coalescer.push(i)
+        self.assertLess(time.monotonic() - started, 1)
+        release.set()
+        coalescer.close()
+
+
+class TestHandlerPool(unittest.TestCase):
+    def test_lane_keeps_order(self):
+        pool = gui.HandlerPool(max_workers=4, limits=dict(write=1))
+        results = []
+        for i in range(20):
+            pool.submit("write", results.append, i)
+        pool.shutdown()
+
+        self.assertEqual(results, list(range(20)))
+
+    def test_lanes_run_in_parallel(self):
+        pool = gui.HandlerPool(max_workers=2, limits=dict(slow=1))
+        release = threading.Event()
+        done = threading.Event()
+        pool.submit("slow", release.wait, 5)
+        pool.submit("fast", done.set)
+
+        self.assertTrue(done.wait(5))
+        release.set()
+        pool.shutdown()
+
+    def test_lane_limit(self):
+        pool = gui.HandlerPool(max_workers=4, limits=dict(read=2))
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def handler():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        for _ in range(8):
+            pool.submit("read", handler)
+        pool.shutdown()
+
+        self.assertEqual(max(peak), 2)
+
+    def test_failing_handler(self):
+        pool = gui.HandlerPool(max_workers=1, limits=dict(write=1))
+        results = []
+        pool.submit("write", int, "not a number")
+        pool.submit("write", results.append, 1)
+        pool.shutdown()
+
+        self.assertEqual(results, [1])
+
+
+class TestWebeventsGUI(unittest.TestCase):
+    def setUp(self):
+        # handlers are tested without starting the web server
+        self.gui = gui.WebeventsGUI.__new__(gui.WebeventsGUI)
+        self.gui.presentor_obj = Mock()
+        self.gui.presentor_obj.search_messages.return_value = []
+
+    def test_search_messages_string(self):
+        result = self.gui._search_messages("hello")
+        self.assertEqual(result, dict(query="hello", messages=[]))
+        self.gui.presentor_obj.search_messages.assert_called_once_with(
+            "hello", limit=20
+        )
+
+    def test_search_messages_with_limit(self):
+        self.gui._search_messages(["hello world", 5])
+        self.gui.presentor_obj.search_messages.assert_called_once_with(
+            "hello world", limit=5
+        )
+
+    def test_search_messages_invalid(self):
+        for data in (None, ["hello"], ["hello", 5, 0], [1, 5]):
+            with self.assertRaises(ValueError):
+                self.gui._search_messages(data)
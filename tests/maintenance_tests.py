@@ -0,0 +1,37 @@
+import time
+import sqlite3
+import unittest
+from unittest.mock import Mock
+
+from securetalks import maintenance
+
+
+class TestMaintenance(unittest.TestCase):
+    def test_runs_tasks_periodically(self):
+        storage = Mock()
+        maintenance_obj = maintenance.Maintenance(
+            storage, expiry_interval=0.01, vacuum_interval=0,
+            checkpoint_interval=0.01, analyze_interval=0
+        )
+        maintenance_obj.start()
+        time.sleep(0.1)
+        maintenance_obj.stop()
+
+        self.assertGreater(storage.delete_expired_data.call_count, 1)
+        self.assertGreater(storage.checkpoint.call_count, 1)
+        storage.incremental_vacuum.assert_not_called()
+        storage.analyze.assert_not_called()
+
+    def test_survives_database_errors(self):
+        storage = Mock()
+        storage.checkpoint.side_effect = sqlite3.OperationalError("locked")
+        storage.checkpoint.__name__ = "checkpoint"
+        maintenance_obj = maintenance.Maintenance(
+            storage, expiry_interval=0, vacuum_interval=0,
+            checkpoint_interval=0.01, analyze_interval=0
+        )
+        maintenance_obj.start()
+        time.sleep(0.05)
+        maintenance_obj.stop()
+
+        self.assertGreater(storage.checkpoint.call_count, 1)
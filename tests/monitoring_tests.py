@@ -0,0 +1,85 @@
+import json
+import unittest
+import urllib.request
+import multiprocessing
+
+from securetalks import monitoring
+
+
+def _count_in_child(metrics):
+    metrics.count("bytes_received", 100)
+    metrics.observe("parse", 0.002)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = monitoring.Metrics()
+
+    def test_histogram(self):
+        for seconds in (0.0001, 0.003, 0.003, 10):
+            self.metrics.observe("decrypt", seconds)
+
+        histogram = self.metrics.snapshot()["histograms"]["decrypt"]
+        self.assertEqual(histogram["count"], 4)
+        self.assertAlmostEqual(histogram["sum"], 10.0061)
+        self.assertEqual(histogram["buckets"]["0.0001"], 1)
+        self.assertEqual(histogram["buckets"]["0.001"], 1)
+        self.assertEqual(histogram["buckets"]["0.005"], 3)
+        self.assertEqual(histogram["buckets"]["5"], 3)
+        self.assertEqual(histogram["buckets"]["+Inf"], 4)
+
+    def test_child_processes_add_up(self):
+        self.metrics.count("bytes_received", 5)
+        child = multiprocessing.Process(
+            target=_count_in_child, args=(self.metrics, )
+        )
+        child.start()
+        child.join()
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["bytes_received"], 105)
+        self.assertEqual(snapshot["histograms"]["parse"]["count"], 1)
+
+    def test_gauges_and_duplicate_rate(self):
+        self.metrics.add_gauge("receiver_queue", lambda: 7)
+        self.metrics.count("messages_stored", 3)
+        self.metrics.count("ciphergrams_duplicate")
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["gauges"], dict(receiver_queue=7))
+        self.assertEqual(snapshot["duplicate_rate"], 0.25)
+
+    def test_render_text(self):
+        self.metrics.count("bytes_sent", 42)
+        self.metrics.observe("store", 0.02)
+        text = self.metrics.render_text()
+
+        self.assertIn("securetalks_bytes_sent_total 42\n", text)
+        self.assertIn('securetalks_store_seconds_bucket{le="0.05"} 1\n', text)
+        self.assertIn("securetalks_store_seconds_count 1\n", text)
+        self.assertIn("securetalks_duplicate_rate 0\n", text)
+
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        self.metrics = monitoring.Metrics()
+        self.server = monitoring.MetricsServer(self.metrics, 0)
+        self.server.start()
+        self.url = f"http://localhost:{self.server.port}"
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_serves_metrics(self):
+        self.metrics.count("connections_accepted", 2)
+        with urllib.request.urlopen(self.url + "/metrics") as response:
+            text = response.read().decode("utf-8")
+        with urllib.request.urlopen(self.url + "/metrics.json") as response:
+            snapshot = json.loads(response.read())
+
+        self.assertIn("securetalks_connections_accepted_total 2\n", text)
+        self.assertEqual(snapshot["counters"]["connections_accepted"], 2)
+
+    def test_unknown_path(self):
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(self.url + "/secret")
@@ -5,6 +5,7 @@ from unittest.mock import Mock
 
 from . import testing_utils
 
+from securetalks import orm
 from securetalks import presentor
 from securetalks import storage
 
@@ -15,13 +16,14 @@ class TestPresentor(unittest.TestCase):
         self.presentor = presentor.Presentor(Mock(), Mock(), self.storage)
 
     def tearDown(self):
+        self.storage.close()
         pathlib.Path(self.db_name).unlink()
 
     def test_get_dialogs(self):
         dialogs = self.presentor.get_dialogs()
         
         self.assertEqual(len(dialogs), 3)
-        self.assertEqual(dialogs[0]["node_id"], "c")
+        self.assertEqual(dialogs[0]["node_id"], testing_utils.node_id("c"))
         self.assertEqual(dialogs[0]["last_activity"], 3000)
         self.assertEqual(dialogs[0]["unread_count"], 2)
         self.assertEqual(dialogs[0]["alias"], "Steve Jobs")
@@ -29,8 +31,165 @@ class TestPresentor(unittest.TestCase):
         self.assertEqual(
             dialogs[0]["messages"][0],
             dict(
-                node_id="c", to_me=False, sender_timestamp=1000,
+                node_id=testing_utils.node_id("c"), to_me=False, sender_timestamp=1000,
                 text="message1 c from me", timestamp=1000,
                 last_activity=3000, unread_count=2, alias="Steve Jobs"
             )
         )
+
+    def _read_dialogs(self):
+        with self.storage.transaction(write=False) as tx:
+            return self.presentor._get_dialogs(tx)
+
+    def test_dialogs_cache(self):
+        self.presentor.get_dialogs()
+        dialogs = self.presentor.get_dialogs()
+        self.assertEqual(self.presentor.dialogs.stats["misses"], 1)
+        self.assertEqual(self.presentor.dialogs.stats["hits"], 1)
+        self.assertEqual(dialogs, self._read_dialogs())
+
+        node_id = testing_utils.node_id("b")
+        self.presentor.send_message(node_id, "new text")
+        self.presentor.change_node_alias(node_id, "Bob")
+        self.presentor.delete_dialog(testing_utils.node_id("a"))
+        self.storage.batcher.add_received_message(
+            orm.Message(orm.fingerprint("d"), "hi", True), "d"
+        )
+        self.storage.batcher.flush()
+
+        dialogs = self.presentor.get_dialogs()
+        self.assertEqual(self.presentor.dialogs.stats["updates"], 1)
+        self.assertEqual(dialogs, self._read_dialogs())
+
+    def test_dialogs_cache_tail(self):
+        self.presentor.dialogs.tail_size = 2
+        node_id = testing_utils.node_id("c")
+        self.presentor.get_dialogs()
+        self.presentor.send_message(node_id, "new text")
+
+        dialog, *_ = self.presentor.get_dialogs()
+        self.assertEqual(
+            [message["text"] for message in dialog["messages"]],
+            ["message3 c to me", "new text"]
+        )
+
+    def test_dialogs_full_history(self):
+        node_id = testing_utils.node_id("c")
+        dialogs = self.presentor.get_dialogs()
+        reset = self.presentor.get_changes_since(0)["dialogs"]
+
+        dialog, = [
+            dialog for dialog in dialogs if dialog["node_id"] == node_id
+        ]
+        self.assertEqual(len(dialog["messages"]), 3)
+        self.assertEqual(
+            sorted(dialogs, key=lambda dialog: dialog["node_id"]),
+            sorted(reset, key=lambda dialog: dialog["node_id"])
+        )
+
+    def test_get_older_messages(self):
+        self.presentor.dialogs.tail_size = 2
+        node_id = testing_utils.node_id("c")
+        dialog, *_ = self.presentor.get_dialogs()
+        older = self.presentor.get_older_messages(
+            node_id, len(dialog["messages"])
+        )
+
+        self.assertEqual(
+            [message["text"] for message in older], ["message1 c from me"]
+        )
+        self.assertEqual(older[0]["alias"], "Steve Jobs")
+        self.assertEqual(self.presentor.get_older_messages("unknown", 0), [])
+
+    def test_dialogs_cache_gauges(self):
+        self.presentor.get_dialogs()
+        self.presentor.get_dialogs()
+        gauges = self.presentor.metrics.snapshot()["gauges"]
+        self.assertEqual(gauges["dialogs_cache_hits"], 1)
+        self.assertEqual(gauges["dialogs_cache_misses"], 1)
+
+    def test_search_messages(self):
+        messages = self.presentor.search_messages(
+            "message1", testing_utils.node_id("c")
+        )
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["text"], "message1 c from me")
+        self.assertEqual(messages[0]["alias"], "Steve Jobs")
+
+    def test_get_changes_since(self):
+        changes = self.presentor.get_changes_since(0)
+        self.assertTrue(changes["reset"])
+        self.assertEqual(len(changes["dialogs"]), 3)
+
+        node_id = testing_utils.node_id("c")
+        self.presentor.send_message(node_id, "new text")
+        self.presentor.make_dialog_read(node_id)
+        changes = self.presentor.get_changes_since(changes["version"])
+
+        self.assertFalse(changes["reset"])
+        self.assertEqual(len(changes["dialogs"]), 1)
+        self.assertEqual(changes["dialogs"][0]["unread_count"], 0)
+        self.assertEqual(len(changes["messages"]), 1)
+        self.assertEqual(changes["messages"][0]["text"], "new text")
+        self.assertEqual(changes["deleted"], [])
+
+        self.presentor.delete_dialog(node_id)
+        changes = self.presentor.get_changes_since(changes["version"])
+        self.assertEqual(changes["dialogs"], [])
+        self.assertEqual(changes["deleted"], [node_id])
+
+    def test_get_changes_since_expired_journal(self):
+        self.presentor.make_dialog_read(testing_utils.node_id("c"))
+        version = self.presentor.get_changes_since(0)["version"]
+        self.presentor.make_dialog_read(testing_utils.node_id("b"))
+        self.storage.changes.delete_expired(-10)
+
+        changes = self.presentor.get_changes_since(version)
+        self.assertTrue(changes["reset"])
+
+    def test_change_node_alias(self):
+        node_id = testing_utils.node_id("c")
+        self.presentor.change_node_alias(node_id, "Steve")
+        node = self.storage.nodes.get_node_by_id(node_id)
+
+        self.assertEqual(node.alias, "Steve")
+        self.assertEqual(node.unread_count, 2)
+
+    def test_delete_dialog(self):
+        node = orm.Node(testing_utils.node_id("c"))
+        self.presentor.delete_dialog(node.node_id)
+
+        self.assertFalse(self.storage.nodes.check_node_exists(node))
+        self.assertEqual(self.storage.messages.get_messages(node), [])
+        with self.assertRaises(orm.KeyNotFoundError):
+            self.storage.keys.get_key(node.node_id)
+
+    def test_add_dialog_and_send_message(self):
+        self.presentor.add_dialog("full key", "Alias")
+        node_id = orm.fingerprint("full key")
+        self.presentor.send_message(node_id, "text", "id1")
+
+        self.assertEqual(self.storage.nodes.get_node_by_id(node_id).alias, "Alias")
+        self.presentor.sender.send_message_to.assert_called_with(
+            "full key", "text", "id1"
+        )
+
+    def test_send_group_message(self):
+        self.presentor.add_dialog("key 1")
+        self.presentor.add_dialog("key 2")
+        node_ids = [orm.fingerprint("key 1"), orm.fingerprint("key 2")]
+        self.presentor.send_group_message(
+            node_ids + ["unknown"], "group text", "id1"
+        )
+
+        self.presentor.sender.send_group_message_to.assert_called_once_with(
+            ["key 1", "key 2"], "group text", "id1"
+        )
+        for node_id in node_ids:
+            message, = self.storage.messages.get_messages(orm.Node(node_id))
+            self.assertEqual(message.text, "group text")
+            self.assertFalse(message.to_me)
+
+    def test_send_message_unknown_node(self):
+        self.presentor.send_message("unknown", "text")
+        self.presentor.sender.send_message_to.assert_not_called()
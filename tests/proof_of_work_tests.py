@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import patch
+import multiprocessing
+
+from securetalks import proof_of_work
+
+
+class TestVerifyMany(unittest.TestCase):
+    def setUp(self):
+        self.batch = []
+        for i in range(20):
+            bmessage = f"message {i}".encode("utf-8")
+            proof = proof_of_work.compute_pow(bmessage)
+            self.batch.append((bmessage, proof if i % 3 else proof + 1))
+        self.expected = [
+            proof_of_work.check_pow_valid(bmessage, proof)
+            for bmessage, proof in self.batch
+        ]
+
+    def test_serial(self):
+        self.assertEqual(proof_of_work.verify_many(self.batch), self.expected)
+        self.assertIn(False, self.expected)
+
+    def test_pool(self):
+        with multiprocessing.Pool(2) as pool:
+            self.assertEqual(
+                proof_of_work.verify_many(self.batch, pool), self.expected
+            )
+
+    def test_empty(self):
+        self.assertEqual(proof_of_work.verify_many([]), [])
+
+
+@patch("securetalks.proof_of_work.time.monotonic")
+class TestPowPolicy(unittest.TestCase):
+    def test_difficulty_follows_load(self, mock_time):
+        mock_time.return_value = 100
+        policy = proof_of_work.PowPolicy(
+            normal_rate=10, max_difficulty=8, window=10
+        )
+        for _ in range(350):
+            policy.record_message()
+        mock_time.return_value = 110
+        policy.record_message()
+        self.assertEqual(policy.difficulty, 4)
+
+        for _ in range(10000):
+            policy.record_message()
+        mock_time.return_value = 120
+        policy.record_message()
+        self.assertEqual(policy.difficulty, 8)
+
+        mock_time.return_value = 200
+        policy.record_message()
+        self.assertEqual(policy.difficulty, 1)
+
+    def test_check(self, mock_time):
+        mock_time.return_value = 100
+        policy = proof_of_work.PowPolicy()
+        bmessage = b"hello, folks!"
+        proof = proof_of_work.compute_pow(bmessage, difficulty=8)
+
+        self.assertGreaterEqual(
+            proof_of_work.compute_strength(bmessage, proof), 8
+        )
+        policy._difficulty.value = 8
+        self.assertTrue(policy.check(bmessage, proof))
+        policy._difficulty.value = 1 << 40
+        self.assertFalse(policy.check(bmessage, proof))
@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import patch
+
+from securetalks import ratelimit
+
+
+@patch("securetalks.ratelimit.time.monotonic")
+class TestTokenBucket(unittest.TestCase):
+    def test_consume_until_empty(self, mock_time):
+        mock_time.return_value = 100
+        bucket = ratelimit.TokenBucket(rate=1, burst=2)
+
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_refill(self, mock_time):
+        mock_time.return_value = 100
+        bucket = ratelimit.TokenBucket(rate=1, burst=2)
+        bucket.consume(2)
+
+        mock_time.return_value = 101
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_large_request_makes_debt(self, mock_time):
+        mock_time.return_value = 100
+        bucket = ratelimit.TokenBucket(rate=10, burst=10)
+
+        self.assertTrue(bucket.consume(30))
+        mock_time.return_value = 102
+        self.assertFalse(bucket.consume(1))
+        mock_time.return_value = 103
+        self.assertTrue(bucket.consume(1))
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def test_connections_rate_is_per_peer(self):
+        admission = ratelimit.AdmissionControl(connections_rate=1)
+        results = [admission.admit_connection("1.1.1.1") for _ in range(5)]
+
+        self.assertEqual(results, [True] * 4 + [False])
+        self.assertTrue(admission.admit_connection("2.2.2.2"))
+        self.assertEqual(admission.counters["rejected_connections"], 1)
+        self.assertEqual(admission.counters["accepted"], 5)
+
+    def test_max_connections(self):
+        admission = ratelimit.AdmissionControl(max_connections=1)
+        self.assertTrue(admission.admit_connection("1.1.1.1"))
+        self.assertFalse(admission.admit_connection("2.2.2.2"))
+
+        admission.release_connection()
+        self.assertTrue(admission.admit_connection("2.2.2.2"))
+        self.assertEqual(admission.counters["rejected_concurrency"], 1)
+
+    def test_admit_frame(self):
+        admission = ratelimit.AdmissionControl(
+            messages_rate=100, bytes_rate=100
+        )
+        self.assertTrue(admission.admit_frame("1.1.1.1", 400))
+        self.assertFalse(admission.admit_frame("1.1.1.1", 400))
+        self.assertTrue(admission.admit_frame("2.2.2.2", 400))
+        self.assertEqual(admission.counters["rejected_bytes"], 1)
+
+    def test_rejected_frame_keeps_tokens(self):
+        admission = ratelimit.AdmissionControl(
+            messages_rate=1, bytes_rate=100
+        )
+        admission.admit_frame("1.1.1.1", 400)
+        for _ in range(10):
+            self.assertFalse(admission.admit_frame("1.1.1.1", 400))
+        peer = admission._peers["1.1.1.1"]
+        self.assertGreaterEqual(peer.messages.tokens, 3)
+
+    def test_forget_idle_peers(self):
+        admission = ratelimit.AdmissionControl(
+            max_peers=2, peer_idle_timeout=0
+        )
+        for ip in ("1.1.1.1", "2.2.2.2", "3.3.3.3"):
+            admission.admit_frame(ip, 1)
+        self.assertEqual(list(admission._peers), ["3.3.3.3"])
@@ -1,15 +1,23 @@
 import time
 import json
+import queue
 import pprint
+import socket
 import pathlib
+import tempfile
+import threading
 import dataclasses
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, MagicMock, patch
 
 from . import testing_utils
 
 from securetalks import crypto
 from securetalks import receiver
+from securetalks import ratelimit
+from securetalks import monitoring
+from securetalks import snakesockets
+from securetalks import proof_of_work
 
 
 @patch("securetalks.receiver.LowLevelReceiver")
@@ -53,6 +61,65 @@ class TestReceiver(unittest.TestCase):
                 mock_sc.assert_called()
                 mock_sm.assert_not_called()
 
+    def test_handle_group_ciphergram(self, llr_mock):
+        ciphergram = self.sender_mcrypto.get_group_ciphergram(
+            [self.sender_keys.pub_key_str, self.recver_keys.pub_key_str],
+            "Message for the group"
+        )
+        message = dict(
+            type="ciphergram", server_port=8001,
+            **dataclasses.asdict(ciphergram)
+        )
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.recver_mcrypto, Mock(), Mock(), Mock()
+        )
+        with patch.object(self.receiver, "_store_as_message") as mock_sm:
+            self.receiver._handle_ciphergram_message("1.1.1.1", message)
+            mock_sm.assert_called_once_with(
+                self.sender_keys.pub_key_str, "Message for the group",
+                ciphergram.timestamp
+            )
+
+    def test_parse_group_ciphergram_too_large(self, llr_mock):
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.recver_mcrypto, Mock(), Mock(), Mock()
+        )
+        message = dict(
+            self.message, cipherkeys=["00"] * (self.receiver.max_group_size + 1)
+        )
+        del message["cipherkey"]
+        with self.assertRaises(receiver.MessageParsingError):
+            self.receiver._parse_ciphergram(json.dumps(message))
+
+    def test_parse_ciphergram_malformed_fields(self, llr_mock):
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.recver_mcrypto, Mock(), Mock(), Mock()
+        )
+        for field, value in [
+            ("timestamp", "x"), ("timestamp", True), ("timestamp", -1),
+            ("proof", 1.5), ("proof", -1), ("signature", 7),
+        ]:
+            message = dict(self.message, **{field: value})
+            with self.assertRaises(receiver.MessageParsingError):
+                self.receiver._parse_ciphergram(json.dumps(message))
+
+    def test_malformed_timestamp_doesnt_stop_receiving(self, llr_mock):
+        frames = queue.Queue()
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.recver_mcrypto, Mock(), frames, Mock()
+        )
+        malformed = dict(self.message, timestamp="x")
+        for message in (malformed, self.message, self.message):
+            frames.put((Mock(), json.dumps(message).encode("utf-8")))
+        frames.put((None, None))
+        # an unexpected error is logged and the next message still handled
+        with patch.object(
+            self.receiver, "_handle_ciphergram",
+            side_effect=[RuntimeError, None]
+        ) as mock_hc:
+            self.receiver.run()
+            self.assertEqual(mock_hc.call_count, 2)
+
     def test_handle_ciphergram_dont_store_crypto_error(self, llr_mock):
         message = self.message.copy()
         message["proof"] = 1
@@ -82,4 +149,139 @@ class TestReceiver(unittest.TestCase):
 
                     mock_time.assert_called()
                     mock_sc.assert_not_called()
-                    mock_sm.assert_not_called()
\ No newline at end of file
+                    mock_sm.assert_not_called()
+
+    def test_offline_batch_checks_pow_first(self, llr_mock):
+        invalid = dict(self.message, proof=self.message["proof"] + 1)
+        response = dict(
+            type="response_offline_data", server_port=8001,
+            ciphergrams=[
+                dict(content=json.dumps(content), timestamp=0)
+                for content in (self.message, invalid, "not a ciphergram")
+            ]
+        )
+        sender_mock = Mock()
+        sender_mock.offline_requested = ["1.1.1.1"]
+        self.receiver = receiver.Receiver(
+            Mock(), sender_mock, Mock(), self.recver_mcrypto,
+            Mock(), Mock(), Mock()
+        )
+        with patch.object(
+            self.recver_mcrypto, "verify_pow_many",
+            wraps=self.recver_mcrypto.verify_pow_many
+        ) as mock_verify:
+            with patch.object(self.receiver, "_store_as_message") as mock_sm:
+                self.receiver._handle_response_offline_message(
+                    "1.1.1.1", response
+                )
+                mock_verify.assert_called_once()
+                mock_sm.assert_called_once()
+                self.assertIsNone(self.receiver._pow_pool)
+
+    def test_request_offline_data_chunked(self, llr_mock):
+        sender_mock = Mock()
+        self.receiver = receiver.Receiver(
+            Mock(), sender_mock, MagicMock(), self.recver_mcrypto,
+            Mock(), Mock(), Mock()
+        )
+        address = Mock()
+        self.receiver._handle_request_offline_message(
+            address, dict(since=900, chunked=True)
+        )
+        self.receiver._handle_request_offline_message(address, dict())
+
+        self.assertEqual(
+            sender_mock.respond_offline_data.call_args_list,
+            [((address, 900, True), ), ((address, None, False), )]
+        )
+
+    def test_check_pow(self, llr_mock):
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.sender_mcrypto,
+            Mock(), Mock(), Mock()
+        )
+        frame = json.dumps(self.message).encode("utf-8")
+        request = b'{"type": "request_offline_data", "server_port": 8001}'
+        self.assertTrue(self.receiver._check_pow(frame))
+
+        self.receiver.pow_policy._difficulty.value = 1 << 40
+        self.assertFalse(self.receiver._check_pow(frame))
+        self.assertTrue(self.receiver._check_pow(request))
+        self.assertTrue(self.receiver._check_pow(b"garbage"))
+        oversized = dict(self.message, proof=1 << 64)
+        self.assertTrue(
+            self.receiver._check_pow(json.dumps(oversized).encode("utf-8"))
+        )
+
+    def test_admission_counters_are_gauges(self, llr_mock):
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.recver_mcrypto, Mock(), Mock(),
+            Mock(), ratelimit.AdmissionControl(bytes_rate=10)
+        )
+        for _ in range(2):
+            self.receiver.admission.admit_frame("1.1.1.1", 100)
+
+        gauges = self.receiver.metrics.snapshot()["gauges"]
+        self.assertEqual(gauges["admission_rejected_bytes"], 1)
+        self.assertEqual(gauges["admission_rejected_messages"], 0)
+
+    def test_check_pow_skips_offline_responses(self, llr_mock):
+        self.receiver = receiver.Receiver(
+            Mock(), Mock(), Mock(), self.sender_mcrypto,
+            Mock(), Mock(), Mock()
+        )
+        self.receiver.pow_policy._difficulty.value = 1 << 40
+        response = json.dumps(dict(
+            type="response_offline_data", server_port=8001,
+            ciphergrams=[dict(content=json.dumps(self.message), timestamp=0)]
+        )).encode("utf-8")
+        with patch.object(self.receiver, "_parse_ciphergram") as mock_parse:
+            self.assertTrue(self.receiver._check_pow(response))
+            mock_parse.assert_not_called()
+
+
+class TestLowLevelReceiver(unittest.TestCase):
+    def test_weak_frame_is_refused(self):
+        frames = Mock()
+        admission = ratelimit.AdmissionControl()
+        llreceiver = receiver.LowLevelReceiver(
+            Mock(), frames, ("127.0.0.1", 0), admission,
+            proof_of_work.PowPolicy(), monitoring.Metrics(),
+            check_frame=lambda frame: False
+        )
+        client_socket = Mock()
+        client_socket.recv.return_value = b"frame"
+        admission.admit_connection("1.1.1.1")
+        llreceiver._worker(client_socket, ("1.1.1.1", 8001))
+
+        frames.put.assert_not_called()
+        reply = json.loads(client_socket.send.call_args[0][0])
+        self.assertEqual(reply, dict(pow_difficulty=1, accepted=False))
+
+    def test_silent_peer_doesnt_block_others(self):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            address = probe.getsockname()
+        frames = queue.Queue()
+        with tempfile.TemporaryDirectory() as data_dir:
+            certs = crypto.CertificateProvider(pathlib.Path(data_dir), "ecdsa")
+            llreceiver = receiver.LowLevelReceiver(
+                certs, frames, address, ratelimit.AdmissionControl(),
+                proof_of_work.PowPolicy(), monitoring.Metrics()
+            )
+            threading.Thread(target=llreceiver.run, daemon=True).start()
+            time.sleep(0.5)
+
+            silent = socket.create_connection(address)
+            client = snakesockets.TCP()
+            client.sock = certs.make_client_context().wrap_socket(client.sock)
+            client.sock.settimeout(10)
+            client.connect(address)
+            client.send(b"hello")
+            reply = json.loads(client.recv())
+            client.close()
+            silent.close()
+
+        ipaddress, frame = frames.get(timeout=10)
+        self.assertEqual(frame, b"hello")
+        self.assertEqual(reply["pow_difficulty"], 1)
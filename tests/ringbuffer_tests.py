@@ -0,0 +1,59 @@
+import threading
+import unittest
+
+from securetalks import orm
+from securetalks import ringbuffer
+
+
+class TestRingBuffer(unittest.TestCase):
+    def setUp(self):
+        self.ring = ringbuffer.RingBuffer(256)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_put_get(self):
+        self.ring.put((orm.IPAddress("1.1.1.1", 8080), b"message"))
+        address, frame = self.ring.get()
+
+        self.assertEqual(address, orm.IPAddress("1.1.1.1", 8080))
+        self.assertIsInstance(frame, memoryview)
+        self.assertEqual(bytes(frame), b"message")
+
+    def test_ipv6_address(self):
+        self.ring.put((orm.IPAddress("::1", 8080), b"message"))
+        address, frame = self.ring.get()
+        self.assertEqual(address.address, "::1")
+
+    def test_wraps_around(self):
+        for i in range(50):
+            frame = str(i).encode("utf-8") * 10
+            self.ring.put((orm.IPAddress("1.1.1.1", i), frame))
+            address, received = self.ring.get()
+
+            self.assertEqual(address.port, i)
+            self.assertEqual(bytes(received), frame)
+
+    def test_large_frame_and_stop_message(self):
+        self.ring.put((orm.IPAddress("1.1.1.1", 8080), b"x" * 1000))
+        self.ring.put([None, None])
+
+        address, frame = self.ring.get()
+        self.assertEqual(bytes(frame), b"x" * 1000)
+        self.assertEqual(self.ring.get(), [None, None])
+
+    def test_backpressure_when_full(self):
+        frame = b"x" * 100
+        self.ring.put((orm.IPAddress("1.1.1.1", 1), frame))
+        self.ring.put((orm.IPAddress("1.1.1.1", 2), frame))
+        producer = threading.Thread(
+            target=self.ring.put, args=((orm.IPAddress("1.1.1.1", 3), frame),)
+        )
+        producer.start()
+        producer.join(timeout=0.2)
+        self.assertTrue(producer.is_alive())
+
+        ports = [self.ring.get()[0].port for _ in range(3)]
+        producer.join(timeout=1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(ports, [1, 2, 3])
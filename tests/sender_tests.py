@@ -0,0 +1,330 @@
+import json
+import time
+import pathlib
+import tempfile
+import unittest
+import threading
+from unittest.mock import Mock, patch
+
+from securetalks import orm
+from securetalks import crypto
+from securetalks import sender
+from securetalks import streaming
+from securetalks import snakesockets
+
+
+class TestPriorityQueue(unittest.TestCase):
+    def test_get_in_priority_order(self):
+        queue = sender.PriorityQueue()
+        queue.put("bulk", sender.BULK)
+        queue.put("relay", sender.RELAY)
+        queue.put("interactive", sender.INTERACTIVE)
+
+        self.assertEqual(queue.get(), "interactive")
+        self.assertEqual(queue.get(), "relay")
+        self.assertEqual(queue.get(), "bulk")
+
+    def test_fifo_within_priority(self):
+        queue = sender.PriorityQueue()
+        queue.put("relay1", sender.RELAY)
+        queue.put("relay2", sender.RELAY)
+
+        self.assertEqual(queue.get(), "relay1")
+        self.assertEqual(queue.get(), "relay2")
+
+    def test_drop_relays_when_full(self):
+        queue = sender.PriorityQueue(maxsizes=(0, 1, 1))
+        self.assertTrue(queue.put("relay1", sender.RELAY))
+        self.assertFalse(queue.put("relay2", sender.RELAY))
+        self.assertEqual(queue.dropped, [0, 1, 0])
+
+        self.assertEqual(queue.get(), "relay1")
+        self.assertTrue(queue.put("relay3", sender.RELAY))
+
+    def test_sizes(self):
+        queue = sender.PriorityQueue()
+        queue.put("bulk", sender.BULK)
+        queue.put("relay", sender.RELAY)
+        queue.put("interactive", sender.INTERACTIVE)
+        queue.get()
+
+        self.assertEqual(queue.sizes, [0, 1, 1])
+
+
+@patch("securetalks.sender.LowLevelSender")
+class TestSender(unittest.TestCase):
+    def setUp(self):
+        self.storage = Mock()
+        self.storage.ipaddresses.list_all.return_value = [
+            orm.IPAddress("1.1.1.1", 8080), orm.IPAddress("2.2.2.2", 8081)
+        ]
+        self.queue = Mock()
+
+    def test_send_message_is_interactive(self, lls_mock):
+        sender_obj = sender.Sender(Mock(), Mock(), self.storage, 8001, self.queue)
+        sender_obj.send_message_to("key", "text", "id1")
+        sender_obj.terminate()
+
+        item, priority = self.queue.put.call_args_list[0][0]
+        self.assertEqual(priority, sender.INTERACTIVE)
+        self.assertEqual(item[1:], ("text", "key", "id1"))
+
+    def test_broadcast_from_is_relay(self, lls_mock):
+        sender_obj = sender.Sender(Mock(), Mock(), self.storage, 8001, self.queue)
+        sender_obj.broadcast_from("message", orm.IPAddress("1.1.1.1", 8080))
+        sender_obj.terminate()
+
+        item, priority = self.queue.put.call_args_list[0][0]
+        self.assertEqual(priority, sender.RELAY)
+        self.assertEqual(item[0], [orm.IPAddress("2.2.2.2", 8081)])
+
+    def test_offline_response_is_bulk(self, lls_mock):
+        self.storage.ciphergrams.get_latest_timestamp.return_value = None
+        sender_obj = sender.Sender(Mock(), Mock(), self.storage, 8001, self.queue)
+        sender_obj.request_offline_data()
+        sender_obj.respond_offline_data(orm.IPAddress("1.1.1.1", 8080))
+        sender_obj.terminate()
+
+        priorities = [args[-1] for args, _ in self.queue.put.call_args_list]
+        self.assertEqual(priorities[:2], [sender.INTERACTIVE, sender.BULK])
+
+    def test_request_offline_data_since(self, lls_mock):
+        self.storage.ciphergrams.get_latest_timestamp.return_value = 5000
+        sender_obj = sender.Sender(Mock(), Mock(), self.storage, 8001, self.queue)
+        sender_obj.offline_overlap = 1000
+        sender_obj.request_offline_data()
+        sender_obj.respond_offline_data(orm.IPAddress("1.1.1.1", 8080), 4000)
+        sender_obj.terminate()
+
+        (request, _), (response, _) = [
+            args for args, _ in self.queue.put.call_args_list[:2]
+        ]
+        self.assertEqual(json.loads(request[1])["since"], 4000)
+        self.assertTrue(json.loads(request[1])["chunked"])
+        self.assertEqual(response[1], sender.OfflineData(4000))
+
+    def test_group_message_is_interactive(self, lls_mock):
+        sender_obj = sender.Sender(Mock(), Mock(), self.storage, 8001, self.queue)
+        sender_obj.send_group_message_to(["key1", "key2"], "text", "id1")
+        sender_obj.terminate()
+
+        item, priority = self.queue.put.call_args_list[0][0]
+        self.assertEqual(priority, sender.INTERACTIVE)
+        self.assertEqual(item[1:], ("text", ("key1", "key2"), "id1"))
+
+    def test_group_wire_format(self, lls_mock):
+        ciphergram = orm.Ciphergram(
+            b"\x01", orm.pack_cipherkeys([b"\x02", b"\x04\x05"]), b"\x03",
+            7, 1000, multikey=True
+        )
+        wire = json.loads(sender.get_wire_ciphergram(ciphergram, 8001))
+
+        self.assertEqual(wire["cipherkeys"], ["02", "0405"])
+        self.assertNotIn("cipherkey", wire)
+
+    def test_status_callbacks(self, lls_mock):
+        callback = Mock()
+        sender_obj = sender.Sender(Mock(), Mock(), self.storage, 8001, self.queue)
+        sender_obj.add_status_callback(callback)
+        sender_obj.status_queue.put(("id1", "sent"))
+        sender_obj.terminate()
+        sender_obj._status_thread.join()
+
+        callback.assert_called_once_with("id1", "sent")
+
+
+class TestLowLevelSender(unittest.TestCase):
+    def setUp(self):
+        self.queue = Mock()
+        self.status_queue = Mock()
+        self.llsender = sender.LowLevelSender(
+            self.queue, self.status_queue, Mock(), Mock(), 8001
+        )
+
+    def test_schedule_ciphergram_reports_sending(self):
+        pool = Mock()
+        self.llsender._schedule_ciphergram(pool, [], "text", "key", "id1")
+
+        self.status_queue.put.assert_called_once_with(("id1", "sending"))
+        pool.apply_async.assert_called_once()
+
+    def test_schedule_ciphergram_peers_difficulty(self):
+        pool = Mock()
+        addresses = [
+            orm.IPAddress("1.1.1.1", 8080), orm.IPAddress("2.2.2.2", 8081)
+        ]
+        self.llsender._difficulties[("2.2.2.2", 8081)] = 16
+        self.llsender._schedule_ciphergram(
+            pool, addresses, "text", "key", "id1"
+        )
+
+        args = pool.apply_async.call_args[0][1]
+        self.assertEqual(args, ("key", "text", 16))
+
+    def test_ready_ciphergram_goes_first(self):
+        ciphergram = crypto.EncryptedMessage("ct", "ck", "s", 1, 1000)
+        self.llsender._ciphergram_ready([], "id1", 2, ciphergram)
+
+        (addresses, message, user_key, message_id), priority = (
+            self.queue.put.call_args[0]
+        )
+        self.assertEqual(priority, sender.INTERACTIVE)
+        self.assertIsNone(user_key)
+        self.assertEqual(message_id, "id1")
+        self.assertEqual(message, sender.OwnCiphergram(ciphergram, 2))
+        wire = json.loads(self.llsender._encode_message(message))
+        self.assertEqual(wire["type"], "ciphergram")
+        self.assertEqual(wire["cipherkey"], "ck")
+
+    def _read_replies(self, required, message):
+        delivered = [(("1.1.1.1", 8080), Mock())]
+        with patch.object(
+            self.llsender, "_read_reply", return_value=required
+        ):
+            return self.llsender._read_replies(delivered, message, "id1")
+
+    def test_refused_ciphergram_is_redone(self):
+        self.llsender._pool = Mock()
+        ciphergram = crypto.EncryptedMessage("ct", "ck", "s", 1, 1000)
+        accepted = self._read_replies(8, sender.OwnCiphergram(ciphergram))
+
+        self.assertEqual(accepted, 0)
+        self.status_queue.put.assert_not_called()
+        args = self.llsender._pool.apply_async.call_args[0]
+        self.assertEqual(args, (sender._redo_proof, (ciphergram, 8)))
+        callback = self.llsender._pool.apply_async.call_args[1]["callback"]
+        callback(ciphergram)
+        (addresses, message, _, message_id), _ = self.queue.put.call_args[0]
+        self.assertEqual(addresses, [orm.IPAddress("1.1.1.1", 8080)])
+        self.assertEqual(message, sender.OwnCiphergram(ciphergram, 8))
+        self.assertEqual(message_id, "id1")
+
+    def test_refused_over_max_difficulty_fails(self):
+        self.llsender._pool = Mock()
+        ciphergram = crypto.EncryptedMessage("ct", "ck", "s", 1, 1000)
+        self._read_replies(1000, sender.OwnCiphergram(ciphergram))
+
+        self.llsender._pool.apply_async.assert_not_called()
+        self.status_queue.put.assert_called_once_with(("id1", "failed"))
+
+    def test_accepted_is_sent(self):
+        self._read_replies(None, "message")
+        self.status_queue.put.assert_called_once_with(("id1", "sent"))
+
+    def test_ciphergram_failed(self):
+        self.llsender._ciphergram_failed(
+            "id1", crypto.MessageCryptoInvalidRecipientKey()
+        )
+        self.status_queue.put.assert_called_once_with(("id1", "failed"))
+
+    def test_offline_response_wire_format(self):
+        self.llsender.ciphergrams = Mock()
+        self.llsender.ciphergrams.iter_all.return_value = iter([
+            orm.Ciphergram(b"\x01", b"\x02", b"\x03", 7, 1000)
+        ])
+        response = b"".join(
+            streaming.iter_chunks(self.llsender._get_offline_response(900))
+        )
+
+        self.llsender.ciphergrams.iter_all.assert_called_once_with(900)
+        ciphergram, = json.loads(response)["ciphergrams"]
+        self.assertEqual(ciphergram["timestamp"], 1000)
+        self.assertEqual(
+            json.loads(ciphergram["content"]),
+            dict(
+                type="ciphergram", server_port=8001, ciphertext="01",
+                cipherkey="02", signature="03", proof=7, timestamp=1000
+            )
+        )
+
+    @patch("securetalks.sender.snakesockets.TCP")
+    def test_offline_response_framing(self, tcp_mock):
+        self.llsender._context = Mock()
+        self.llsender.ciphergrams = Mock()
+        self.llsender.ciphergrams.iter_all.return_value = iter([])
+        address = orm.IPAddress("1.1.1.1", 8080)
+        socket_mock = tcp_mock.return_value
+
+        self.llsender._send_message([address], sender.OfflineData(900))
+        self.assertEqual(
+            json.loads(socket_mock.send.call_args[0][0])["ciphergrams"], []
+        )
+        socket_mock.send_chunked.assert_not_called()
+
+        socket_mock.reset_mock()
+        self.llsender._send_message(
+            [address], sender.OfflineData(900, chunked=True)
+        )
+        socket_mock.send.assert_not_called()
+        socket_mock.send_chunked.assert_called_once()
+
+    def test_session_is_resumed(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            certs = crypto.CertificateProvider(
+                pathlib.Path(data_dir), "ecdsa",
+                crypto.TLSSettings(min_version="1.3")
+            )
+            self.llsender.certs = certs
+            server = snakesockets.TCP()
+            server.sock = certs.make_server_context().wrap_socket(
+                server.sock, server_side=True
+            )
+            server.bind(("127.0.0.1", 0))
+            server.listen()
+            address = orm.IPAddress(*server.sock.getsockname())
+
+            reused = []
+            def serve():
+                for _ in range(2):
+                    client, _ = server.accept()
+                    client.recv()
+                    reused.append(client.sock.session_reused)
+                    client.send(b'{"pow_difficulty": 4}')
+                    client.close()
+            server_thread = threading.Thread(target=serve)
+            server_thread.start()
+            sent = [
+                self.llsender._send_message([address], "message").result()
+                for _ in range(2)
+            ]
+            server_thread.join()
+            server.close()
+
+        self.assertEqual(sent, [1, 1])
+        self.assertEqual(reused, [False, True])
+        self.assertEqual(self.llsender._get_difficulty([address]), 4)
+
+    def test_silent_peer_doesnt_hold_the_send_loop(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            certs = crypto.CertificateProvider(pathlib.Path(data_dir), "ecdsa")
+            self.llsender.certs = certs
+            self.llsender.close_timeout = 1
+            server = snakesockets.TCP()
+            server.sock = certs.make_server_context().wrap_socket(
+                server.sock, server_side=True
+            )
+            server.bind(("127.0.0.1", 0))
+            server.listen()
+            address = orm.IPAddress(*server.sock.getsockname())
+            clients = []
+            def serve():
+                client, _ = server.accept()
+                clients.append(client)  # never replies
+            server_thread = threading.Thread(target=serve)
+            server_thread.start()
+
+            started = time.monotonic()
+            future = self.llsender._send_message([address], "message", "id1")
+            elapsed = time.monotonic() - started
+            self.assertEqual(future.result(), 1)
+            server_thread.join()
+            for client in clients:
+                client.close()
+            server.close()
+
+        self.assertLess(elapsed, 0.5)
+        self.status_queue.put.assert_called_once_with(("id1", "sent"))
+
+    def test_relay_reports_nothing(self):
+        self.llsender._report_status(None, "sent")
+        self.status_queue.put.assert_not_called()
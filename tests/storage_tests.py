@@ -3,8 +3,10 @@ import shutil
 import pathlib
 import sqlite3
 import unittest
+from unittest.mock import Mock
 
 from . import testing_utils
+from .testing_utils import make_ciphergram
 
 from securetalks import storage
 from securetalks import orm
@@ -22,7 +24,7 @@ class TestNodes(unittest.TestCase):
 
     def test_update_node_activity(self):
         delta = 2
-        node = orm.Node("a")
+        node = orm.Node(testing_utils.node_id("a"))
         self.nodes.update_node_activity(node)
         self._cursor.execute(
             "SELECT last_activity FROM Nodes WHERE node_id=?",
@@ -41,7 +43,7 @@ class TestNodes(unittest.TestCase):
             self.nodes.update_node_activity(node)
 
     def test_increment_unread_count(self):
-        node = orm.Node("a")
+        node = orm.Node(testing_utils.node_id("a"))
         self.nodes.increment_node_unread(node)
         self._cursor.execute(
             "SELECT unread_count FROM Nodes WHERE node_id=?",
@@ -53,7 +55,7 @@ class TestNodes(unittest.TestCase):
         self.assertEqual(unread_count, 1)
 
     def test_set_node_unread_to_zero(self):
-        node = orm.Node("b")
+        node = orm.Node(testing_utils.node_id("b"))
         self.nodes.set_node_unread_to_zero(node)
         self._cursor.execute(
             "SELECT unread_count FROM Nodes WHERE node_id=?",
@@ -65,12 +67,12 @@ class TestNodes(unittest.TestCase):
         self.assertEqual(unread_count, 0)
 
     def test_check_node_exists_true(self):
-        node = orm.Node("b")
+        node = orm.Node(testing_utils.node_id("b"))
         node_exists = self.nodes.check_node_exists(node)
         self.assertTrue(node_exists)
 
     def test_check_node_exists_false(self):
-        node = orm.Node("d")
+        node = orm.Node(testing_utils.node_id("d"))
         node_exists = self.nodes.check_node_exists(node)
         self.assertFalse(node_exists)
 
@@ -80,18 +82,18 @@ class TestNodes(unittest.TestCase):
         self.assertTrue(self.nodes.check_node_exists(node))
 
     def test_add_node_failed(self):
-        node = orm.Node("c")
+        node = orm.Node(testing_utils.node_id("c"))
         with self.assertRaises(orm.NodeAlreadyExistsError):
             self.nodes.add_node(node)
 
     def test_delete_node(self):
-        node = orm.Node("a")
+        node = orm.Node(testing_utils.node_id("a"))
         self.nodes.delete_node(node)
         self.assertFalse(self.nodes.check_node_exists(node))
 
     def test_get_node_by_id(self):
-        node = self.nodes.get_node_by_id("c")
-        self.assertEqual(node.node_id, "c")
+        node = self.nodes.get_node_by_id(testing_utils.node_id("c"))
+        self.assertEqual(node.node_id, testing_utils.node_id("c"))
         self.assertEqual(node.last_activity, 3000)
         self.assertEqual(node.unread_count, 2)
         self.assertEqual(node.alias, "Steve Jobs")
@@ -109,12 +111,12 @@ class TestMessages(unittest.TestCase):
 
     def test_check_message_exists(self):
         msg_ok = orm.Message(
-            "c", "message2 c from me",
+            testing_utils.node_id("c"), "message2 c from me",
             to_me=False, sender_timestamp=5000
         )
         msg_ok_result = self.messages.check_message_exists(msg_ok)
         msg_fail = orm.Message(
-            "c", "message2 c from me",
+            testing_utils.node_id("c"), "message2 c from me",
             to_me=False, sender_timestamp=4000
         )
         msg_fail_result = self.messages.check_message_exists(msg_fail)
@@ -141,7 +143,7 @@ class TestMessages(unittest.TestCase):
         self.assertEqual(timestamp, message.timestamp)
 
     def test_get_messages_limit_none_offset_none(self):
-        node = orm.Node("c")
+        node = orm.Node(testing_utils.node_id("c"))
         messages = self.messages.get_messages(node)
 
         self.assertEqual(len(messages), 3)
@@ -151,7 +153,7 @@ class TestMessages(unittest.TestCase):
         self.assertEqual(messages[0].timestamp, 1000)
 
     def test_get_messages_limit_offset(self):
-        node = orm.Node("c")
+        node = orm.Node(testing_utils.node_id("c"))
         messages = self.messages.get_messages(node, limit=3, offset=1)
         self.assertEqual(len(messages), 2)
         self.assertEqual(messages[0].node_id, node.node_id)
@@ -160,12 +162,57 @@ class TestMessages(unittest.TestCase):
         self.assertEqual(messages[0].timestamp, 5000)
 
     def test_get_messages_limit(self):
-        node = orm.Node("c")
+        node = orm.Node(testing_utils.node_id("c"))
         messages = self.messages.get_messages(node, limit=2)
         self.assertEqual(len(messages), 2)
 
+    def test_get_last_messages(self):
+        node = orm.Node(testing_utils.node_id("c"))
+        messages = self.messages.get_last_messages(node, 2)
+        self.assertEqual(
+            [message.text for message in messages],
+            ["message2 c from me", "message3 c to me"]
+        )
+
+    def test_get_last_messages_skip(self):
+        node = orm.Node(testing_utils.node_id("c"))
+        messages = self.messages.get_last_messages(node, 5, skip=2)
+        self.assertEqual(
+            [message.text for message in messages], ["message1 c from me"]
+        )
+
+    def test_search_messages(self):
+        messages = self.messages.search_messages("messag me")
+        self.assertEqual(len(messages), 6)
+
+        node = orm.Node(testing_utils.node_id("c"))
+        messages = self.messages.search_messages("message2", node)
+        self.assertEqual(
+            [message.text for message in messages], ["message2 c from me"]
+        )
+
+    def test_search_messages_pagination(self):
+        first = self.messages.search_messages("message", limit=4)
+        rest = self.messages.search_messages("message", limit=4, offset=4)
+        self.assertEqual(len(first), 4)
+        self.assertEqual(len(rest), 2)
+        texts = [message.text for message in first + rest]
+        self.assertEqual(len(set(texts)), 6)
+
+    def test_search_messages_syntax(self):
+        self.assertEqual(self.messages.search_messages('" OR'), [])
+        self.assertEqual(self.messages.search_messages("  "), [])
+
+    def test_search_index_follows_messages(self):
+        node = orm.Node(testing_utils.node_id("c"))
+        self.messages.delete_messages(node)
+        self.messages.add_message(orm.Message(node.node_id, "needle", True))
+        messages = self.messages.search_messages("needle")
+        self.assertEqual([message.text for message in messages], ["needle"])
+        self.assertEqual(self.messages.search_messages("message2 c"), [])
+
     def test_delete_messages(self):
-        node = orm.Node("b")
+        node = orm.Node(testing_utils.node_id("b"))
         old_messages = self.messages.get_messages(node)
         self.messages.delete_messages(node)
         new_messages = self.messages.get_messages(node)
@@ -174,6 +221,30 @@ class TestMessages(unittest.TestCase):
         self.assertEqual(len(new_messages), 0)
 
 
+class TestKeys(unittest.TestCase):
+    def setUp(self):
+        self._db_name = testing_utils.setup_db()
+        self.keys = storage.Keys(self._db_name)
+
+    def tearDown(self):
+        pathlib.Path(self._db_name).unlink()
+
+    def test_migrated_keys(self):
+        self.assertEqual(self.keys.get_key(testing_utils.node_id("c")), "c")
+
+    def test_add_key(self):
+        key_fingerprint = self.keys.add_key("my key")
+        self.assertEqual(self.keys.add_key("my key"), key_fingerprint)
+        self.assertEqual(len(key_fingerprint), 32)
+        self.assertEqual(self.keys.get_key(key_fingerprint), "my key")
+
+    def test_delete_key(self):
+        key_fingerprint = self.keys.add_key("my key")
+        self.keys.delete_key(key_fingerprint)
+        with self.assertRaises(orm.KeyNotFoundError):
+            self.keys.get_key(key_fingerprint)
+
+
 class TestCiphergrams(unittest.TestCase):
     def setUp(self):
         self._db_name = testing_utils.setup_db()
@@ -185,10 +256,15 @@ class TestCiphergrams(unittest.TestCase):
         self._conn.close()
         pathlib.Path(self._db_name).unlink()
 
+    def _list_contents(self, since=None):
+        return [
+            cph.ciphertext.decode() for cph in self.ciphergrams.list_all(since)
+        ]
+
     def test_check_ciphergram_exists(self):
-        cph_ok = orm.Ciphergram("content1", 1000)
+        cph_ok = make_ciphergram("content1", 1000)
         cph_ok_result = self.ciphergrams.check_ciphergram_exists(cph_ok)
-        cph_fail = orm.Ciphergram("content100", 1000)
+        cph_fail = make_ciphergram("content100", 1000)
         cph_fail_result = self.ciphergrams.check_ciphergram_exists(cph_fail)
 
         self.assertTrue(cph_ok_result)
@@ -197,9 +273,30 @@ class TestCiphergrams(unittest.TestCase):
     def test_list_all(self):
         ciphergrams = self.ciphergrams.list_all()
         self.assertEqual(len(ciphergrams), 3)
-        self.assertEqual(ciphergrams[0].content, "content1")
+        self.assertEqual(ciphergrams[0].ciphertext, b"content1")
         self.assertEqual(ciphergrams[0].timestamp, 1000)
 
+    def test_iter_all_pages(self):
+        self.ciphergrams.page_size = 1
+        self.ciphergrams.add_ciphergram(make_ciphergram("content4", 1001))
+        ciphergrams = self.ciphergrams.iter_all()
+        first = next(ciphergrams)
+
+        # no read is kept open between the pages
+        conn = sqlite3.connect(self._db_name, timeout=0)
+        conn.execute("BEGIN EXCLUSIVE")
+        conn.rollback()
+        conn.close()
+
+        contents = [first.ciphertext] + [
+            cph.ciphertext for cph in ciphergrams
+        ]
+        self.assertEqual(len(contents), 4)
+        self.assertEqual(set(contents), {
+            cph.ciphertext for cph in self.ciphergrams.list_all()
+        })
+        self.assertEqual(contents[0], b"content1")
+
     def test_delete_expired(self):
         old_ciphergrams = self.ciphergrams.list_all()
         self.ciphergrams.delete_expired(60*60*24*2)
@@ -208,8 +305,104 @@ class TestCiphergrams(unittest.TestCase):
         self.assertEqual(len(old_ciphergrams), 3)
         self.assertEqual(len(new_ciphergrams), 1)
 
+    def test_delete_expired_limit(self):
+        self.ciphergrams.add_ciphergram(make_ciphergram("content4", 10**5))
+        deleted = self.ciphergrams.delete_expired(60*60*24*2, limit=1)
+        new_ciphergrams = self.ciphergrams.list_all()
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(len(new_ciphergrams), 2)
+
+    def test_expired_partitions_are_dropped(self):
+        self.ciphergrams.delete_expired(60*60*24*2)
+        self._cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND name LIKE 'Ciphergrams!_%' ESCAPE '!'"
+        )
+        bucket = self.ciphergrams.get_bucket(999999999999999)
+        self.assertEqual(self._cursor.fetchall(), [(f"Ciphergrams_{bucket}", )])
+
+    def test_list_since(self):
+        self.ciphergrams.add_ciphergram(make_ciphergram("content4", 10**5))
+        contents = self._list_contents(since=2000)
+        self.assertEqual(contents, ["content2", "content4", "content3"])
+
+    def test_get_latest_timestamp(self):
+        self.assertEqual(self.ciphergrams.get_latest_timestamp(), 2000)
+
+    def test_usage_is_tracked(self):
+        self.assertEqual(self.ciphergrams.get_usage(), (3, 24))
+        self.ciphergrams.add_ciphergram(
+            make_ciphergram("my content", 7000, origin="1.1.1.1")
+        )
+        self.assertEqual(self.ciphergrams.get_usage(), (4, 34))
+        self.ciphergrams.delete_expired(60*60*24*2)
+        self.assertEqual(self.ciphergrams.get_usage(), (1, 8))
+
+    def test_quota_with_drifted_usage(self):
+        ciphergrams = Mock()
+        ciphergrams.get_usage.return_value = (0, 100)
+        ciphergrams.evict.return_value = 0
+        quota = storage.CiphergramsQuota(max_bytes=10)
+        self.assertEqual(quota.enforce(ciphergrams), 0)
+
+        ciphergrams.get_usage.return_value = (5, 100)
+        quota = storage.CiphergramsQuota(max_rows=2, max_bytes=10)
+        self.assertEqual(quota.enforce(ciphergrams), 0)
+        ciphergrams.evict.assert_called_once_with(5, "age")
+
+    def test_evict_by_age(self):
+        self.ciphergrams.evict(2, "age")
+        contents = self._list_contents()
+        self.assertEqual(contents, ["content3"])
+
+    def test_evict_by_strength(self):
+        self.ciphergrams.add_ciphergram(make_ciphergram("weak", 1, weight=1))
+        self.ciphergrams.add_ciphergram(make_ciphergram("strong", 1, weight=9))
+        self.ciphergrams.evict(1, "strength")
+        contents = self._list_contents()
+        self.assertNotIn("content1", contents)
+        self.assertIn("weak", contents)
+
+        self.ciphergrams.evict(3, "strength")
+        contents = self._list_contents()
+        self.assertEqual(contents, ["strong"])
+
+    def test_evict_fairness(self):
+        for i in range(3):
+            self.ciphergrams.add_ciphergram(
+                make_ciphergram(f"spam message {i}", i, origin="6.6.6.6")
+            )
+        self.ciphergrams.add_ciphergram(
+            make_ciphergram("fair", 1, origin="1.1.1.1")
+        )
+        self.ciphergrams.evict(2, "fairness")
+        contents = self._list_contents()
+        self.assertNotIn("spam message 0", contents)
+        self.assertNotIn("spam message 1", contents)
+        self.assertIn("fair", contents)
+
+    def test_quota(self):
+        quota = storage.CiphergramsQuota(max_rows=2)
+        self.assertEqual(quota.enforce(self.ciphergrams), 1)
+        quota = storage.CiphergramsQuota(max_bytes=10)
+        self.assertEqual(quota.enforce(self.ciphergrams), 1)
+        self.assertEqual(self.ciphergrams.get_usage(), (1, 8))
+
+    def test_quota_with_drifted_usage(self):
+        ciphergrams = Mock()
+        ciphergrams.get_usage.return_value = (0, 100)
+        ciphergrams.evict.return_value = 0
+        quota = storage.CiphergramsQuota(max_bytes=10)
+        self.assertEqual(quota.enforce(ciphergrams), 0)
+
+        ciphergrams.get_usage.return_value = (5, 100)
+        quota = storage.CiphergramsQuota(max_rows=2, max_bytes=10)
+        self.assertEqual(quota.enforce(ciphergrams), 0)
+        ciphergrams.evict.assert_called_once_with(5, "age")
+
     def test_add_ciphergram(self):
-        ciphergram = orm.Ciphergram("my content", 7000)
+        ciphergram = make_ciphergram("my content", 7000)
         old_ciphergrams = self.ciphergrams.list_all()
         self.ciphergrams.add_ciphergram(ciphergram)
         new_ciphergrams = self.ciphergrams.list_all()
@@ -217,6 +410,23 @@ class TestCiphergrams(unittest.TestCase):
         self.assertNotIn(ciphergram, old_ciphergrams)
         self.assertIn(ciphergram, new_ciphergrams)
 
+    def test_add_group_ciphergram(self):
+        cipherkeys = [b"key1", b"key2"]
+        self.ciphergrams.add_ciphergram(
+            orm.Ciphergram(
+                b"group content", orm.pack_cipherkeys(cipherkeys), b"", 0,
+                7000, multikey=True
+            )
+        )
+        stored, = [
+            cph for cph in self.ciphergrams.list_all()
+            if cph.ciphertext == b"group content"
+        ]
+
+        self.assertTrue(stored.multikey)
+        self.assertEqual(orm.unpack_cipherkeys(stored.cipherkey), cipherkeys)
+        self.assertFalse(self.ciphergrams.list_all()[0].multikey)
+
 class TestIPAddresses(unittest.TestCase):
     def setUp(self):
         self._db_name = testing_utils.setup_db()
@@ -284,3 +494,140 @@ class TestIPAddresses(unittest.TestCase):
         ipaddress = orm.IPAddress("8.8.8.8", 8888)
         with self.assertRaises(orm.IPAddressNotFoundError):
             self.ipaddresses.update_address(ipaddress)
+
+
+class TestWriteBatcher(unittest.TestCase):
+    def setUp(self):
+        self._db_name = testing_utils.setup_db()
+        self._conn = sqlite3.connect(self._db_name)
+        self._cursor = self._conn.cursor()
+        self.batcher = storage.WriteBatcher(self._db_name, max_delay=10)
+
+    def tearDown(self):
+        self.batcher.close()
+        self._conn.close()
+        pathlib.Path(self._db_name).unlink()
+
+    def test_add_received_message_new_node(self):
+        callback = Mock()
+        node_id = orm.fingerprint("d")
+        message = orm.Message(
+            node_id, "hello", to_me=True, sender_timestamp=10
+        )
+        self.batcher.add_received_message(message, "d", callback)
+        self.batcher.flush()
+
+        node, stored_message = callback.call_args[0][0]
+        self.assertEqual(node.node_id, node_id)
+        self.assertEqual(node.unread_count, 1)
+        self.assertEqual(stored_message, message)
+        self._cursor.execute(
+            "SELECT COUNT(*) FROM Messages WHERE node_id=?", (node_id, )
+        )
+        self.assertEqual(self._cursor.fetchone(), (1, ))
+        self._cursor.execute(
+            "SELECT key FROM Keys WHERE fingerprint=?", (node_id, )
+        )
+        self.assertEqual(self._cursor.fetchone(), ("d", ))
+
+    def test_add_received_message_duplicate(self):
+        callback = Mock()
+        message = orm.Message(
+            orm.fingerprint("c"), "hello", to_me=True, sender_timestamp=10
+        )
+        self.batcher.add_received_message(message, "c", callback)
+        self.batcher.add_received_message(message, "c", callback)
+        self.batcher.flush()
+
+        self.assertEqual(callback.call_count, 1)
+        node, _ = callback.call_args[0][0]
+        self.assertEqual(node.unread_count, 3)
+        self.assertEqual(node.alias, "Steve Jobs")
+        counters = self.batcher.metrics.snapshot()["counters"]
+        self.assertEqual(counters["messages_stored"], 1)
+        self.assertEqual(counters["messages_duplicate"], 1)
+
+    def test_add_ciphergram(self):
+        self.batcher.add_ciphergram(make_ciphergram("content1", 1000))
+        self.batcher.add_ciphergram(make_ciphergram("content4", 4000))
+        self.batcher.flush()
+
+        self._cursor.execute("SELECT SUM(rows) FROM CiphergramsUsage")
+        self.assertEqual(self._cursor.fetchone(), (4, ))
+
+    def test_nothing_committed_before_flush(self):
+        self.batcher.add_ciphergram(make_ciphergram("content4", 4000))
+        self._cursor.execute("SELECT SUM(rows) FROM CiphergramsUsage")
+        self.assertEqual(self._cursor.fetchone(), (3, ))
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self._db_name = testing_utils.setup_db()
+        self._conn = sqlite3.connect(self._db_name)
+        self._cursor = self._conn.cursor()
+        self.storage = storage.Storage(self._db_name, 60*60*24*2)
+
+    def tearDown(self):
+        self.storage.close()
+        self._conn.close()
+        pathlib.Path(self._db_name).unlink()
+
+    def test_incremental_vacuum_enabled(self):
+        self._cursor.execute("PRAGMA auto_vacuum")
+        self.assertEqual(self._cursor.fetchone(), (2, ))
+
+    def test_commit(self):
+        with self.storage.transaction() as tx:
+            tx.nodes.add_node(orm.Node("e"))
+            tx.messages.add_message(
+                orm.Message("e", "hello", to_me=True, sender_timestamp=10)
+            )
+
+        self.assertTrue(self.storage.nodes.check_node_exists(orm.Node("e")))
+        self.assertEqual(
+            len(self.storage.messages.get_messages(orm.Node("e"))), 1
+        )
+
+    def test_commit_listeners(self):
+        listener = Mock()
+        self.storage.add_commit_listener(listener)
+        with self.storage.transaction(write=False) as tx:
+            tx.nodes.list_all()
+        listener.assert_not_called()
+
+        with self.storage.transaction() as tx:
+            tx.nodes.add_node(orm.Node("e"))
+        self.storage.batcher.add_ciphergram(make_ciphergram("content4", 4000))
+        self.storage.batcher.flush()
+        self.assertEqual(listener.call_count, 2)
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(orm.NodeAlreadyExistsError):
+            with self.storage.transaction() as tx:
+                tx.nodes.add_node(orm.Node("e"))
+                tx.nodes.add_node(orm.Node(testing_utils.node_id("a")))
+
+        self.assertFalse(self.storage.nodes.check_node_exists(orm.Node("e")))
+
+    def test_delete_expired_data_in_batches(self):
+        self.storage.delete_expired_data(batch_size=1)
+
+        self.assertEqual(len(self.storage.ciphergrams.list_all()), 1)
+        self.assertEqual(len(self.storage.ipaddresses.list_all()), 1)
+
+    def test_maintenance_pragmas(self):
+        self.storage.incremental_vacuum()
+        self.storage.checkpoint()
+        self.storage.analyze()
+
+        self._cursor.execute("PRAGMA journal_mode")
+        self.assertEqual(self._cursor.fetchone(), ("wal", ))
+
+    def test_uncommitted_changes_are_invisible(self):
+        with self.storage.transaction() as tx:
+            tx.nodes.add_node(orm.Node("e"))
+            self._cursor.execute(
+                "SELECT COUNT(*) FROM Nodes WHERE node_id='e'"
+            )
+            self.assertEqual(self._cursor.fetchone(), (0, ))
@@ -0,0 +1,72 @@
+import json
+import socket
+import unittest
+
+from securetalks import streaming
+from securetalks import snakesockets
+
+
+class TestIterJson(unittest.TestCase):
+    def test_same_as_json(self):
+        obj = dict(
+            type="response", port=8001, ok=True, none=None, ratio=0.5,
+            items=[dict(text="привет \"quoted\""), (1, 2), []], empty={}
+        )
+        encoded = b"".join(streaming.iter_chunks(obj)).decode("utf-8")
+        self.assertEqual(json.loads(encoded), obj | dict(items=[
+            dict(text="привет \"quoted\""), [1, 2], []
+        ]))
+
+    def test_bytes_are_strings(self):
+        encoded = b"".join(streaming.iter_chunks(dict(text=b"hi")))
+        self.assertEqual(json.loads(encoded), dict(text="hi"))
+
+    def test_generators_are_arrays(self):
+        obj = dict(items=(dict(n=n) for n in range(3)))
+        encoded = b"".join(streaming.iter_chunks(obj))
+        self.assertEqual(
+            json.loads(encoded), dict(items=[dict(n=0), dict(n=1), dict(n=2)])
+        )
+
+    def test_chunk_size(self):
+        obj = [dict(content="x" * 100) for _ in range(1000)]
+        chunks = list(streaming.iter_chunks(obj, chunk_size=1000))
+
+        self.assertGreater(len(chunks), 50)
+        self.assertTrue(all(len(chunk) < 1200 for chunk in chunks))
+        self.assertEqual(json.loads(b"".join(chunks)), obj)
+
+
+class TestChunkedFrames(unittest.TestCase):
+    def setUp(self):
+        left, right = socket.socketpair()
+        self.sender = snakesockets.TCP(left)
+        self.receiver = snakesockets.TCP(right)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_chunked_and_plain_frames(self):
+        self.sender.send_chunked([b"ab", b"", b"cd"])
+        self.sender.send(b"plain")
+
+        self.assertEqual(self.receiver.recv(), b"abcd")
+        self.assertEqual(self.receiver.recv(), b"plain")
+
+    def test_max_size(self):
+        self.sender.send(b"x" * 10)
+        with self.assertRaises(snakesockets.FrameTooLargeError):
+            self.receiver.recv(max_size=9)
+
+    def test_max_size_of_chunked_frame(self):
+        self.sender.send_chunked([b"x" * 5, b"x" * 5])
+        with self.assertRaises(snakesockets.FrameTooLargeError):
+            self.receiver.recv(max_size=9)
+
+    def test_closed_inside_of_frame(self):
+        self.sender.sock.sendall(b"\x00\x00\x00\x10abc")
+        self.sender.sock.shutdown(socket.SHUT_WR)
+
+        with self.assertRaises(ConnectionError):
+            self.receiver.recv()
@@ -2,6 +2,7 @@ import shutil
 import pathlib
 import sqlite3
 
+from securetalks import orm
 from securetalks import storage
 
 def setup_db():
@@ -14,4 +15,14 @@ def setup_db():
 
     db_name = str(db_path.parent / "test_active.db")
     shutil.copyfile(db_path, db_name)
-    return db_name
\ No newline at end of file
+    storage.Storage.migrate(db_name)
+    return db_name
+
+def node_id(key):
+    """Id of a fixture node after node ids were replaced by fingerprints"""
+    return orm.fingerprint(key)
+
+def make_ciphergram(text, timestamp, **kwargs):
+    return orm.Ciphergram(
+        text.encode("utf-8"), b"", b"", 0, timestamp, **kwargs
+    )